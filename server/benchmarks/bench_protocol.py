@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+''' Measure the time and memory needed to build and serialize protocol objects
+
+Builds a references result of many Locations, then serializes it with
+the standard library encoder and with orjson, if it is installed
+'''
+import argparse
+import json
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+
+# the server package isn't installed, so make it importable however the benchmark is run
+SERVER_DIR = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(SERVER_DIR))
+
+from yarals import protocol as lsp
+
+
+def _build_cli():
+    parser = argparse.ArgumentParser(description="Benchmark protocol object serialization")
+    parser.add_argument("-n", "--locations", type=int, default=100000, help="Number of locations to serialize")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs to take the best time of")
+    return parser.parse_args()
+
+def build_locations(count: int) -> list:
+    ''' Build a list of Locations spread across a few files '''
+    results = []
+    for index in range(count):
+        locrange = lsp.Range(
+            start=lsp.Position(line=index, char=4),
+            end=lsp.Position(line=index, char=16)
+        )
+        results.append(lsp.Location(locrange, "file:///rules/{:d}.yara".format(index % 100)))
+    return results
+
+def measure(func, repeat: int) -> dict:
+    ''' Get the best wall time and the peak memory allocated by a callable '''
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    # tracing slows everything down, so memory is measured in a separate run
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"seconds": round(best, 4), "peak_mib": round(peak / 2**20, 2)}
+
+def main():
+    ''' Program entrypoint '''
+    args = _build_cli()
+    locations = build_locations(args.locations)
+    message = {"jsonrpc": "2.0", "id": 1, "result": locations}
+    results = {
+        "locations": args.locations,
+        "build": measure(lambda: build_locations(args.locations), args.repeat),
+        "json": measure(lambda: json.dumps(message, cls=lsp.JSONEncoder), args.repeat)
+    }
+    if lsp.HAS_ORJSON:
+        results["orjson"] = measure(lambda: lsp.dumps(message), args.repeat)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
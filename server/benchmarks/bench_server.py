@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+''' Measure end-to-end request latency against a real language server
+
+Generates a synthetic workspace of rule files, serves it with
+YaraLanguageServer.handle_client over a loopback TCP connection, and
+times each request from the moment it is written until its response
+arrives. Results are printed (or saved) as JSON, so runs on different
+commits can be compared with --baseline
+'''
+import argparse
+import asyncio
+import itertools
+import json
+from pathlib import Path
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# the server package isn't installed, so make it importable however the benchmark is run
+SERVER_DIR = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(SERVER_DIR))
+
+from yarals.compiler import HAS_YARA
+from yarals.yarals import YaraLanguageServer
+
+
+METHODS = ("completion", "definition", "hover", "references", "rename", "didChange", "compileAll")
+# rules, files, strings per rule and strings in the single deep rule
+PRESETS = {
+    "small": (1000, 10, 5, 1000),
+    "medium": (10000, 20, 10, 5000),
+    "large": (100000, 1, 10, 20000)
+}
+
+
+def _build_cli():
+    parser = argparse.ArgumentParser(description="Benchmark language server requests end-to-end")
+    parser.add_argument("-p", "--preset", choices=sorted(PRESETS), default="small", help="Corpus size to generate")
+    parser.add_argument("--rules", type=int, help="Number of rules. Overrides the preset")
+    parser.add_argument("--files", type=int, help="Number of files to spread rules over. Overrides the preset")
+    parser.add_argument("--strings", type=int, help="Strings per rule. Overrides the preset")
+    parser.add_argument("--deep", type=int, help="Strings in one extra rule of the first file. Overrides the preset")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Requests to send per method")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--compile-runs", type=int, default=3, help="Number of CompileAllRules commands to send")
+    parser.add_argument("-m", "--methods", nargs="+", choices=METHODS, default=list(METHODS), help="Methods to measure")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for picking request positions")
+    parser.add_argument("-o", "--output", type=Path, help="Save results to this file instead of printing them")
+    parser.add_argument("-b", "--baseline", type=Path, help="Results of an earlier run to compare against")
+    return parser.parse_args()
+
+
+class Corpus(object):
+    def __init__(self, root: Path, rules: int, files: int, strings: int, deep: int):
+        ''' Synthetic workspace of rule files
+
+        Every rule imports "pe", defines a few strings and references the rule
+        before it, so all request types have something to find. The first file
+        also holds one rule with a very deep strings section. Positions worth
+        sending requests for are recorded while the files are written
+        '''
+        self.root = root
+        self.files = []
+        self.size = 0
+        # (line, character) positions in the first file, by kind of symbol
+        self.targets = {"string": [], "rule": [], "module": [], "change": []}
+        per_file = max(rules // files, 1)
+        number = 0
+        for index in range(files):
+            count = per_file if index < files - 1 else max(rules - number, 1)
+            lines = ["import \"pe\"", ""]
+            if index == 0:
+                self._add_rule(lines, "DeepStrings", deep, None, record=True)
+            for _ in range(count):
+                previous = "Rule_{:d}".format(number - 1) if number else None
+                self._add_rule(lines, "Rule_{:d}".format(number), strings, previous, record=index == 0)
+                number += 1
+            path = root.joinpath("rules_{:d}.yara".format(index))
+            text = "\n".join(lines) + "\n"
+            path.write_text(text, encoding="utf-8")
+            self.size += len(text)
+            self.files.append(path)
+        self.text = self.files[0].read_text(encoding="utf-8")
+
+    def __repr__(self):
+        return "<Corpus(files={:d}, bytes={:d})>".format(len(self.files), self.size)
+
+    def _add_rule(self, lines: list, name: str, strings: int, previous: str, record: bool):
+        ''' Append one rule to a file's lines '''
+        lines.append("rule {} : bench".format(name))
+        lines.append("{")
+        lines.append("    meta:")
+        lines.append("        author = \"bench\"")
+        if record:
+            self.targets["change"].append((len(lines) - 1, 18))
+        lines.append("    strings:")
+        for index in range(max(strings, 1)):
+            if index % 3 == 2:
+                lines.append("        $s{:d} = {{ 4D 5A ?? {:02X} [2-4] 50 45 }}".format(index, index % 256))
+            else:
+                lines.append("        $s{:d} = \"{} string {:d}\" ascii wide".format(index, name, index))
+        lines.append("    condition:")
+        condition = "        pe.number_of_sections > 1 and #s0 > 0 and any of ($s*)"
+        if record:
+            row = len(lines)
+            self.targets["module"].append((row, condition.index("pe.") + 3))
+            self.targets["string"].append((row, condition.index("#s0") + 2))
+        if previous is not None:
+            if record:
+                self.targets["rule"].append((len(lines), len(condition) + 5))
+            condition += " and " + previous
+        lines.append(condition)
+        lines.append("}")
+        lines.append("")
+
+
+class Client(object):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ''' Minimal language client timing its requests '''
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count(1)
+        self.waiting = {}
+        self.notifications = 0
+        self.received = 0
+        self._listener = asyncio.ensure_future(self._listen())
+
+    def __repr__(self):
+        return "<Client(waiting={:d})>".format(len(self.waiting))
+
+    async def _listen(self):
+        ''' Match responses to the requests waiting for them '''
+        while True:
+            header = await self.reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in header.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            body = await self.reader.readexactly(length)
+            self.received += len(header) + length
+            message = json.loads(body)
+            if "id" in message and message["id"] in self.waiting:
+                self.waiting.pop(message["id"]).set_result(message)
+            else:
+                self.notifications += 1
+
+    def close(self):
+        self._listener.cancel()
+        self.writer.close()
+
+    def notify(self, method: str, params: dict):
+        ''' Send a notification, which is never answered '''
+        self._send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    async def request(self, method: str, params: dict) -> dict:
+        ''' Send a request and wait for its response '''
+        curr_id = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[curr_id] = future
+        self._send({"jsonrpc": "2.0", "id": curr_id, "method": method, "params": params})
+        return await future
+
+    def _send(self, message: dict):
+        body = json.dumps(message).encode("utf-8")
+        self.writer.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    ''' Reduce request latencies (in seconds) to percentiles and throughput '''
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50_ms": round(statistics.median(ordered) * 1000, 3),
+        "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "per_sec": round(len(ordered) / elapsed, 1) if elapsed else None
+    }
+
+async def measure(send, count: int, concurrency: int) -> dict:
+    ''' Time a number of calls to an async callable, keeping some of them in flight at once '''
+    latencies = []
+    calls = iter(range(count))
+
+    async def worker():
+        for index in calls:
+            start = time.perf_counter()
+            await send(index)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start)
+
+async def run(args, corpus: Corpus) -> dict:
+    ''' Serve the corpus and send every benchmarked request '''
+    server = YaraLanguageServer()
+    socket_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0, limit=2**26)
+    host, port = socket_server.sockets[0].getsockname()[:2]
+    reader, writer = await asyncio.open_connection(host, port, limit=2**26)
+    client = Client(reader, writer)
+    rng = random.Random(args.seed)
+    file_uri = corpus.files[0].as_uri()
+    text_document = {"uri": file_uri}
+    results = {}
+    try:
+        initialize = json.loads(SERVER_DIR.joinpath("tests", "initialize_msg.json").read_text())["params"]
+        initialize["rootUri"] = corpus.root.as_uri()
+        initialize["rootPath"] = str(corpus.root)
+        await client.request("initialize", initialize)
+        client.notify("initialized", {})
+        client.notify("textDocument/didOpen", {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 1, "text": corpus.text}
+        })
+        # wait for the server to load modules and index the workspace before timing anything
+        await server.warm_up()
+        await server.workspaces.get(corpus.root).indexer
+
+        def position(kind: str) -> dict:
+            line, char = rng.choice(corpus.targets[kind])
+            return {"line": line, "character": char}
+
+        requests = {
+            "completion": ("textDocument/completion", lambda: {"textDocument": text_document, "position": position("module")}),
+            "definition": ("textDocument/definition", lambda: {"textDocument": text_document, "position": position(rng.choice(("string", "rule")))}),
+            "hover": ("textDocument/hover", lambda: {"textDocument": text_document, "position": position("string")}),
+            "references": ("textDocument/references", lambda: {
+                "textDocument": text_document, "position": position(rng.choice(("string", "rule"))),
+                "context": {"includeDeclaration": True}
+            }),
+            "rename": ("textDocument/rename", lambda: {"textDocument": text_document, "position": position("string"), "newName": "renamed"})
+        }
+        for name, (method, build) in requests.items():
+            if name in args.methods:
+                results[name] = await measure(lambda _, method=method, build=build: client.request(method, build()), args.requests, args.concurrency)
+        if "didChange" in args.methods:
+            versions = itertools.count(2)
+
+            async def change(index: int):
+                # notifications are not answered, so follow each edit with a hover that has to see it
+                line, char = rng.choice(corpus.targets["change"])
+                edit = {"start": {"line": line, "character": char}, "end": {"line": line, "character": char + 1}}
+                client.notify("textDocument/didChange", {
+                    "textDocument": {"uri": file_uri, "version": next(versions)},
+                    "contentChanges": [{"range": edit, "text": "abcdefgh"[index % 8]}]
+                })
+                await client.request("textDocument/hover", {"textDocument": text_document, "position": position("string")})
+
+            # edits of the same buffer can't overlap
+            results["didChange"] = await measure(change, args.requests, 1)
+        if "compileAll" in args.methods and HAS_YARA:
+            command = {"command": "yara.CompileAllRules", "arguments": []}
+            results["compileAll"] = await measure(lambda _: client.request("workspace/executeCommand", command), args.compile_runs, 1)
+        results["bytes_received"] = client.received
+    finally:
+        client.close()
+        socket_server.close()
+        await socket_server.wait_closed()
+        server.compiler.shutdown()
+    return results
+
+def _git_commit() -> str:
+    ''' Get the commit being measured, if the code is in a git repository '''
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=str(SERVER_DIR),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        )
+        return output.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: dict, baseline: dict) -> dict:
+    ''' Get the ratio of each method's p50 and p99 latency to the baseline's. Below 1 is faster '''
+    ratios = {}
+    for method in METHODS:
+        new, old = results["methods"].get(method, {}), baseline.get("methods", {}).get(method, {})
+        if new.get("count") and old.get("count"):
+            ratios[method] = {
+                key: round(new[key] / old[key], 3) if old[key] else None
+                for key in ("p50_ms", "p99_ms")
+            }
+    return ratios
+
+def main():
+    ''' Program entrypoint '''
+    args = _build_cli()
+    rules, files, strings, deep = PRESETS[args.preset]
+    rules = args.rules or rules
+    files = args.files or files
+    strings = args.strings or strings
+    deep = args.deep if args.deep is not None else deep
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        corpus = Corpus(Path(tmpdir), rules, files, strings, deep)
+        generate_time = time.perf_counter() - start
+        methods = asyncio.run(run(args, corpus))
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "yara": HAS_YARA,
+        "corpus": {
+            "rules": rules, "files": files, "strings": strings, "deep_strings": deep,
+            "megabytes": round(corpus.size / 2**20, 2), "generate_seconds": round(generate_time, 2)
+        },
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "bytes_received": methods.pop("bytes_received", 0),
+        "methods": methods
+    }
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        results["baseline"] = {"commit": baseline.get("commit", None), "ratios": compare(results, baseline)}
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+''' Measure how quickly the language server starts up
+
+Launches vscode_yara.py in a new process, then measures:
+  * time-to-listening: until the server accepts TCP connections
+  * time-to-first-response: until the server answers the initialize request
+'''
+import argparse
+import json
+from pathlib import Path
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+
+SERVER_DIR = Path(__file__).parent.parent.resolve()
+
+
+def _build_cli():
+    parser = argparse.ArgumentParser(description="Benchmark language server startup")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="Number of server launches")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind the server to")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for the server")
+    return parser.parse_args()
+
+def _free_port(host: str) -> int:
+    ''' Find a port nobody is listening on '''
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def _read_message(sock: socket.socket) -> dict:
+    ''' Read a single JSON-RPC message from a socket '''
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += sock.recv(4096)
+    header, _, body = data.partition(b"\r\n\r\n")
+    length = int(header.split(b":")[1])
+    while len(body) < length:
+        body += sock.recv(4096)
+    return json.loads(body[:length])
+
+def launch(host: str, timeout: float) -> dict:
+    ''' Start one server and time how long it takes to become useful '''
+    port = _free_port(host)
+    message = json.loads(SERVER_DIR.joinpath("tests", "initialize_msg.json").read_text())
+    body = json.dumps(message).encode("utf-8")
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, str(SERVER_DIR.joinpath("vscode_yara.py")), host, str(port)],
+        cwd=str(SERVER_DIR), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError("Server did not start listening within {:.0f} seconds".format(timeout))
+            try:
+                sock = socket.create_connection((host, port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.001)
+        listening = time.perf_counter() - start
+        with sock:
+            sock.sendall(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+            _read_message(sock)
+            responding = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {"listening": listening, "first_response": responding}
+
+def main():
+    ''' Program entrypoint '''
+    args = _build_cli()
+    runs = [launch(args.host, args.timeout) for _ in range(args.repeat)]
+    results = {"launches": args.repeat}
+    for metric in ("listening", "first_response"):
+        times = [run[metric] for run in runs]
+        results[metric] = {
+            "median_ms": round(statistics.median(times) * 1000, 1),
+            "min_ms": round(min(times) * 1000, 1)
+        }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
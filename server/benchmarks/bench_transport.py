@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+''' Measure the throughput of the raw JSON-RPC message pump
+
+Frames a batch of messages with write_data(), then parses them all back
+with read_request(), without any network in between
+'''
+import argparse
+import asyncio
+import json
+from pathlib import Path
+import sys
+import time
+
+# the server package isn't installed, so make it importable however the benchmark is run
+SERVER_DIR = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(SERVER_DIR))
+
+from yarals.yarals import LanguageServer
+
+
+class BufferTransport(asyncio.Transport):
+    ''' Transport that collects everything written to it in memory '''
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return self.closed
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+def _build_cli():
+    parser = argparse.ArgumentParser(description="Benchmark JSON-RPC framing and parsing")
+    parser.add_argument("-n", "--messages", type=int, default=20000, help="Number of messages to send")
+    parser.add_argument("-l", "--locations", type=int, default=50, help="Locations per response message")
+    parser.add_argument("--ascii", action="store_true", help="Only use ASCII text in messages")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs to take the best time of")
+    return parser.parse_args()
+
+def _build_message(curr_id: int, locations: int, folder: str) -> str:
+    ''' Build a references response with the given number of locations '''
+    result = []
+    for index in range(locations):
+        pos = {"line": index, "character": 4}
+        result.append({"uri": "file:///rules/{}/{:d}.yara".format(folder, curr_id), "range": {"start": pos, "end": pos}})
+    return json.dumps({"jsonrpc": "2.0", "id": curr_id, "result": result}, ensure_ascii=False)
+
+async def bench(server: LanguageServer, messages: list) -> dict:
+    ''' Time writing and then reading back every message '''
+    reader = asyncio.StreamReader(limit=2**24)
+    transport = BufferTransport()
+    writer = asyncio.StreamWriter(transport, asyncio.StreamReaderProtocol(reader), reader, asyncio.get_event_loop())
+    start = time.perf_counter()
+    for message in messages:
+        await server.write_data(message, writer)
+    write_time = time.perf_counter() - start
+    data = b"".join(chunk if isinstance(chunk, bytes) else bytes(chunk) for chunk in transport.chunks)
+    reader.feed_data(data)
+    reader.feed_eof()
+    start = time.perf_counter()
+    for _ in messages:
+        await server.read_request(reader)
+    read_time = time.perf_counter() - start
+    writer.close()
+    return {"write": write_time, "read": read_time, "bytes": len(data)}
+
+async def main():
+    ''' Program entrypoint '''
+    args = _build_cli()
+    server = LanguageServer()
+    folder = "rules" if args.ascii else "règles"
+    messages = [_build_message(curr_id, args.locations, folder) for curr_id in range(args.messages)]
+    runs = [await bench(server, messages) for _ in range(args.repeat)]
+    results = {
+        "messages": args.messages,
+        "megabytes": runs[0]["bytes"] / 2**20,
+        "write_msgs_per_sec": args.messages / min(run["write"] for run in runs),
+        "read_msgs_per_sec": args.messages / min(run["read"] for run in runs)
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
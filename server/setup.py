@@ -12,6 +12,7 @@ setup(
     package_data={"yarals": ["data/*.json"]},
     provides=["yarals"],
     install_requires=["yara-python"],
+    extras_require={"speedups": ["orjson"]},
     tests_require=["pytest", "pytest-asyncio"],
     scripts=["vscode_yara.py"]
 )
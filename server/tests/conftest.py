@@ -10,11 +10,23 @@ from yarals import yarals
 
 def pytest_configure(config):
     ''' Registering custom markers '''
+    config.addinivalue_line("markers", "atoms: Run atom quality unittests")
+    config.addinivalue_line("markers", "cache: Run result cache unittests")
+    config.addinivalue_line("markers", "compiler: Run rule compilation unittests")
+    config.addinivalue_line("markers", "completion: Run module completion unittests")
     config.addinivalue_line("markers", "config: Run config unittests")
+    config.addinivalue_line("markers", "document: Run text document buffer unittests")
     config.addinivalue_line("markers", "helpers: Run helper function unittests")
+    config.addinivalue_line("markers", "includes: Run include resolution unittests")
+    config.addinivalue_line("markers", "matcher: Run sample scanning unittests")
+    config.addinivalue_line("markers", "metrics: Run request metrics unittests")
+    config.addinivalue_line("markers", "parser: Run YARA tokenizer and parser unittests")
     config.addinivalue_line("markers", "protocol: Run language server protocol unittests")
     config.addinivalue_line("markers", "server: Run YARA-specific protocol unittests")
+    config.addinivalue_line("markers", "state: Run shared workspace state unittests")
+    config.addinivalue_line("markers", "symbols: Run workspace symbol index unittests")
     config.addinivalue_line("markers", "transport: Run network transport unittests")
+    config.addinivalue_line("markers", "workspace: Run workspace scanner unittests")
 
 @pytest.fixture
 def event_loop():
@@ -60,6 +72,22 @@ async def init_server(initialize_msg, initialized_msg):
         await yara_server.read_request(reader)
     return _init_server
 
+@pytest.fixture(scope="function")
+async def init_workspace(initialize_msg, initialized_msg):
+    ''' Start the given language server with the standard init sequence for a workspace folder
+
+    The client does not offer to watch files, so nothing but the handshake is sent back
+    '''
+    async def _init_workspace(reader, writer, yara_server, root):
+        initialize = json.loads(initialize_msg)
+        initialize["params"]["rootUri"] = root.as_uri()
+        del initialize["params"]["capabilities"]["workspace"]["didChangeWatchedFiles"]
+        await yara_server.write_data(json.dumps(initialize), writer)
+        await yara_server.read_request(reader)
+        await yara_server.write_data(initialized_msg, writer)
+        await yara_server.read_request(reader)
+    return _init_workspace
+
 @pytest.fixture(scope="function")
 def test_rules():
     ''' Resolve full path to the test YARA rules '''
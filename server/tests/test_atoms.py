@@ -0,0 +1,105 @@
+''' Tests for yarals.atoms module '''
+import pytest
+from yarals import atoms, protocol
+from yarals.parser import get_syntax_tree
+
+
+def _estimate(definition: str) -> atoms.StringAtoms:
+    ''' Estimate the atom of a single string definition '''
+    document = "rule Estimate {{ strings: $a = {} condition: $a }}".format(definition)
+    return atoms.estimate_atoms(get_syntax_tree(document).rules[0].strings[0])
+
+def _offset(document: str, diagnostic: protocol.Diagnostic) -> int:
+    ''' Convert the start of a diagnostic back into an offset '''
+    lines = document.split("\n")
+    return sum(len(line) + 1 for line in lines[:diagnostic.range.start.line]) + diagnostic.range.start.char
+
+@pytest.mark.atoms
+def test_atom_quality():
+    ''' Ensure atoms are rated the way YARA rates them '''
+    assert atoms.atom_quality(((0x4D, 0xFF), (0x5A, 0xFF), (0x90, 0xFF), (0x01, 0xFF))) == 251
+    assert atoms.atom_quality(((0x61, 0xFF),)) == 187
+    assert atoms.atom_quality(((0x12, 0xFF), (0x34, 0xFF), (0x01, 0xFF), (0x02, 0xFF))) == atoms.MAX_ATOM_QUALITY
+    # repeating a common byte is worse than anything else
+    assert atoms.atom_quality(((0x00, 0xFF),) * 4) == 175
+    assert atoms.atom_quality(((0x40, 0xF0), (0x5A, 0xFF))) < atoms.WARNING_QUALITY
+    assert atoms.atom_quality(()) == atoms.MAX_ATOM_QUALITY - 22 * atoms.MAX_ATOM_LENGTH
+
+@pytest.mark.atoms
+def test_text_atoms():
+    ''' Ensure the best window of a text string is picked, and the worst of its ascii and wide forms is reported '''
+    estimate = _estimate("\"\\x00\\x00\\x00MZ\\x90\\x00\"")
+    assert atoms.format_atom(estimate.atom) == "{ 00 4D 5A 90 }"
+    estimate = _estimate("\"ab\" ascii wide nocase")
+    assert atoms.format_atom(estimate.atom) == "{ 61 62 }"
+    # each form and every case combination of the letters is searched for
+    assert estimate.variants == 8
+    assert _estimate("\"a\\\"b\\\\\"").atom == ((0x61, 0xFF), (0x22, 0xFF), (0x62, 0xFF), (0x5C, 0xFF))
+    assert _estimate("\"abc\" base64") is None
+
+@pytest.mark.atoms
+def test_hex_atoms():
+    ''' Ensure jumps split hex strings and alternatives are only as good as the worst of them '''
+    assert atoms.format_atom(_estimate("{ 4D [2-4] 5A 90 ?? 1? // comment\n }").atom) == "{ 5A 90 ?? 1? }"
+    assert atoms.format_atom(_estimate("{ 01 ( 4D 5A 90 | 4D ) 02 }").atom) == "{ 01 }"
+    assert atoms.format_atom(_estimate("{ 01 ( 4D 5A 90 00 | 4D 5A 90 01 ) }").atom) == "{ 4D 5A 90 00 }"
+    assert _estimate("{ 4D 5A ZZ }") is None
+
+@pytest.mark.atoms
+def test_regex_atoms():
+    ''' Ensure only bytes every match has to contain are used '''
+    assert atoms.format_atom(_estimate("/ab?cd\\x90[ef]+/").atom) == "{ 63 64 90 }"
+    assert atoms.format_atom(_estimate("/ab{0,2}cd{1}e/").atom) == "{ 63 64 }"
+    assert atoms.format_atom(_estimate("/(abc|xyz)\\/de\\d/").atom) == "{ 2F 64 65 }"
+    assert atoms.format_atom(_estimate("/abcd|ef/").atom) == "{ 65 66 }"
+    estimate = _estimate("/xy/i")
+    assert estimate.variants == 4
+
+@pytest.mark.atoms
+def test_atom_diagnostics():
+    ''' Ensure slow strings are reported with their estimated atom at the string's value '''
+    document = "\n".join([
+        "rule Slow {",
+        "  strings:",
+        "    $good = \"MZ\\x90\\x00\\x03\"",
+        "    $short = \"a\"",
+        "    $weak = \"PK\"",
+        "    $regex = /.*evil.exe/",
+        "    $hex = { ?? 4D 5A 90 00 }",
+        "    $nocase = \"exe\" wide nocase",
+        "    $empty = /.+/",
+        "  condition:",
+        "    any of them",
+        "}"
+    ])
+    results = {
+        document[_offset(document, diag):].split()[0]: diag
+        for diag in atoms.atom_diagnostics(document)
+    }
+    assert sorted(results) == ["\"PK\"", "\"a\"", "\"exe\"", "/.*evil.exe/", "/.+/", "{"]
+    assert results["\"a\""].severity == protocol.DiagnosticSeverity.WARNING
+    assert results["\"a\""].message == "$short may slow down scanning. The best atom YARA can pick from it is { 61 } (quality 187 of 255)"
+    assert results["\"a\""].range.start.line == 3
+    assert results["\"a\""].range.start.char == 13
+    assert results["\"PK\""].severity == protocol.DiagnosticSeverity.HINT
+    assert results["/.*evil.exe/"].severity == protocol.DiagnosticSeverity.WARNING
+    assert "{ 65 76 69 6C }" in results["/.*evil.exe/"].message
+    assert results["{"].severity == protocol.DiagnosticSeverity.HINT
+    assert results["\"exe\""].message == "$nocase is a short wide nocase string, so YARA searches for 4 atoms like { 65 00 78 00 } (quality 233 of 255)"
+    assert results["/.+/"].message.startswith("$empty has no fixed bytes")
+
+@pytest.mark.atoms
+def test_compile_reports_atoms():
+    ''' Ensure slow strings are reported next to the compile results '''
+    pytest.importorskip("yara")
+    from yarals import compiler
+    diagnostics = compiler.compile_diagnostics("rule Slow { strings: $a = \"a\" condition: $a }")
+    assert [diag.severity for diag in diagnostics] == [protocol.DiagnosticSeverity.WARNING]
+
+@pytest.mark.atoms
+def test_compile_errors_skip_atoms():
+    ''' Ensure files that don't compile only report their errors '''
+    pytest.importorskip("yara")
+    from yarals import compiler
+    diagnostics = compiler.compile_diagnostics("rule Broken { strings: $a = \"a\" condition: $b }")
+    assert [diag.severity for diag in diagnostics] == [protocol.DiagnosticSeverity.ERROR]
@@ -0,0 +1,156 @@
+''' Tests for yarals.cache module '''
+import os
+
+import pytest
+from yarals import cache, protocol
+
+
+def _diagnostic(line: int, message: str) -> protocol.Diagnostic:
+    ''' Build a single-line error diagnostic '''
+    locrange = protocol.Range(start=protocol.Position(line, 0), end=protocol.Position(line, 10000))
+    return protocol.Diagnostic(locrange=locrange, severity=protocol.DiagnosticSeverity.ERROR, message=message)
+
+@pytest.mark.cache
+def test_hash_text():
+    ''' Ensure hashes change with both the text and the salt '''
+    assert cache.hash_text("rule A { condition: true }") == cache.hash_text("rule A { condition: true }")
+    assert cache.hash_text("rule A { condition: true }") != cache.hash_text("rule B { condition: true }")
+    assert cache.hash_text("rule A { condition: true }", salt="4.0.0") != cache.hash_text("rule A { condition: true }", salt="4.1.0")
+
+@pytest.mark.cache
+def test_lru_eviction():
+    ''' Ensure the least recently used entry is evicted when the cache is full '''
+    results = cache.DiagnosticCache(maxsize=2)
+    results.put("one", [])
+    results.put("two", [_diagnostic(1, "two")])
+    assert results.get("one") == []
+    results.put("three", [])
+    assert "one" in results
+    assert "two" not in results
+    assert results.get("two") is None
+    assert results.hits == 1
+    assert results.misses == 1
+
+@pytest.mark.cache
+def test_pinned_eviction():
+    ''' Ensure pinned entries are kept and don't count towards the size of the cache '''
+    results = cache.DiagnosticCache(maxsize=1)
+    results.pin("workspace", ["one"])
+    results.put("one", [])
+    results.pin("workspace", ["two"], replace=False)
+    results.put("two", [])
+    results.put("three", [])
+    results.put("four", [])
+    assert [key for key in ("one", "two", "three", "four") if key in results] == ["one", "two", "four"]
+    results.resize(0)
+    assert len(results) == 2
+    # entries that are no longer pinned are evicted like any other
+    results.pin("workspace", ["two"])
+    assert "one" not in results
+    results.pin("workspace", ())
+    assert len(results) == 0
+
+@pytest.mark.cache
+def test_pinned_keys_without_entries():
+    ''' Ensure keys pinned before anything is cached for them don't make room for more unpinned entries '''
+    results = cache.DiagnosticCache(maxsize=2)
+    results.pin("first", ["shared"] + ["missing{:d}".format(index) for index in range(100)])
+    results.pin("second", ["shared"])
+    results.put("shared", [])
+    for index in range(10):
+        results.put("unpinned{:d}".format(index), [])
+    assert len(results) == 3
+    assert "shared" in results
+    # the key stays pinned as long as any owner pins it
+    results.pin("first", ())
+    results.put("unpinned10", [])
+    assert "shared" in results
+    results.pin("second", ())
+    assert len(results) == 2
+    assert "shared" not in results
+
+@pytest.mark.cache
+def test_save_load(tmp_path):
+    ''' Ensure cached diagnostics survive a round trip to disk '''
+    path = tmp_path.joinpath(".yarals", "compile_cache.json")
+    results = cache.DiagnosticCache(path=path)
+    results.put("key", [_diagnostic(4, "undefined string \"$a\"")])
+    results.save()
+    loaded = cache.DiagnosticCache(path=path)
+    loaded.load()
+    diagnostics = loaded.get("key")
+    assert len(diagnostics) == 1
+    assert isinstance(diagnostics[0], protocol.Diagnostic) is True
+    assert diagnostics[0].range.start.line == 4
+    assert diagnostics[0].range.end.char == 10000
+    assert diagnostics[0].severity == protocol.DiagnosticSeverity.ERROR
+    assert diagnostics[0].message == "undefined string \"$a\""
+
+@pytest.mark.cache
+def test_load_corrupt(tmp_path):
+    ''' Ensure a corrupt cache file is ignored '''
+    path = tmp_path.joinpath("compile_cache.json")
+    path.write_text("{not json")
+    results = cache.DiagnosticCache(path=path)
+    results.load()
+    assert len(results) == 0
+
+@pytest.mark.cache
+def test_file_cache(tmp_path):
+    ''' Ensure files are only read again after they change, and recently modified files are not cached '''
+    rule_file = tmp_path.joinpath("rule.yar")
+    rule_file.write_text("rule A { condition: true }\n")
+    files = cache.FileCache(maxsize=1)
+    assert files.read(str(rule_file)) == "rule A { condition: true }\n"
+    # the file was just written, so its modification time can't be trusted yet
+    assert str(rule_file) not in files
+    stat = rule_file.stat()
+    os.utime(str(rule_file), ns=(stat.st_atime_ns, stat.st_mtime_ns - 60 * 10**9))
+    files.read(str(rule_file))
+    assert files.read(str(rule_file)) == "rule A { condition: true }\n"
+    assert files.hits == 1
+    rule_file.write_text("rule Longer { condition: true }\n")
+    assert files.read(str(rule_file)) == "rule Longer { condition: true }\n"
+    with pytest.raises(OSError):
+        files.read(str(tmp_path.joinpath("missing.yar")))
+
+@pytest.mark.cache
+def test_rules_store(tmp_path):
+    ''' Ensure compiled rules are loaded back, and unreadable artifacts are dropped '''
+    yara = pytest.importorskip("yara")
+    store = cache.RulesStore(tmp_path.joinpath("rules"))
+    assert store.get("missing") is None
+    assert store.misses == 1
+    store.put("key", yara.compile(source="rule Stored { condition: true }"))
+    assert "key" in store
+    assert [match.rule for match in store.get("key").match(data=b"")] == ["Stored"]
+    assert store.hits == 1
+    store.artifact("corrupt").write_bytes(b"not compiled rules")
+    assert store.get("corrupt") is None
+    assert "corrupt" not in store
+    store.clear()
+    assert "key" not in store
+    # nothing is saved without a folder
+    disabled = cache.RulesStore()
+    disabled.put("key", yara.compile(source="rule Stored { condition: true }"))
+    assert disabled.get("key") is None
+    assert disabled.misses == 0
+
+@pytest.mark.cache
+def test_rules_store_eviction(tmp_path):
+    ''' Ensure the least recently used artifacts are deleted once the store is full '''
+    yara = pytest.importorskip("yara")
+    rules = yara.compile(source="rule Stored { condition: true }")
+    store = cache.RulesStore(tmp_path)
+    store.put("size", rules)
+    size = store.artifact("size").stat().st_size
+    store.clear()
+    store.configure(tmp_path, max_bytes=size * 3)
+    for index, key in enumerate(("first", "second", "third")):
+        store.put(key, rules)
+        # make sure every artifact has a different modification time
+        os.utime(str(store.artifact(key)), ns=(index * 10**9, index * 10**9))
+    store.get("first")
+    store.put("fourth", rules)
+    # "second" was used the longest time ago, then "third"
+    assert [key in store for key in ("first", "second", "third", "fourth")] == [True, False, False, True]
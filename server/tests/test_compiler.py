@@ -0,0 +1,131 @@
+''' Tests for yarals.compiler module '''
+import pytest
+from yarals import compiler, protocol
+from yarals.cache import RulesStore
+
+
+@pytest.mark.compiler
+def test_compile_diagnostics():
+    ''' Ensure compilation errors are converted to diagnostics '''
+    document = "rule OneDiagnostic {\n condition:\n  $true\n}\n"
+    result = compiler.compile_diagnostics(document)
+    assert len(result) == 1
+    assert isinstance(result[0], protocol.Diagnostic) is True
+    assert result[0].severity == protocol.DiagnosticSeverity.ERROR
+    # YARA reports undefined strings at the end of the condition
+    assert result[0].range.start.line == 3
+    assert result[0].range.start.char == 0
+
+@pytest.mark.compiler
+def test_compile_file(test_rules):
+    ''' Ensure files are read from disk when no text is given '''
+    file_uri = test_rules.joinpath("simple_mistake.yar").as_uri()
+    result = compiler.compile_file(file_uri)
+    assert len(result) == 1
+    assert result[0].message == "undefined string \"$true\""
+
+@pytest.mark.asyncio
+@pytest.mark.compiler
+async def test_compile_all(test_rules):
+    ''' Ensure every file is compiled in the pool and unreadable files are skipped '''
+    engine = compiler.CompileEngine(max_workers=2)
+    files = {
+        test_rules.joinpath("simple_mistake.yar").as_uri(): None,
+        test_rules.joinpath("missing.yar").as_uri(): None,
+        "file:///unsaved.yara": "rule Unsaved { condition: true }"
+    }
+    try:
+        results = {}
+        async for file_uri, diagnostics in engine.compile_all(files):
+            results[file_uri] = diagnostics
+    finally:
+        engine.shutdown()
+    assert len(results) == 2
+    assert results["file:///unsaved.yara"] == []
+    assert len(results[test_rules.joinpath("simple_mistake.yar").as_uri()]) == 1
+
+@pytest.mark.asyncio
+@pytest.mark.compiler
+async def test_compile_cached():
+    ''' Ensure identical text is only compiled once '''
+    engine = compiler.CompileEngine()
+    document = "rule Cached { condition: $a }"
+    first = await engine.compile(document)
+    second = await engine.compile(document)
+    assert len(first) == len(second) == 1
+    assert engine.cache.misses == 1
+    assert engine.cache.hits == 1
+    assert compiler.get_cache_key(document) in engine.cache
+
+@pytest.mark.asyncio
+@pytest.mark.compiler
+async def test_compile_all_known_keys(tmp_path):
+    ''' Ensure files with a known, cached hash are not read and new hashes are reported '''
+    engine = compiler.CompileEngine(max_workers=1)
+    document = "rule Known { condition: $a }"
+    key = compiler.get_cache_key(document)
+    engine.cache.put(key, [])
+    rule_file = tmp_path.joinpath("known.yar")
+    rule_file.write_text("rule Changed { condition: true }")
+    # the file doesn't exist, so a result means it was answered from the cache
+    keys = {tmp_path.joinpath("gone.yar").as_uri(): key}
+    files = {tmp_path.joinpath("gone.yar").as_uri(): None, rule_file.as_uri(): None}
+    try:
+        results = {file_uri: diagnostics async for file_uri, diagnostics in engine.compile_all(files, keys=keys)}
+    finally:
+        engine.shutdown()
+    assert results == {tmp_path.joinpath("gone.yar").as_uri(): [], rule_file.as_uri(): []}
+    assert keys[rule_file.as_uri()] == compiler.get_cache_key(rule_file.read_text())
+
+@pytest.mark.compiler
+def test_compile_includes(tmp_path):
+    ''' Ensure includes are answered from the given sources and their errors point at the include statement '''
+    file_uri = tmp_path.joinpath("main.yar").as_uri()
+    document = "import \"pe\"\ninclude \"common.yar\"\nrule Main { condition: Common }\n"
+    sources = {tmp_path.joinpath("common.yar").as_uri(): "rule Common { condition: true }\n"}
+    assert compiler.compile_diagnostics(document, file_uri, sources) == []
+    sources = {tmp_path.joinpath("common.yar").as_uri(): "rule Common {\n condition: $missing\n}\n"}
+    result = compiler.compile_diagnostics(document, file_uri, sources)
+    assert len(result) == 1
+    assert result[0].range.start.line == 1
+    assert result[0].message == "undefined string \"$missing\" (common.yar line 3)"
+    # includes are never read from the server's working directory
+    result = compiler.compile_diagnostics(document)
+    assert result[0].range.start.line == 1
+    assert result[0].message == "can't open include file: common.yar"
+
+@pytest.mark.compiler
+def test_cache_key_includes():
+    ''' Ensure the text of included files is part of the cache key '''
+    document = "include \"common.yar\"\n"
+    first = compiler.get_cache_key(document, {"file:///common.yar": "rule A { condition: true }"})
+    second = compiler.get_cache_key(document, {"file:///common.yar": "rule B { condition: true }"})
+    assert len({compiler.get_cache_key(document), first, second}) == 3
+
+@pytest.mark.asyncio
+@pytest.mark.compiler
+async def test_compile_saves_rules(tmp_path):
+    ''' Ensure files that compile are saved to the rules store under their namespace, and files with errors are not '''
+    engine = compiler.CompileEngine(max_workers=1, rules=RulesStore(tmp_path))
+    file_uri = tmp_path.joinpath("saved.yar").as_uri()
+    document = "rule Saved { condition: true }"
+    # compiling as the user types doesn't save anything
+    assert await engine.compile(document, file_uri) == []
+    assert compiler.get_rules_key(compiler.get_cache_key(document), file_uri) not in engine.rules
+    # saving the same text does, even though its diagnostics are cached
+    assert await engine.compile(document, file_uri, store_rules=True) == []
+    assert engine.cache.hits == 1
+    rules = engine.rules.get(compiler.get_rules_key(compiler.get_cache_key(document), file_uri))
+    assert [(match.namespace, match.rule) for match in rules.match(data=b"")] == [(file_uri, "Saved")]
+    broken = "rule Broken { condition: $a }"
+    await engine.compile(broken, file_uri, store_rules=True)
+    assert compiler.get_rules_key(compiler.get_cache_key(broken), file_uri) not in engine.rules
+    # files compiled by the worker processes are saved too
+    rule_file = tmp_path.joinpath("worker.yar")
+    rule_file.write_text("rule Worker { condition: true }")
+    try:
+        results = [result async for result in engine.compile_all({rule_file.as_uri(): None})]
+    finally:
+        engine.shutdown()
+    assert results == [(rule_file.as_uri(), [])]
+    assert compiler.get_rules_key(compiler.get_cache_key(rule_file.read_text()), rule_file.as_uri()) in engine.rules
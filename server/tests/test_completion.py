@@ -0,0 +1,52 @@
+''' Tests for yarals.completion module '''
+import json
+
+import pytest
+from yarals import protocol
+from yarals.completion import CompletionTable
+
+
+SCHEMA = {
+    "pe": {
+        "DLL": "enum",
+        "data_directories": {
+            "size": "property",
+            "virtual_address": "property"
+        },
+        "dll_characteristics": "property",
+        "exports": "method"
+    }
+}
+
+
+@pytest.mark.completion
+def test_table_paths():
+    ''' Ensure every module and nested structure gets an entry keyed by its dotted path '''
+    table = CompletionTable(SCHEMA)
+    assert len(table) == 2
+    assert "pe" in table
+    assert "pe.data_directories" in table
+    assert "pe.exports" not in table
+
+@pytest.mark.completion
+def test_table_items():
+    ''' Ensure the full list keeps the schema order and item kinds '''
+    table = CompletionTable(SCHEMA)
+    items = json.loads(table.get("pe").data)
+    assert items == [
+        {"label": "DLL", "kind": protocol.CompletionItemKind.ENUM},
+        {"label": "data_directories", "kind": protocol.CompletionItemKind.CLASS},
+        {"label": "dll_characteristics", "kind": protocol.CompletionItemKind.PROPERTY},
+        {"label": "exports", "kind": protocol.CompletionItemKind.METHOD}
+    ]
+    assert [item["label"] for item in json.loads(table.get("pe.data_directories").data)] == ["size", "virtual_address"]
+
+@pytest.mark.completion
+def test_table_prefix():
+    ''' Ensure a partially typed member only returns the members it could complete to, ignoring case '''
+    table = CompletionTable(SCHEMA)
+    assert [item["label"] for item in json.loads(table.get("pe.d").data)] == ["data_directories", "DLL", "dll_characteristics"]
+    assert [item["label"] for item in json.loads(table.get("pe.dll_").data)] == ["dll_characteristics"]
+    assert json.loads(table.get("pe.x").data) == []
+    assert table.get("elf") is None
+    assert table.get("elf.x") is None
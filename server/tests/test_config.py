@@ -56,10 +56,41 @@ async def test_compile_on_save_true(caplog, init_server, open_streams, test_rule
         await yara_server.write_data(change_config_msg, writer)
         await yara_server.write_data(save_file_msg, writer)
         response = await yara_server.read_request(reader)
-        diagnostics = response["params"]["diagnostics"]
+        # the slow hex string in the file is only hinted at
+        diagnostics = [diag for diag in response["params"]["diagnostics"] if diag["severity"] != protocol.DiagnosticSeverity.HINT]
         assert len(diagnostics) == 1
         assert diagnostics[0]["message"] == expected_msg
         assert diagnostics[0]["severity"] == expected_sev
         assert ("yara", logging.DEBUG, "Changed workspace config to {}".format(json.dumps(new_config))) in caplog.record_tuples
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.config
+async def test_compile_on_type(init_server, open_streams, yara_server):
+    ''' Ensure a burst of changes only publishes diagnostics once, for the latest version '''
+    new_config = {"compile_on_type": True, "compile_on_type_delay": 50}
+    file_uri = "file:///unsaved.yara"
+    change_config_msg = json.dumps({
+        "jsonrpc":"2.0", "method": "workspace/didChangeConfiguration",
+        "params": {"settings": {"yara": new_config}}
+    })
+    did_open_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didOpen",
+        "params": {"textDocument": {"uri": file_uri, "languageId": "yara", "version": 1, "text": ""}}
+    })
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(change_config_msg, writer)
+    await yara_server.write_data(did_open_msg, writer)
+    for version, text in enumerate(["rule A { condition: $a }", "rule A { condition: true }"], start=2):
+        did_change_msg = json.dumps({
+            "jsonrpc": "2.0", "method": "textDocument/didChange",
+            "params": {"textDocument": {"uri": file_uri, "version": version}, "contentChanges": [{"text": text}]}
+        })
+        await yara_server.write_data(did_change_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response["method"] == "textDocument/publishDiagnostics"
+    assert response["params"] == {"uri": file_uri, "diagnostics": []}
+    writer.close()
+    await writer.wait_closed()
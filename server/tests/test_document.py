@@ -0,0 +1,82 @@
+''' Tests for yarals.document module '''
+import pytest
+from yarals import document, protocol
+
+
+@pytest.mark.document
+def test_split_lines():
+    ''' Ensure all protocol line terminators are recognized and kept '''
+    lines = document.split_lines("one\ntwo\r\nthree\rfour\n")
+    assert lines == ["one\n", "two\r\n", "three\r", "four\n", ""]
+
+@pytest.mark.document
+def test_full_change():
+    ''' Ensure a change without a range replaces the whole document '''
+    doc = document.TextDocument("file:///test.yara", "rule One { condition: true }", version=1)
+    doc.apply_changes([{"text": "rule Two { condition: false }\n"}], version=2)
+    assert doc.text == "rule Two { condition: false }\n"
+    assert doc.line_count == 2
+    assert doc.version == 2
+
+@pytest.mark.document
+def test_incremental_insert():
+    ''' Ensure text is inserted at a position on a single line '''
+    doc = document.TextDocument("file:///test.yara", "rule One {\n condition:\n  true\n}\n")
+    change = {"range": {"start": {"line": 0, "character": 8}, "end": {"line": 0, "character": 8}}, "text": "Two"}
+    doc.apply_change(change)
+    assert doc.text == "rule OneTwo {\n condition:\n  true\n}\n"
+    assert doc.line_count == 5
+
+@pytest.mark.document
+def test_incremental_multiline():
+    ''' Ensure edits spanning several lines add and remove lines appropriately '''
+    doc = document.TextDocument("file:///test.yara", "rule One {\r\n condition:\r\n  true\r\n}\r\n")
+    delete = {"range": {"start": {"line": 1, "character": 0}, "end": {"line": 3, "character": 0}}, "text": ""}
+    doc.apply_change(delete)
+    assert doc.text == "rule One {\r\n}\r\n"
+    insert = {"range": {"start": {"line": 0, "character": 10}, "end": {"line": 0, "character": 10}}, "text": "\r\n strings:\r\n  $a = \"a\""}
+    doc.apply_change(insert)
+    assert doc.text == "rule One {\r\n strings:\r\n  $a = \"a\"\r\n}\r\n"
+    assert doc.line_count == 5
+
+@pytest.mark.document
+def test_incremental_out_of_bounds():
+    ''' Ensure positions past the end of a line or document are clamped '''
+    doc = document.TextDocument("file:///test.yara", "one\ntwo")
+    change = {"range": {"start": {"line": 0, "character": 50}, "end": {"line": 10, "character": 0}}, "text": "!"}
+    doc.apply_change(change)
+    assert doc.text == "one!"
+    assert str(doc) == doc.text
+
+@pytest.mark.document
+def test_line_index_get_line():
+    ''' Ensure lines are returned without their terminators '''
+    index = document.LineIndex("one\r\ntwo\nthree")
+    assert index.line_count == 3
+    assert index.get_line(0) == "one"
+    assert index.get_line(1) == "two"
+    assert index.get_line(2) == "three"
+    with pytest.raises(IndexError):
+        index.get_line(3)
+
+@pytest.mark.document
+def test_line_index_conversions():
+    ''' Ensure offsets and positions convert back and forth '''
+    text = "rule One {\r\n condition:\n  true\n}\n"
+    index = document.LineIndex(text)
+    pos = index.position_at(text.index("true"))
+    assert pos.line == 2
+    assert pos.char == 2
+    assert index.offset_at(pos) == text.index("true")
+    # characters past the end of a line are clamped to the line length
+    assert index.offset_at(protocol.Position(line=0, char=100)) == len("rule One {")
+
+@pytest.mark.document
+def test_line_index_cached():
+    ''' Ensure each version of a buffer shares one line index '''
+    doc = document.TextDocument("file:///test.yara", "rule One {\n condition:\n  true\n}\n")
+    assert doc.index is doc.index
+    old_index = doc.index
+    doc.apply_change({"range": {"start": {"line": 2, "character": 2}, "end": {"line": 2, "character": 6}}, "text": "false"})
+    assert doc.index is not old_index
+    assert doc.index.get_line(2) == "  false"
@@ -0,0 +1,80 @@
+''' Tests for yarals.includes module '''
+import pytest
+from yarals import compiler
+from yarals import includes
+from yarals.parser import get_syntax_tree
+
+
+def _make_tree(root):
+    ''' Create a rule file including a file that includes another '''
+    root.joinpath("sub").mkdir()
+    root.joinpath("main.yar").write_text("include \"sub/common.yar\"\nrule Main { condition: Common }\n")
+    root.joinpath("sub", "common.yar").write_text("include \"base.yar\"\nrule Common { condition: Base }\n")
+    root.joinpath("sub", "base.yar").write_text("rule Base { condition: true }\n")
+
+
+@pytest.mark.includes
+def test_resolve_include(tmp_path):
+    ''' Ensure include paths are resolved against the folder of the including file '''
+    file_uri = tmp_path.joinpath("sub", "main.yar").as_uri()
+    assert includes.resolve_include(file_uri, "common.yar") == tmp_path.joinpath("sub", "common.yar").as_uri()
+    assert includes.resolve_include(file_uri, "../base.yar") == tmp_path.joinpath("base.yar").as_uri()
+    assert includes.resolve_include(file_uri, str(tmp_path.joinpath("abs.yar"))) == tmp_path.joinpath("abs.yar").as_uri()
+    # unsaved documents have no folder to resolve against
+    assert includes.resolve_include("untitled:Untitled-1", "common.yar") is None
+
+@pytest.mark.includes
+def test_load_includes(tmp_path):
+    ''' Ensure nested includes are read once each, preferring the given reader's text '''
+    _make_tree(tmp_path)
+    main = tmp_path.joinpath("main.yar")
+    common_uri = tmp_path.joinpath("sub", "common.yar").as_uri()
+    base_uri = tmp_path.joinpath("sub", "base.yar").as_uri()
+    sources = includes.load_includes(main.as_uri(), main.read_text(), compiler.read_file)
+    assert list(sources) == [common_uri, base_uri]
+    assert sources[base_uri] == "rule Base { condition: true }\n"
+    # files that can't be read are left out
+    tmp_path.joinpath("sub", "base.yar").unlink()
+    assert list(includes.load_includes(main.as_uri(), main.read_text(), compiler.read_file)) == [common_uri]
+
+@pytest.mark.includes
+def test_find_includes_skips_parsing(tmp_path):
+    ''' Ensure documents that can't include anything are not parsed to find their includes '''
+    file_uri = tmp_path.joinpath("main.yar").as_uri()
+    document = "rule NoIncludes { condition: true }\n"
+    before = get_syntax_tree.cache_info()
+    assert includes.find_includes(file_uri, document) == []
+    assert includes.load_includes(file_uri, document, compiler.read_file) == {}
+    assert get_syntax_tree.cache_info() == before
+    assert includes.find_includes(file_uri, "include \"common.yar\"\n" + document) == [tmp_path.joinpath("common.yar").as_uri()]
+
+@pytest.mark.includes
+def test_include_callback():
+    ''' Ensure nested includes resolve against the file including them, and errors trace back to the document '''
+    sources = {
+        "file:///rules/sub/common.yar": "include \"base.yar\"",
+        "file:///rules/sub/base.yar": "rule Base { condition: true }"
+    }
+    callback = includes.IncludeCallback("file:///rules/main.yar", sources)
+    assert callback("sub/common.yar", None, "default") == sources["file:///rules/sub/common.yar"]
+    assert callback("base.yar", "sub/common.yar", "default") == sources["file:///rules/sub/base.yar"]
+    assert callback("missing.yar", None, "default") is None
+    assert callback.origin("base.yar") == "sub/common.yar"
+    assert callback.origin("sub/common.yar") == "sub/common.yar"
+    assert callback.origin("unknown.yar") is None
+
+@pytest.mark.includes
+def test_dependency_graph():
+    ''' Ensure transitive dependents and dependencies are found, even with cycles '''
+    graph = includes.DependencyGraph()
+    graph.update("main", ["common"])
+    graph.update("other", ["common"])
+    graph.update("common", ["base"])
+    graph.update("base", ["common"])
+    assert sorted(graph.dependents("base")) == ["common", "main", "other"]
+    assert graph.dependencies("main") == ["common", "base"]
+    assert graph.includes("other") == ("common",)
+    graph.update("other", [])
+    graph.remove("main")
+    assert "main" not in graph
+    assert graph.dependents("common") == ["base"]
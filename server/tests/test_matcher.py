@@ -0,0 +1,82 @@
+''' Tests for yarals.matcher module '''
+import pytest
+from yarals import compiler, matcher
+from yarals.cache import RulesStore
+
+
+@pytest.mark.matcher
+def test_compile_rules(tmp_path):
+    ''' Ensure every file gets its own namespace and its includes are resolved against its folder '''
+    tmp_path.joinpath("common.yar").write_text("rule Common { strings: $a = \"common\" condition: $a }\n")
+    main_uri = tmp_path.joinpath("main.yar").as_uri()
+    other_uri = tmp_path.joinpath("other.yar").as_uri()
+    tmp_path.joinpath("other.yar").write_text("rule Main { condition: false }\n")
+    documents = {main_uri: "include \"common.yar\"\nrule Main { condition: Common }\n", other_uri: None}
+    rules = matcher.compile_rules(documents)
+    matches = rules.match(data=b"common")
+    assert sorted((match.namespace, match.rule) for match in matches) == [(main_uri, "Common"), (main_uri, "Main")]
+    # open documents are compiled instead of what is on disk
+    rules = matcher.compile_rules({other_uri: None}, overlay={other_uri: "rule Other { condition: true }\n"})
+    assert [match.rule for match in rules.match(data=b"")] == ["Other"]
+
+@pytest.mark.matcher
+def test_scan_file(tmp_path):
+    ''' Ensure matched strings, empty files and missing files are all reported with their scan time '''
+    rules = matcher.compile_rules({"file:///rules/a.yar": "rule A : tag { meta: author = \"me\" strings: $a = \"abc\" condition: $a or filesize == 0 }"})
+    sample = tmp_path.joinpath("sample.bin")
+    sample.write_bytes(b"xxabcxxabc")
+    result = matcher.scan_file(rules, sample)
+    assert result["uri"] == sample.as_uri()
+    assert result["time_ms"] >= 0
+    assert result["matches"] == [{
+        "rule": "A", "namespace": "file:///rules/a.yar", "tags": ["tag"], "meta": {"author": "me"},
+        "strings": [{"identifier": "$a", "offset": 2, "length": 3}, {"identifier": "$a", "offset": 7, "length": 3}]
+    }]
+    empty = tmp_path.joinpath("empty.bin")
+    empty.write_bytes(b"")
+    assert [match["rule"] for match in matcher.scan_file(rules, empty)["matches"]] == ["A"]
+    missing = matcher.scan_file(rules, tmp_path.joinpath("missing.bin"))
+    assert missing["matches"] == []
+    assert "error" in missing
+
+@pytest.mark.matcher
+def test_iter_samples(tmp_path):
+    ''' Ensure files in subfolders are found '''
+    tmp_path.joinpath("sub").mkdir()
+    tmp_path.joinpath("one.bin").write_bytes(b"1")
+    tmp_path.joinpath("sub", "two.bin").write_bytes(b"2")
+    assert sorted(path.name for path in matcher.iter_samples(tmp_path)) == ["one.bin", "two.bin"]
+
+@pytest.mark.asyncio
+@pytest.mark.matcher
+async def test_scan_all(tmp_path):
+    ''' Ensure every file is scanned on the pool and timed '''
+    engine = matcher.MatchEngine(max_workers=2)
+    rules = await engine.compile({"file:///rules/a.yar": "rule A { strings: $a = \"abc\" condition: $a }"})
+    paths = []
+    for index in range(10):
+        paths.append(tmp_path.joinpath("{:d}.bin".format(index)))
+        paths[-1].write_bytes(b"abc" if index % 2 else b"xyz")
+    results = [result async for result in engine.scan_all(rules, paths)]
+    assert sorted(result["uri"] for result in results) == sorted(path.as_uri() for path in paths)
+    assert sum(1 for result in results if result["matches"]) == 5
+    assert len(engine.scan_times) == 10
+    engine.shutdown()
+
+@pytest.mark.asyncio
+@pytest.mark.matcher
+async def test_compile_stored(tmp_path):
+    ''' Ensure rules saved after compiling for their diagnostics are loaded instead of compiled again '''
+    engine = compiler.CompileEngine(rules=RulesStore(tmp_path))
+    file_uri = tmp_path.joinpath("stored.yar").as_uri()
+    document = "rule Stored { condition: true }"
+    await engine.compile(document, file_uri, store_rules=True)
+    rules = matcher.compile_rules({file_uri: document}, store=engine.rules)
+    assert engine.rules.hits == 1
+    assert [(match.namespace, match.rule) for match in rules.match(data=b"")] == [(file_uri, "Stored")]
+    # sets of many files are saved as a whole
+    documents = {file_uri: document, tmp_path.joinpath("other.yar").as_uri(): "rule Other { condition: true }"}
+    matcher.compile_rules(documents, store=engine.rules)
+    assert engine.rules.misses == 1
+    matcher.compile_rules(dict(reversed(list(documents.items()))), store=engine.rules)
+    assert engine.rules.hits == 2
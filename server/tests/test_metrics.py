@@ -0,0 +1,52 @@
+''' Tests for yarals.metrics module '''
+import pytest
+from yarals import metrics
+
+
+@pytest.mark.metrics
+def test_histogram_percentiles():
+    ''' Ensure percentiles are estimated from bucket bounds, capped at the largest duration '''
+    histogram = metrics.Histogram()
+    for millis in [0.05] * 50 + [3] * 49 + [40]:
+        histogram.record(millis)
+    assert len(histogram) == 100
+    assert histogram.percentile(0.5) == 0.1
+    assert histogram.percentile(0.99) == 5
+    assert histogram.percentile(1) == 40
+    result = histogram.to_dict()
+    assert result["max_ms"] == 40
+    assert result["buckets"] == {"0.1": 50, "5": 49, "50": 1}
+
+@pytest.mark.metrics
+def test_empty_histogram():
+    ''' Ensure an empty histogram reports zeros instead of failing '''
+    result = metrics.Histogram().to_dict()
+    assert result["count"] == 0
+    assert result["p99_ms"] == 0
+    assert result["buckets"] == {}
+
+@pytest.mark.metrics
+def test_method_counters():
+    ''' Ensure calls, errors, cancellations and traffic are counted per method '''
+    stats = metrics.Metrics()
+    stats.record("textDocument/hover", 0.002)
+    stats.record("textDocument/hover", 0.004)
+    stats.error("textDocument/hover")
+    stats.cancelled("textDocument/references")
+    stats.received(100)
+    stats.sent(250)
+    result = stats.to_dict()
+    assert result["methods"]["textDocument/hover"]["calls"] == 2
+    assert result["methods"]["textDocument/hover"]["errors"] == 1
+    assert result["methods"]["textDocument/references"]["cancelled"] == 1
+    assert (result["bytes_in"], result["bytes_out"]) == (100, 250)
+    assert stats.calls == 2
+    summary = stats.summary()
+    assert "textDocument/hover x2" in summary
+    assert "slowest p99: textDocument/hover 4 ms" in summary
+
+@pytest.mark.metrics
+def test_hit_rate():
+    ''' Ensure hit rates are left out until there has been a lookup '''
+    assert metrics.hit_rate(0, 0)["hit_rate"] is None
+    assert metrics.hit_rate(3, 1)["hit_rate"] == 0.75
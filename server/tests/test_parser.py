@@ -0,0 +1,168 @@
+''' Tests for yarals.parser module '''
+import pytest
+from yarals import parser
+from yarals.parser import TokenKind
+
+
+RULES = (
+    "import \"pe\"\n"
+    "include \"other.yar\"\n"
+    "private global rule First : tag1 tag2 {\n"
+    "    meta:\n"
+    "        author = \"Test\"\n"
+    "        score = -5\n"
+    "    strings:\n"
+    "        $text = \"a } b\" xor(0x01-0xff) wide\n"
+    "        $hex = { AA [2-4] // comment\n"
+    "                 BB }\n"
+    "        $re = /a\\/b/is\n"
+    "    condition:\n"
+    "        #text > 2 and @hex[1] != !re and pe.sections[0].name == \"x\"\n"
+    "}\n"
+    "rule Second {\n"
+    "    condition:\n"
+    "        First and /* First */ true\n"
+    "}\n"
+)
+
+
+@pytest.mark.parser
+def test_tokenize():
+    ''' Ensure comments are skipped and string forms, operators and literals are told apart '''
+    tokens, unterminated = parser.tokenize("$a = /x\\// // note\n!a != #a /* skip */ @b")
+    assert [(token.kind, token.value) for token in tokens] == [
+        (TokenKind.STRING_ID, "$a"),
+        (TokenKind.OPERATOR, "="),
+        (TokenKind.REGEX, "/x\\//"),
+        (TokenKind.STRING_LENGTH, "!a"),
+        (TokenKind.OPERATOR, "!="),
+        (TokenKind.STRING_COUNT, "#a"),
+        (TokenKind.STRING_OFFSET, "@b")
+    ]
+    assert unterminated is False
+    _, unterminated = parser.tokenize("rule A { /* condition: true }")
+    assert unterminated is True
+
+@pytest.mark.parser
+def test_parse_rules():
+    ''' Ensure imports, modifiers, tags, meta, strings and conditions become nodes '''
+    tree = parser.SyntaxTree(RULES)
+    assert [node.module for node in tree.imports] == ["pe"]
+    assert [node.module for node in tree.includes] == ["other.yar"]
+    first, second = tree.rules
+    assert first.name == "First"
+    assert [token.value for token in first.modifiers] == ["private", "global"]
+    assert [token.value for token in first.tags] == ["tag1", "tag2"]
+    assert [(meta.key.value, meta.value.value) for meta in first.meta] == [("author", "\"Test\""), ("score", "-5")]
+    assert [string.name for string in first.strings] == ["text", "hex", "re"]
+    text = first.strings[0]
+    assert RULES[text.value.start:text.end] == "\"a } b\" xor(0x01-0xff) wide"
+    assert [token.value for token in text.modifiers] == ["xor", "wide"]
+    assert first.strings[1].value.kind == TokenKind.HEX
+    assert [token.name for token in first.iter_string_refs()] == ["text", "hex", "re"]
+    assert RULES[first.start:first.end].endswith("\"x\"\n}")
+    assert second.name == "Second"
+    assert [token.value for token in second.condition] == ["First", "and", "true"]
+
+@pytest.mark.parser
+def test_unclosed_rule():
+    ''' Ensure a rule missing its closing brace ends where the next rule starts '''
+    tree = parser.SyntaxTree("rule A {\n condition:\n  B and\nrule B { condition: true }\n")
+    first, second = tree.rules
+    assert [token.value for token in first.condition] == ["B", "and"]
+    assert second.name == "B"
+    assert tree.rule_at(first.end + 1).name == "B"
+
+@pytest.mark.parser
+def test_block_comment_across_rules():
+    ''' Ensure a block comment hiding a rule declaration is respected '''
+    tree = parser.SyntaxTree("rule A { condition: true }\n/*\nrule Hidden { condition: true }\n*/\nrule C { condition: A }\n")
+    assert [rule.name for rule in tree.rules] == ["A", "C"]
+
+@pytest.mark.parser
+def test_rule_references():
+    ''' Ensure rule names are found in declarations and conditions, but not comments or module members '''
+    tree = parser.SyntaxTree(RULES + "rule Third { condition: pe.First and First }\n")
+    offsets = [token.start for token in tree.iter_rule_refs("First")]
+    assert len(offsets) == 3
+    assert all(RULES[offset:offset+5] == "First" for offset in offsets[:2])
+    assert [rule.name for rule in tree.find_rules("Second")] == ["Second"]
+
+@pytest.mark.parser
+def test_dotted_name():
+    ''' Ensure module paths skip index expressions and stop at a trailing dot '''
+    text = "rule A { condition: pe.sections[0].na and cuckoo.network. }"
+    tree = parser.SyntaxTree(text)
+    assert tree.dotted_name_at(text.index(".na") + 3) == "pe.sections.na"
+    assert tree.dotted_name_at(text.index("network.") + 8) == "cuckoo.network"
+    assert tree.dotted_name_at(text.index("{")) == ""
+
+@pytest.mark.parser
+def test_chunks_reused():
+    ''' Ensure rules that did not change are not parsed again after an edit '''
+    text = "import \"pe\"\nrule A { condition: true }\nrule B { condition: false }\n"
+    before = parser.get_syntax_tree(text)
+    after = parser.get_syntax_tree(text.replace("false", "A"))
+    assert before is not after
+    assert before._chunks[1] is after._chunks[1]
+    assert before._chunks[2] is not after._chunks[2]
+    assert parser.get_syntax_tree(text) is before
+
+@pytest.mark.parser
+def test_chunks_reused_large_document():
+    ''' Ensure an edit to a document with more rules than any fixed-size cache would hold only parses what changed '''
+    text = "".join("rule R{:d} {{ condition: true }}\n".format(index) for index in range(20000))
+    before = parser.SyntaxTree(text)
+    misses = parser.CHUNK_CACHE.misses
+    after = parser.SyntaxTree(text.replace("rule R100 { condition: true }", "rule R100 { condition: false }"))
+    assert parser.CHUNK_CACHE.misses == misses + 1
+    assert before._chunks[-1] is after._chunks[-1]
+    assert before._chunks[100] is not after._chunks[100]
+
+@pytest.mark.parser
+def test_uncached_trees():
+    ''' Ensure parsing many files without the cache keeps the pieces of the document being edited '''
+    text = "rule Edited { condition: true }\nrule Kept { condition: false }\n"
+    parser.get_syntax_tree(text)
+    trees = len(parser.CHUNK_CACHE)
+    for index in range(parser.CHUNK_CACHE.maxtrees * 2):
+        parser.SyntaxTree("rule Other{:d} {{ condition: true }}\n".format(index), cache=False)
+    assert len(parser.CHUNK_CACHE) == trees
+    misses = parser.CHUNK_CACHE.misses
+    parser.get_syntax_tree(text.replace("true", "Kept"))
+    assert parser.CHUNK_CACHE.misses == misses + 1
+
+@pytest.mark.parser
+def test_string_table():
+    ''' Ensure string definitions and every form of usage are indexed by name '''
+    table = parser.SyntaxTree(RULES).rules[0].string_table
+    assert len(table) == 3
+    assert [string.name for string in table.find_definitions("text")] == ["text"]
+    assert [token.value for token in table.find_references("text")] == ["$text", "#text"]
+    assert [token.value for token in table.find_references("re")] == ["$re", "!re"]
+    assert [string.name for string in table.find_definitions("te*")] == ["text"]
+    assert table.find_references("missing") == []
+
+@pytest.mark.parser
+def test_string_lookup_offsets():
+    ''' Ensure string lookups return document offsets in later rules '''
+    text = RULES + "rule Third {\n strings:\n  $text = \"t\"\n condition:\n  $text\n}\n"
+    tree = parser.SyntaxTree(text)
+    first = [text[token.start:token.end] for token in tree.string_references(RULES.index("#text"), "text")]
+    assert first == ["$text", "#text"]
+    offset = len(RULES) + 20
+    refs = tree.string_references(offset, "text")
+    assert [text[token.start:token.end] for token in refs] == ["$text", "$text"]
+    assert all(token.start > len(RULES) for token in refs)
+    assert [text[string.start:string.end] for string in tree.string_definitions(offset, "text")] == ["$text = \"t\""]
+    assert tree.string_definitions(len(text), "text") == []
+
+@pytest.mark.parser
+def test_string_table_reused():
+    ''' Ensure editing one rule leaves the string tables of the others alone '''
+    text = "rule A {\n strings:\n  $a = \"a\"\n condition:\n  $a\n}\nrule B {\n strings:\n  $b = \"b\"\n condition:\n  $b\n}\n"
+    before = parser.get_syntax_tree(text)
+    first = before._chunks[0].rules[0].string_table
+    after = parser.get_syntax_tree(text.replace("\"b\"", "\"c\""))
+    assert after._chunks[0].rules[0].string_table is first
+    assert after._chunks[1].rules[0].string_table is not before._chunks[1].rules[0].string_table
@@ -64,3 +64,50 @@ def test_range():
         end=pos
     )
     assert json.dumps(rg_obj, cls=protocol.JSONEncoder) == json.dumps(rg_dict)
+
+@pytest.mark.protocol
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_loads(monkeypatch, use_orjson):
+    ''' Ensure messages round trip through both the orjson and the stdlib backends '''
+    if use_orjson and not protocol.HAS_ORJSON:
+        pytest.skip("orjson is not installed")
+    monkeypatch.setattr(protocol, "HAS_ORJSON", use_orjson)
+    pos = protocol.Position(line=1, char=2)
+    loc = protocol.Location(locrange=protocol.Range(start=pos, end=pos), uri="file:///règle.yara")
+    message = {"jsonrpc": "2.0", "id": 1, "result": [loc]}
+    data = protocol.dumps(message)
+    assert isinstance(data, bytes) is True
+    assert protocol.loads(data) == json.loads(json.dumps(message, cls=protocol.JSONEncoder))
+
+@pytest.mark.protocol
+def test_unknown_object():
+    ''' Ensure objects the encoder does not know about are rejected instead of encoded as null '''
+    with pytest.raises(TypeError):
+        protocol.dumps({"result": object()})
+
+@pytest.mark.protocol
+def test_to_dict():
+    ''' Ensure to_dict() matches the encoder output and nests no protocol objects '''
+    pos = protocol.Position(line=3, char=4)
+    rg_obj = protocol.Range(start=pos, end=pos)
+    edit = protocol.WorkspaceEdit("file:///one.yara", [protocol.TextEdit(rg_obj, "new_name")])
+    hover = protocol.Hover(protocol.MarkupContent(protocol.MarkupKind.Markdown, "text"), rg_obj)
+    for obj in (rg_obj, edit, hover):
+        assert json.dumps(obj.to_dict()) == json.dumps(obj, cls=protocol.JSONEncoder)
+    assert edit.to_dict()["changes"]["file:///one.yara"][0]["range"]["start"] == {"line": 3, "character": 4}
+
+@pytest.mark.protocol
+def test_slots():
+    ''' Ensure protocol objects do not carry a per-instance __dict__ '''
+    pos = protocol.Position(line=1, char=2)
+    with pytest.raises(AttributeError):
+        pos.extra = True
+    assert not hasattr(protocol.Location(protocol.Range(pos, pos), "file:///one.yara"), "__dict__")
+
+@pytest.mark.protocol
+def test_raw_json():
+    ''' Ensure pre-serialized values are decoded when nested inside of another message '''
+    raw = protocol.RawJSON(b'[{"label":"pe","kind":7}]')
+    assert protocol.loads(protocol.dumps({"result": raw})) == {"result": [{"label": "pe", "kind": 7}]}
+    with pytest.raises(TypeError):
+        protocol.RawJSON("[]")
@@ -1,10 +1,14 @@
 ''' Tests for yarals.yarals module '''
+import asyncio
 import json
 import logging
+import os
+from pathlib import Path
 
 import pytest
 from yarals import helpers
 from yarals import protocol
+from yarals import yarals
 
 try:
     # asyncio exceptions changed from 3.6 > 3.7 > 3.8
@@ -29,11 +33,18 @@ def test_cmd_compile_rule():
     }
     assert request is False
 
-@pytest.mark.skip(reason="not implemented")
+@pytest.mark.asyncio
 @pytest.mark.server
-def test_cmd_compile_all_rules():
+async def test_cmd_compile_all_rules(init_workspace, open_streams, test_rules, yara_server):
     ''' Ensure CompileAllRules compiles all YARA rule files in the given workspace '''
-    request = {
+    expected = {
+        test_rules.joinpath("code_completion.yara").as_uri(),
+        test_rules.joinpath("peek_rules.yara").as_uri(),
+        test_rules.joinpath("simple_mistake.yar").as_uri()
+    }
+    # files that compile, but have strings that would slow down scanning
+    hinted = {test_rules.joinpath("apt_alienspy_rat.yar").as_uri()}
+    request = json.dumps({
         "jsonrpc": "2.0",
         "id": 1,
         "method": "workspace/executeCommand",
@@ -41,8 +52,90 @@ def test_cmd_compile_all_rules():
             "command": "yara.CompileAllRules",
             "arguments": []
         }
-    }
-    assert request is False
+    })
+    reader, writer = open_streams
+    await init_workspace(reader, writer, yara_server, test_rules)
+    await yara_server.write_data(request, writer)
+    actual = set()
+    # only files with diagnostics are published, in whatever order they finish compiling
+    for _ in expected | hinted:
+        response = await yara_server.read_request(reader)
+        assert response["method"] == "textDocument/publishDiagnostics"
+        errors = [diag for diag in response["params"]["diagnostics"] if diag["severity"] != protocol.DiagnosticSeverity.HINT]
+        assert len(errors) == (0 if response["params"]["uri"] in hinted else 1)
+        actual.add(response["params"]["uri"])
+    assert actual == expected | hinted
+    # the command is answered once every file has been compiled
+    response = await yara_server.read_request(reader)
+    assert response == {"jsonrpc": "2.0", "id": 1, "result": None}
+    yara_server.compiler.shutdown()
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cmd_compile_all_rules_removed(init_workspace, open_streams, tmp_path, yara_server):
+    ''' Ensure files deleted between two CompileAllRules have their diagnostics cleared and their symbols dropped '''
+    broken = tmp_path.joinpath("broken.yar")
+    broken.write_text("rule Broken { condition: $a }\n")
+    tmp_path.joinpath("good.yar").write_text("rule Good { condition: true }\n")
+    request = json.dumps({
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "workspace/executeCommand",
+        "params": {
+            "command": "yara.CompileAllRules",
+            "arguments": []
+        }
+    })
+    reader, writer = open_streams
+    await init_workspace(reader, writer, yara_server, tmp_path)
+    await yara_server.write_data(request, writer)
+    response = await yara_server.read_request(reader)
+    assert response["params"]["uri"] == broken.as_uri()
+    assert len(response["params"]["diagnostics"]) == 1
+    assert (await yara_server.read_request(reader))["id"] == 1
+    broken.unlink()
+    await yara_server.write_data(request, writer)
+    response = await yara_server.read_request(reader)
+    assert response["method"] == "textDocument/publishDiagnostics"
+    assert response["params"] == {"uri": broken.as_uri(), "diagnostics": []}
+    assert (await yara_server.read_request(reader))["id"] == 1
+    state = yara_server.workspaces.get(tmp_path)
+    assert broken.as_uri() not in state.symbols
+    yara_server.compiler.shutdown()
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cmd_compile_all_rules_large_workspace(init_workspace, open_streams, tmp_path, yara_server):
+    ''' Ensure unchanged files are answered from the cache even when the workspace has more files than it holds '''
+    for index in range(8):
+        rule_file = tmp_path.joinpath("rule{:d}.yar".format(index))
+        rule_file.write_text("rule Rule{:d} {{ condition: true }}\n".format(index))
+        # files modified just before a scan are not trusted to be unchanged
+        stat = rule_file.stat()
+        os.utime(str(rule_file), ns=(stat.st_atime_ns, stat.st_mtime_ns - 60 * 10**9))
+    yara_server.compiler.cache.resize(2)
+    request = json.dumps({
+        "jsonrpc": "2.0",
+        "id": 1,
+        "method": "workspace/executeCommand",
+        "params": {
+            "command": "yara.CompileAllRules",
+            "arguments": []
+        }
+    })
+    reader, writer = open_streams
+    await init_workspace(reader, writer, yara_server, tmp_path)
+    for _ in range(2):
+        await yara_server.write_data(request, writer)
+        assert (await yara_server.read_request(reader))["id"] == 1
+    assert yara_server.compiler.cache.hits == 8
+    yara_server.compiler.shutdown()
+    writer.close()
+    await writer.wait_closed()
 
 @pytest.mark.skip(reason="not implemented")
 @pytest.mark.server
@@ -59,6 +152,45 @@ def test_cmd_compile_all_rules_no_workspace():
     }
     assert request is False
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cancel_request(init_server, open_streams, test_rules, yara_server):
+    ''' Ensure cancelled requests are answered with an error instead of a result '''
+    peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
+    file_uri = helpers.create_file_uri(peek_rules)
+    references_msg = json.dumps({
+        "jsonrpc": "2.0", "id": 2, "method": "textDocument/references",
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 42, "character": 12},
+            "context": {"includeDeclaration": True}
+        }
+    })
+    hover_msg = json.dumps({
+        "jsonrpc": "2.0", "id": 3, "method": "textDocument/hover",
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 29, "character": 12}
+        }
+    })
+    cancel_msg = json.dumps({"jsonrpc": "2.0", "method": "$/cancelRequest", "params": {"id": 2}})
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(references_msg, writer)
+    await yara_server.write_data(hover_msg, writer)
+    await yara_server.write_data(cancel_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response == {
+        "jsonrpc": "2.0", "id": 2,
+        "error": {"code": protocol.JsonRPCError.REQUEST_CANCELLED, "message": "Request cancelled"}
+    }
+    # other requests are still answered
+    response = await yara_server.read_request(reader)
+    assert response["id"] == 3
+    assert response["result"]["contents"]["value"] == "\"double string\" wide nocase fullword"
+    writer.close()
+    await writer.wait_closed()
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_code_completion_regular(test_rules, yara_server):
@@ -73,10 +205,13 @@ async def test_code_completion_regular(test_rules, yara_server):
     }
     document = yara_server._get_document(file_uri, dirty_files={})
     result = await yara_server.provide_code_completion(params, document)
-    assert len(result) == 4
-    for completion in result:
-        assert isinstance(completion, protocol.CompletionItem) is True
-        actual.append(completion.label)
+    # completion items are serialized ahead of time
+    assert isinstance(result, protocol.RawJSON) is True
+    items = json.loads(result.data)
+    assert len(items) == 4
+    for completion in items:
+        assert completion["kind"] == protocol.CompletionItemKind.CLASS
+        actual.append(completion["label"])
     assert actual == expected
 
 @pytest.mark.asyncio
@@ -327,6 +462,15 @@ async def test_exit(caplog, initialize_msg, initialized_msg, open_streams, shutd
     writer.close()
     await writer.wait_closed()
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_deferred_modules(yara_server):
+    ''' Ensure the modules schema is only loaded once it is needed '''
+    assert yara_server._modules is None
+    await yara_server.warm_up()
+    assert "pe" in yara_server.modules
+    assert "pe.data_directories" in yara_server.completions
+
 @pytest.mark.skip(reason="not implemented")
 @pytest.mark.server
 def test_highlights():
@@ -384,6 +528,78 @@ async def test_hover_dirty_file(initialize_msg, initialized_msg, open_streams, t
     writer.close()
     await writer.wait_closed()
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_request_unexpected_error(initialize_msg, initialized_msg, monkeypatch, open_streams, test_rules, yara_server):
+    ''' Ensure requests whose handler fails unexpectedly are still answered '''
+    async def broken_hover(params, document):
+        raise KeyError("contents")
+    monkeypatch.setattr(yara_server, "provide_hover", broken_hover)
+    file_uri = helpers.create_file_uri(str(test_rules.joinpath("peek_rules.yara").resolve()))
+    hover_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/hover", "id": 2,
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 29, "character": 12}
+        }
+    })
+    reader, writer = open_streams
+    await yara_server.write_data(initialize_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(initialized_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(hover_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response["id"] == 2
+    assert response["error"]["code"] == protocol.JsonRPCError.INTERNAL_ERROR
+    assert yara_server.metrics.methods["textDocument/hover"].errors == 1
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_hover_incremental_change(initialize_msg, initialized_msg, open_streams, test_rules, yara_server):
+    ''' Ensure a variable's value is provided on hover after an incremental change to an open file '''
+    peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
+    file_uri = helpers.create_file_uri(peek_rules)
+    unsaved_changes = "rule ResolveSymbol {\n strings:\n  $a = \"test\"\n condition:\n  #a > 3\n}\n"
+    did_open_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didOpen",
+        "params": {
+            "textDocument": {"uri": file_uri, "languageId": "yara", "version": 1, "text": unsaved_changes}
+        }
+    })
+    # replace "test" with "changed"
+    did_change_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didChange",
+        "params": {
+            "textDocument": {"uri": file_uri, "version": 2},
+            "contentChanges": [{
+                "range": {"start": {"line": 2, "character": 8}, "end": {"line": 2, "character": 12}},
+                "text": "changed"
+            }]
+        }
+    })
+    hover_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/hover", "id": 2,
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 4, "character": 3}
+        }
+    })
+    reader, writer = open_streams
+    await yara_server.write_data(initialize_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(initialized_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(did_open_msg, writer)
+    await yara_server.write_data(did_change_msg, writer)
+    await yara_server.write_data(hover_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response["result"]["contents"]["value"] == "\"changed\""
+    writer.close()
+    await writer.wait_closed()
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_no_hover(test_rules, yara_server):
@@ -407,8 +623,8 @@ async def test_initialize(initialize_msg, initialized_msg, open_streams, yara_se
             "capabilities": {
                 "completionProvider":{"resolveProvider": False, "triggerCharacters": ["."]},
                 "definitionProvider": True, "hoverProvider": True, "renameProvider": True,
-                "referencesProvider": True, "textDocumentSync": 1,
-                "executeCommandProvider": {"commands": ["yara.CompileRule", "yara.CompileAllRules"]}
+                "referencesProvider": True, "textDocumentSync": 2,
+                "executeCommandProvider": {"commands": ["yara.CompileRule", "yara.CompileAllRules", "yara.ScanFile", "yara.ScanDirectory"]}
             }
         }
     }
@@ -471,6 +687,38 @@ async def test_references_rules(test_rules, yara_server):
             assert location.range.end.line == 42
             assert location.range.end.char == 21
 
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_references_partial_results(init_server, monkeypatch, open_streams, test_rules, yara_server):
+    ''' Ensure references are streamed with $/progress when the client sends a partialResultToken '''
+    monkeypatch.setattr(yarals, "PARTIAL_RESULT_SIZE", 2)
+    peek_rules = str(test_rules.joinpath("peek_rules.yara").resolve())
+    file_uri = helpers.create_file_uri(peek_rules)
+    references_msg = json.dumps({
+        "jsonrpc": "2.0", "id": 2, "method": "textDocument/references",
+        "params": {
+            "textDocument": {"uri": file_uri},
+            "position": {"line": 28, "character": 12},
+            "context": {"includeDeclaration": True},
+            "partialResultToken": "refs-token"
+        }
+    })
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(references_msg, writer)
+    chunks = []
+    response = await yara_server.read_request(reader)
+    while response.get("method") == "$/progress":
+        assert response["params"]["token"] == "refs-token"
+        chunks.append(response["params"]["value"])
+        response = await yara_server.read_request(reader)
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert [loc["range"]["start"]["line"] for chunk in chunks for loc in chunk] == [21, 28, 29]
+    # everything was already reported, so the response itself is empty
+    assert response == {"jsonrpc": "2.0", "id": 2, "result": []}
+    writer.close()
+    await writer.wait_closed()
+
 @pytest.mark.asyncio
 @pytest.mark.server
 async def test_references_variable(test_rules, yara_server):
@@ -570,3 +818,256 @@ async def test_shutdown(caplog, initialize_msg, initialized_msg, open_streams, s
         assert ("yara", logging.INFO, "Client requested shutdown") in caplog.record_tuples
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_stats(init_server, open_streams, test_rules, yara_server):
+    ''' Ensure the yara/stats request reports per-method counts, latencies and traffic '''
+    file_uri = helpers.create_file_uri(str(test_rules.joinpath("peek_rules.yara").resolve()))
+    hover_msg = json.dumps({
+        "jsonrpc": "2.0", "id": 2, "method": "textDocument/hover",
+        "params": {"textDocument": {"uri": file_uri}, "position": {"line": 29, "character": 12}}
+    })
+    stats_msg = json.dumps({"jsonrpc": "2.0", "id": 3, "method": "yara/stats", "params": None})
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(hover_msg, writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(stats_msg, writer)
+    response = await yara_server.read_request(reader)
+    stats = response["result"]
+    assert stats["methods"]["initialize"]["calls"] == 1
+    assert stats["methods"]["initialized"]["calls"] == 1
+    hover = stats["methods"]["textDocument/hover"]
+    assert hover["calls"] == 1
+    assert hover["errors"] == 0
+    assert hover["latency"]["count"] == 1
+    assert stats["bytes_in"] > 0
+    assert stats["bytes_out"] > 0
+    assert set(stats["caches"]) == {"diagnostics", "files", "rules", "line_indexes", "syntax_trees", "rule_chunks"}
+    assert stats["workspaces"] == {"/yara/rules": {"clients": 1, "files": 0}}
+    assert stats["compiles"]["count"] == 0
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_definitions_workspace_rules(test_rules, yara_server):
+    ''' Ensure definitions for rules in other workspace files are provided from the symbol index '''
+    # the index builds URIs from the workspace paths
+    peek_uri = test_rules.joinpath("peek_rules.yara").as_uri()
+    state = yara_server.workspaces.open(test_rules)
+    await yara_server.index_workspace(state)
+    symbols = state.overlay()
+    file_uri = "file:///unsaved.yara"
+    document = "rule Unsaved {\n condition:\n  SyntaxExample\n}\n"
+    params = {
+        "textDocument": {"uri": file_uri},
+        "position": {"line": 2, "character": 4}
+    }
+    result = await yara_server.provide_definition(params, document, symbols)
+    assert len(result) == 1
+    assert result[0].uri == peek_uri
+    assert result[0].range.start.line == 5
+    assert result[0].range.start.char == 5
+    references = await yara_server.provide_reference(params, document, symbols)
+    assert [loc.range.start.line for loc in references] == [2, 5, 42]
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_watched_files(initialize_msg, initialized_msg, open_streams, tmp_path, yara_server):
+    ''' Ensure the server watches rule files and applies changes made outside of the editor '''
+    initialize = json.loads(initialize_msg)
+    initialize["params"]["rootUri"] = tmp_path.as_uri()
+    config_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "workspace/didChangeConfiguration",
+        "params": {"settings": {"yara": {"compile_on_save": True}}}
+    })
+    rule_file = tmp_path.joinpath("feed", "new.yar")
+    file_uri = rule_file.as_uri()
+    reader, writer = open_streams
+    await yara_server.write_data(json.dumps(initialize), writer)
+    await yara_server.read_request(reader)
+    await yara_server.write_data(initialized_msg, writer)
+    await yara_server.read_request(reader)
+    request = await yara_server.read_request(reader)
+    assert request["method"] == "client/registerCapability"
+    registration = request["params"]["registrations"][0]
+    assert registration["method"] == "workspace/didChangeWatchedFiles"
+    assert registration["registerOptions"]["watchers"] == [{"globPattern": "**/*.yara"}, {"globPattern": "**/*.yar"}]
+    await yara_server.write_data(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": None}), writer)
+    await yara_server.write_data(config_msg, writer)
+    rule_file.parent.mkdir()
+    rule_file.write_text("rule Watched {\n condition:\n  Missing\n}\n")
+    changes = [
+        {"uri": file_uri, "type": protocol.FileChangeType.CREATED},
+        {"uri": tmp_path.joinpath("notes.txt").as_uri(), "type": protocol.FileChangeType.CREATED}
+    ]
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "method": "workspace/didChangeWatchedFiles", "params": {"changes": changes}
+    }), writer)
+    response = await yara_server.read_request(reader)
+    assert response["method"] == "textDocument/publishDiagnostics"
+    assert response["params"]["uri"] == file_uri
+    assert len(response["params"]["diagnostics"]) == 1
+    assert [loc.uri for loc in yara_server.workspaces.get(tmp_path).symbols.definitions("Watched")] == [file_uri]
+    rule_file.unlink()
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "method": "workspace/didChangeWatchedFiles",
+        "params": {"changes": [{"uri": file_uri, "type": protocol.FileChangeType.DELETED}]}
+    }), writer)
+    response = await yara_server.read_request(reader)
+    assert response["params"] == {"uri": file_uri, "diagnostics": []}
+    assert yara_server.workspaces.get(tmp_path).symbols.definitions("Watched") == []
+    yara_server.compiler.shutdown()
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_include_dependents(init_workspace, open_streams, tmp_path, yara_server):
+    ''' Ensure saving an included file recompiles the files including it against the saved text '''
+    main = tmp_path.joinpath("main.yar")
+    common = tmp_path.joinpath("common.yar")
+    main.write_text("include \"common.yar\"\nrule Main { condition: Common }\n")
+    common.write_text("rule Common { condition: true }\n")
+    config_msg = json.dumps({
+        "jsonrpc": "2.0", "method": "workspace/didChangeConfiguration",
+        "params": {"settings": {"yara": {"compile_on_save": True}}}
+    })
+    reader, writer = open_streams
+    await init_workspace(reader, writer, yara_server, tmp_path)
+    # wait for the workspace to be indexed
+    await yara_server.workspaces.get(tmp_path).indexer
+    await yara_server.write_data(config_msg, writer)
+    common.write_text("rule Renamed { condition: true }\n")
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didSave",
+        "params": {"textDocument": {"uri": common.as_uri()}}
+    }), writer)
+    published = {}
+    for _ in range(2):
+        response = await yara_server.read_request(reader)
+        assert response["method"] == "textDocument/publishDiagnostics"
+        published[response["params"]["uri"]] = response["params"]["diagnostics"]
+    assert published[common.as_uri()] == []
+    assert len(published[main.as_uri()]) == 1
+    assert published[main.as_uri()][0]["message"] == "undefined identifier \"Common\""
+    yara_server.compiler.shutdown()
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_shared_workspace(init_workspace, open_streams, tmp_path, unused_tcp_port, yara_server):
+    ''' Ensure clients of the same folder share one index without seeing each other's unsaved text '''
+    rule_file = tmp_path.joinpath("one.yar")
+    rule_file.write_text("rule One { condition: true }\n")
+    stats_msg = json.dumps({"jsonrpc": "2.0", "id": 5, "method": "yara/stats"})
+    first_reader, first_writer = open_streams
+    second_reader, second_writer = await asyncio.open_connection("localhost", unused_tcp_port)
+    await init_workspace(first_reader, first_writer, yara_server, tmp_path)
+    await init_workspace(second_reader, second_writer, yara_server, tmp_path)
+    state = yara_server.workspaces.get(tmp_path)
+    assert state.clients == 2
+    await state.indexer
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didOpen",
+        "params": {"textDocument": {
+            "uri": rule_file.as_uri(), "languageId": "yara", "version": 1,
+            "text": "rule Unsaved { condition: true }\n"
+        }}
+    }), first_writer)
+    await yara_server.write_data(stats_msg, first_writer)
+    response = await yara_server.read_request(first_reader)
+    assert response["result"]["workspaces"] == {str(tmp_path): {"clients": 2, "files": 1}}
+    assert state.symbols.definitions("Unsaved") == []
+    assert [loc.uri for loc in state.symbols.definitions("One")] == [rule_file.as_uri()]
+    second_writer.close()
+    await second_writer.wait_closed()
+    # the server notices the disconnect on its own time
+    for _ in range(100):
+        if state.clients == 1:
+            break
+        await asyncio.sleep(0.01)
+    assert yara_server.workspaces.get(tmp_path) is state
+    assert state.clients == 1
+    yara_server.compiler.shutdown()
+    first_writer.close()
+    await first_writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cmd_scan_directory(init_workspace, open_streams, tmp_path, yara_server):
+    ''' Ensure samples are scanned with the workspace rules and every file is reported as it finishes '''
+    rules = tmp_path.joinpath("rules")
+    samples = tmp_path.joinpath("samples")
+    rules.mkdir()
+    samples.mkdir()
+    rules.joinpath("abc.yar").write_text("rule Abc { strings: $a = \"abc\" condition: $a }\n")
+    samples.joinpath("match.bin").write_bytes(b"xxabc")
+    samples.joinpath("clean.bin").write_bytes(b"xxx")
+    reader, writer = open_streams
+    await init_workspace(reader, writer, yara_server, rules)
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "id": 2, "method": "workspace/executeCommand",
+        "params": {
+            "command": "yara.ScanDirectory", "arguments": [samples.as_uri()],
+            "workDoneToken": "work", "partialResultToken": "partial"
+        }
+    }), writer)
+    progress, results = [], []
+    while True:
+        message = await yara_server.read_request(reader)
+        if "id" in message:
+            assert message["result"] == []
+            break
+        assert message["method"] == "$/progress"
+        if message["params"]["token"] == "work":
+            progress.append(message["params"]["value"])
+        else:
+            results.extend(message["params"]["value"])
+    assert [value["kind"] for value in progress] == ["begin", "report", "report", "end"]
+    assert progress[-2]["percentage"] == 100
+    assert progress[-1]["message"].startswith("Scanned 2 files")
+    matched = {Path(result["uri"]).name: [match["rule"] for match in result["matches"]] for result in results}
+    assert matched == {"match.bin": ["Abc"], "clean.bin": []}
+    assert all(result["time_ms"] >= 0 for result in results)
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.server
+async def test_cmd_scan_file(init_server, open_streams, tmp_path, yara_server):
+    ''' Ensure a single file can be scanned with an open document, and bad arguments are reported '''
+    sample = tmp_path.joinpath("sample.bin")
+    sample.write_bytes(b"unsaved")
+    rule_uri = tmp_path.joinpath("unsaved.yar").as_uri()
+    reader, writer = open_streams
+    await init_server(reader, writer, yara_server)
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "method": "textDocument/didOpen",
+        "params": {"textDocument": {
+            "uri": rule_uri, "languageId": "yara", "version": 1,
+            "text": "rule Unsaved { strings: $a = \"unsaved\" condition: $a }\n"
+        }}
+    }), writer)
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "id": 2, "method": "workspace/executeCommand",
+        "params": {"command": "yara.ScanFile", "arguments": [str(sample), rule_uri]}
+    }), writer)
+    response = await yara_server.read_request(reader)
+    assert len(response["result"]) == 1
+    assert response["result"][0]["uri"] == sample.as_uri()
+    assert [match["rule"] for match in response["result"][0]["matches"]] == ["Unsaved"]
+    await yara_server.write_data(json.dumps({
+        "jsonrpc": "2.0", "id": 3, "method": "workspace/executeCommand",
+        "params": {"command": "yara.ScanFile", "arguments": []}
+    }), writer)
+    response = await yara_server.read_request(reader)
+    assert response == {
+        "jsonrpc": "2.0", "method": "window/showMessage",
+        "params": {"type": 1, "message": "yara.ScanFile needs the path of a file to scan"}
+    }
+    writer.close()
+    await writer.wait_closed()
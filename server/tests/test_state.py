@@ -0,0 +1,41 @@
+''' Tests for yarals.state module '''
+import pytest
+from yarals import state
+
+
+@pytest.mark.state
+def test_registry_shares_roots(tmp_path):
+    ''' Ensure clients of the same folder share one state until the last one releases it '''
+    registry = state.WorkspaceRegistry()
+    first = registry.open(tmp_path)
+    second = registry.open(tmp_path.joinpath("sub", ".."))
+    assert first is second
+    assert first.clients == 2
+    assert len(registry) == 1
+    assert registry.get(tmp_path) is first
+    assert registry.release(first) is False
+    assert tmp_path in registry
+    assert registry.release(first) is True
+    assert tmp_path not in registry
+    assert registry.open(tmp_path) is not first
+
+@pytest.mark.state
+def test_registry_private_states(tmp_path):
+    ''' Ensure clients without a workspace folder never share a state '''
+    registry = state.WorkspaceRegistry()
+    first, second = registry.open(None), registry.open(None)
+    assert first is not second
+    assert first.root is None
+    assert first.includes(tmp_path.joinpath("rule.yar")) is False
+    assert len(registry) == 0
+    assert registry.release(first) is True
+
+@pytest.mark.state
+def test_overlays(tmp_path):
+    ''' Ensure every overlay reads from the shared index of the state '''
+    workspace = state.WorkspaceState(tmp_path)
+    overlay = workspace.overlay()
+    workspace.symbols.update(tmp_path.joinpath("one.yar").as_uri(), "rule One { condition: true }\n")
+    assert len(overlay.definitions("One")) == 1
+    assert workspace.includes(tmp_path.joinpath("one.yar")) is True
+    assert workspace.includes(tmp_path.joinpath("notes.txt")) is False
@@ -0,0 +1,125 @@
+''' Tests for yarals.symbols module '''
+import pytest
+from yarals import helpers, parser, symbols
+
+
+@pytest.mark.symbols
+def test_scan_rules(test_rules):
+    ''' Ensure rule definitions and condition references are found '''
+    peek_rules = test_rules.joinpath("peek_rules.yara").resolve()
+    definitions, references = symbols.scan_rules(peek_rules.read_text())
+    assert definitions == {
+        "SyntaxExample": [(5, 5, 18)],
+        "RuleReferenceExample": [(33, 5, 25)]
+    }
+    assert references["SyntaxExample"] == [(42, 8, 21)]
+    # keywords, module members and string identifiers are not references
+    assert "filesize" not in references
+    assert "hex_string" not in references
+
+@pytest.mark.symbols
+def test_scan_rules_private():
+    ''' Ensure private and global rules are defined, and comments and strings are not references '''
+    text = "private global rule Base { condition: true }\nrule Child {\n condition:\n  // Base\n  Base and pe.imports(\"Base\")\n}\n"
+    definitions, references = symbols.scan_rules(text)
+    assert definitions == {"Base": [(0, 20, 24)], "Child": [(1, 5, 10)]}
+    assert references == {"Base": [(4, 2, 6)], "pe": [(4, 11, 13)]}
+
+@pytest.mark.symbols
+def test_index_definitions(test_rules):
+    ''' Ensure definitions are looked up across files '''
+    index = symbols.SymbolIndex()
+    peek_uri = helpers.create_file_uri(str(test_rules.joinpath("peek_rules.yara")))
+    index.update(peek_uri, test_rules.joinpath("peek_rules.yara").read_text())
+    index.update("file:///other.yara", "rule Other {\n condition:\n  SyntaxExample\n}\n")
+    result = index.definitions("SyntaxExample")
+    assert len(result) == 1
+    assert result[0].uri == peek_uri
+    assert result[0].range.start.line == 5
+    assert result[0].range.start.char == 5
+    assert index.definitions("SyntaxExample", exclude=peek_uri) == []
+
+@pytest.mark.symbols
+def test_index_references():
+    ''' Ensure references include definitions and are sorted per file '''
+    index = symbols.SymbolIndex()
+    index.update("file:///one.yara", "rule One { condition: true }\n")
+    index.update("file:///two.yara", "rule Two { condition: One }\nrule Three { condition: One and Two }\n")
+    result = [(loc.uri, loc.range.start.line, loc.range.start.char) for loc in index.references("One")]
+    assert result == [("file:///one.yara", 0, 5), ("file:///two.yara", 0, 22), ("file:///two.yara", 1, 24)]
+
+@pytest.mark.symbols
+def test_index_invalidate():
+    ''' Ensure changed files are re-scanned lazily and removed files are dropped '''
+    index = symbols.SymbolIndex()
+    index.update("file:///one.yara", "rule One { condition: true }\n")
+    index.invalidate("file:///one.yara", lambda: "rule Renamed { condition: true }\n")
+    assert "file:///one.yara" in index
+    assert index.definitions("One") == []
+    assert len(index.definitions("Renamed")) == 1
+    index.remove("file:///one.yara")
+    assert index.definitions("Renamed") == []
+    assert len(index) == 0
+
+@pytest.mark.symbols
+def test_index_replace_keeps_invalidated():
+    ''' Ensure files changed while a replacement index is built are re-scanned after replacing '''
+    shared = symbols.SymbolIndex()
+    shared.update("file:///one.yara", "rule One { condition: true }\n")
+    # the rebuild read the file before it was saved again
+    rebuilt = symbols.SymbolIndex()
+    rebuilt.update("file:///one.yara", "rule One { condition: true }\n")
+    shared.invalidate("file:///one.yara", lambda: "rule Saved { condition: true }\n")
+    shared.replace(rebuilt)
+    assert shared.definitions("One") == []
+    assert [loc.uri for loc in shared.definitions("Saved")] == ["file:///one.yara"]
+
+@pytest.mark.symbols
+def test_index_workspace_uncached(tmp_path):
+    ''' Ensure indexing a workspace leaves the parse caches to the open documents '''
+    for index in range(parser.CHUNK_CACHE.maxtrees * 2):
+        tmp_path.joinpath("rule{:d}.yar".format(index)).write_text("rule Indexed{:d} {{ condition: true }}\n".format(index))
+    opened = parser.get_syntax_tree("rule Opened { condition: true }\n")
+    trees = parser.get_syntax_tree.cache_info()
+    chunks = len(parser.CHUNK_CACHE)
+    index = symbols.SymbolIndex.from_workspace(tmp_path)
+    assert len(index) == parser.CHUNK_CACHE.maxtrees * 2
+    assert len(index.definitions("Indexed3")) == 1
+    assert parser.get_syntax_tree.cache_info() == trees
+    assert len(parser.CHUNK_CACHE) == chunks
+    assert parser.get_syntax_tree("rule Opened { condition: true }\n") is opened
+
+@pytest.mark.symbols
+def test_index_dependents():
+    ''' Ensure the files including a file are tracked as files are re-scanned '''
+    index = symbols.SymbolIndex()
+    index.update("file:///rules/main.yar", "include \"sub/common.yar\"\nrule Main { condition: Common }\n")
+    index.update("file:///rules/sub/common.yar", "include \"base.yar\"\n")
+    assert index.includes("file:///rules/main.yar") == ("file:///rules/sub/common.yar",)
+    assert index.dependents("file:///rules/sub/base.yar") == ["file:///rules/sub/common.yar", "file:///rules/main.yar"]
+    index.invalidate("file:///rules/main.yar", lambda: "rule Main { condition: true }\n")
+    assert index.dependents("file:///rules/sub/base.yar") == ["file:///rules/sub/common.yar"]
+
+@pytest.mark.symbols
+def test_overlay():
+    ''' Ensure a client's open documents hide the shared index without changing it '''
+    shared = symbols.SymbolIndex()
+    shared.update("file:///rules/one.yar", "rule One { condition: true }\n")
+    shared.update("file:///rules/two.yar", "include \"one.yar\"\nrule Two { condition: One }\n")
+    first, second = symbols.SymbolOverlay(shared), symbols.SymbolOverlay(shared)
+    first.invalidate("file:///rules/one.yar", lambda: "rule Unsaved { condition: true }\n")
+    first.invalidate("file:///rules/three.yar", lambda: "include \"one.yar\"\n")
+    assert first.definitions("One") == []
+    assert [loc.uri for loc in first.definitions("Unsaved")] == ["file:///rules/one.yar"]
+    assert sorted(first.dependents("file:///rules/one.yar")) == ["file:///rules/three.yar", "file:///rules/two.yar"]
+    # the other client and the shared index still see what is on disk
+    assert second.definitions("Unsaved") == []
+    assert [loc.uri for loc in second.definitions("One")] == ["file:///rules/one.yar"]
+    assert second.dependents("file:///rules/one.yar") == ["file:///rules/two.yar"]
+    first.close("file:///rules/one.yar")
+    assert [loc.uri for loc in first.definitions("One")] == ["file:///rules/one.yar"]
+    # replacing the shared index is seen through every overlay
+    rebuilt = symbols.SymbolIndex()
+    rebuilt.update("file:///rules/four.yar", "rule Four { condition: true }\n")
+    shared.replace(rebuilt)
+    assert [loc.uri for loc in second.definitions("Four")] == ["file:///rules/four.yar"]
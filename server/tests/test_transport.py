@@ -1,8 +1,18 @@
 ''' Test the various transport mechanisms used between client and server
-    Currently only TCP is supported, though ideally anything supported by
-    the asyncio library will be fully integrated and tested in the future
+    TCP, stdio and Unix domain sockets are supported
 '''
+import asyncio
+import json
+import logging
+import os
+import socket
+import stat
+
 import pytest
+from yarals import protocol
+from yarals import transport
+from yarals.custom_err import ServerExit
+from yarals.outbound import MessageQueue
 
 
 @pytest.mark.asyncio
@@ -22,3 +32,196 @@ async def test_tcp_opened(open_streams):
     assert reader.at_eof() is False
     writer.close()
     await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_read_multiple_headers(yara_server):
+    ''' Ensure messages with extra headers (such as Content-Type) are parsed '''
+    body = b'{"jsonrpc": "2.0", "method": "initialized", "params": {}}'
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"Content-Length: %d\r\nContent-Type: application/vscode-jsonrpc; charset=utf-8\r\n\r\n" % len(body))
+    reader.feed_data(body)
+    reader.feed_eof()
+    message = await yara_server.read_request(reader)
+    assert message == {"jsonrpc": "2.0", "method": "initialized", "params": {}}
+    # an empty dictionary is returned once the stream ends
+    assert await yara_server.read_request(reader) == {}
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_non_ascii_round_trip(yara_server):
+    ''' Ensure Content-Length counts bytes, so non-ASCII messages are framed correctly '''
+    message = json.dumps({"jsonrpc": "2.0", "method": "window/logMessage", "params": {"message": "règle ✓"}}, ensure_ascii=False)
+    reader = asyncio.StreamReader()
+    transport = _BufferTransport()
+    writer = asyncio.StreamWriter(transport, asyncio.StreamReaderProtocol(reader), reader, asyncio.get_event_loop())
+    await yara_server.write_data(message, writer)
+    await yara_server.write_data(message.encode("utf-8"), writer)
+    reader.feed_data(transport.data)
+    for _ in range(2):
+        assert await yara_server.read_request(reader) == json.loads(message)
+    writer.close()
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_raw_response(yara_server):
+    ''' Ensure pre-serialized results are sent as a valid response '''
+    reader, transport, writer = _buffer_streams()
+    await yara_server.send_response(7, protocol.RawJSON(b'[{"label":"pe","kind":7}]'), writer)
+    reader.feed_data(transport.data)
+    assert await yara_server.read_request(reader) == {"jsonrpc": "2.0", "id": 7, "result": [{"label": "pe", "kind": 7}]}
+    writer.close()
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_queue_batches_writes(yara_server):
+    ''' Ensure messages queued together are written to the transport at once '''
+    _, transport, writer = _buffer_streams()
+    queue = MessageQueue(writer)
+    for curr_id in range(10):
+        await yara_server.send_response(curr_id, {}, queue)
+    queue.close()
+    await queue.wait_closed()
+    assert transport.writes == 1
+    assert transport.closed is True
+    reader = asyncio.StreamReader()
+    reader.feed_data(transport.data)
+    for curr_id in range(10):
+        assert (await yara_server.read_request(reader))["id"] == curr_id
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_queue_coalesces_diagnostics(yara_server):
+    ''' Ensure only the newest unsent diagnostics for a file are written '''
+    _, transport, writer = _buffer_streams()
+    queue = MessageQueue(writer)
+    for version in range(5):
+        for file_uri in ("file:///one.yara", "file:///two.yara"):
+            params = {"uri": file_uri, "diagnostics": [version]}
+            await yara_server.send_notification("textDocument/publishDiagnostics", params, queue)
+    await yara_server.send_notification("window/showMessage", {"type": 3, "message": "done"}, queue)
+    queue.close()
+    await queue.wait_closed()
+    assert queue.coalesced == 8
+    reader = asyncio.StreamReader()
+    reader.feed_data(transport.data)
+    reader.feed_eof()
+    messages = []
+    message = await yara_server.read_request(reader)
+    while message:
+        messages.append(message)
+        message = await yara_server.read_request(reader)
+    assert [msg["params"].get("uri") for msg in messages] == ["file:///one.yara", "file:///two.yara", None]
+    assert all(msg["params"]["diagnostics"] == [4] for msg in messages[:2])
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_queue_backpressure(yara_server):
+    ''' Ensure writers wait for the queue to empty out once it holds too much data '''
+    _, transport, writer = _buffer_streams()
+    queue = MessageQueue(writer, high_water=1024, batch_size=256)
+    for _ in range(100):
+        queue.write(b"x" * 100)
+    assert len(transport.data) == 0
+    await queue.drain()
+    # the queue only lets writers continue after dropping below a quarter of its limit
+    assert len(transport.data) >= 100 * 100 - 256
+    assert transport.writes > 1
+    queue.close()
+    await queue.wait_closed()
+    assert len(transport.data) == 100 * 100
+
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_stdio(initialize_msg, yara_server):
+    ''' Ensure a client can be served over a pair of pipes '''
+    client_read, server_write = os.pipe()
+    server_read, client_write = os.pipe()
+    with open(server_read, "rb", buffering=0) as stdin, open(server_write, "wb", buffering=0) as stdout:
+        server = asyncio.ensure_future(transport.serve_stdio(yara_server.handle_client, stdin, stdout))
+        reader, writer = await transport.open_stdio(open(client_read, "rb", buffering=0), open(client_write, "wb", buffering=0))
+        await yara_server.write_data(initialize_msg, writer)
+        response = await yara_server.read_request(reader)
+        assert response["id"] == 0
+        assert "capabilities" in response["result"]
+        # the server stops once the client closes its end
+        writer.close()
+        await asyncio.wait_for(server, timeout=5)
+        assert yara_server.num_clients == 0
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+async def test_stdio_exit(caplog, initialize_msg, initialized_msg, yara_server):
+    ''' Ensure the server exits cleanly when a client served over pipes asks it to '''
+    client_read, server_write = os.pipe()
+    server_read, client_write = os.pipe()
+    with open(server_read, "rb", buffering=0) as stdin, open(server_write, "wb", buffering=0) as stdout:
+        server = asyncio.ensure_future(transport.serve_stdio(yara_server.handle_client, stdin, stdout))
+        reader, writer = await transport.open_stdio(open(client_read, "rb", buffering=0), open(client_write, "wb", buffering=0))
+        await yara_server.write_data(initialize_msg, writer)
+        await yara_server.read_request(reader)
+        await yara_server.write_data(initialized_msg, writer)
+        await yara_server.read_request(reader)
+        await yara_server.write_data(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "shutdown"}), writer)
+        assert (await yara_server.read_request(reader))["id"] == 1
+        await yara_server.write_data(json.dumps({"jsonrpc": "2.0", "method": "exit"}), writer)
+        with caplog.at_level(logging.INFO, "yara"), pytest.raises(ServerExit):
+            await asyncio.wait_for(server, timeout=5)
+        assert ("yara", logging.INFO, "Disconnected client") in caplog.record_tuples
+        writer.close()
+        await writer.wait_closed()
+
+@pytest.mark.asyncio
+@pytest.mark.transport
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix domain sockets are not supported")
+async def test_unix_socket(initialize_msg, tmp_path, yara_server):
+    ''' Ensure clients can connect over a Unix domain socket, replacing a stale socket file '''
+    path = tmp_path.joinpath("yarals.sock")
+    stale = await transport.start_socket_server(yara_server.handle_client, path)
+    stale.close()
+    await stale.wait_closed()
+    server = await transport.start_socket_server(yara_server.handle_client, path)
+    await server.start_serving()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    reader, writer = await asyncio.open_unix_connection(str(path))
+    await yara_server.write_data(initialize_msg, writer)
+    response = await yara_server.read_request(reader)
+    assert response["id"] == 0
+    writer.close()
+    await writer.wait_closed()
+    server.close()
+    await server.wait_closed()
+
+def _buffer_streams():
+    ''' Create a reader and a writer whose transport stores everything written to it '''
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport = _BufferTransport(protocol)
+    writer = asyncio.StreamWriter(transport, protocol, reader, asyncio.get_event_loop())
+    return reader, transport, writer
+
+
+class _BufferTransport(asyncio.Transport):
+    ''' Transport that stores everything written to it '''
+    def __init__(self, protocol: asyncio.Protocol=None):
+        super().__init__()
+        self.protocol = protocol
+        self.closed = False
+        self.data = b""
+        self.writes = 0
+
+    def write(self, data):
+        self.data += data
+        self.writes += 1
+
+    def close(self):
+        if not self.closed and self.protocol is not None:
+            self.protocol.connection_lost(None)
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def get_write_buffer_size(self):
+        return 0
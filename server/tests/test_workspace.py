@@ -0,0 +1,120 @@
+''' Tests for yarals.workspace module '''
+import os
+
+import pytest
+from yarals import workspace
+
+
+def _make_tree(root):
+    ''' Create a few rule files, some of them in folders that are excluded by default '''
+    for relpath in ("one.yar", "sub/two.yara", "sub/notes.txt", ".git/three.yar", "node_modules/pkg/four.yar", "feeds/five.yar"):
+        path = root.joinpath(relpath)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("rule R { condition: true }\n")
+
+def _age(path, seconds=60):
+    ''' Move a file's modification time into the past, so it isn't considered racy '''
+    stat = path.stat()
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns - seconds * 10**9))
+
+
+@pytest.mark.workspace
+def test_iter_paths(tmp_path):
+    ''' Ensure only included files outside of excluded folders are found '''
+    _make_tree(tmp_path)
+    scanner = workspace.WorkspaceScanner(tmp_path)
+    found = sorted(path.relative_to(tmp_path).as_posix() for path in scanner.iter_paths())
+    assert found == ["feeds/five.yar", "one.yar", "sub/two.yara"]
+
+@pytest.mark.workspace
+def test_configure_patterns(tmp_path):
+    ''' Ensure patterns match names or paths relative to the root '''
+    _make_tree(tmp_path)
+    scanner = workspace.WorkspaceScanner(tmp_path)
+    exclude = list(workspace.DEFAULT_EXCLUDE) + ["feeds", "sub/*.yara"]
+    assert scanner.configure(["*.yar"], exclude) is True
+    assert scanner.configure(["*.yar"], exclude) is False
+    assert [path.name for path in scanner.iter_paths()] == ["one.yar"]
+    # custom excludes replace the defaults
+    scanner.configure(["*.yar"], ["feeds"])
+    assert sorted(path.name for path in scanner.iter_paths()) == ["four.yar", "one.yar", "three.yar"]
+
+@pytest.mark.workspace
+def test_includes(tmp_path):
+    ''' Ensure single files are matched the same way a scan would match them '''
+    _make_tree(tmp_path)
+    scanner = workspace.WorkspaceScanner(tmp_path)
+    assert scanner.includes(tmp_path.joinpath("sub", "two.yara")) is True
+    # files that do not exist yet are matched by their path alone
+    assert scanner.includes(tmp_path.joinpath("new", "six.yar")) is True
+    assert scanner.includes(tmp_path.joinpath("sub", "notes.txt")) is False
+    assert scanner.includes(tmp_path.joinpath("node_modules", "pkg", "four.yar")) is False
+    assert scanner.includes(tmp_path.parent.joinpath("outside.yar")) is False
+    scanner.configure(["*.yar", "sub/*.yara"])
+    assert scanner.watch_patterns() == ["**/*.yar", "sub/*.yara"]
+
+@pytest.mark.workspace
+def test_scan_changes(tmp_path):
+    ''' Ensure files are unchanged once their hash is known, until they are modified or removed '''
+    _make_tree(tmp_path)
+    scanner = workspace.WorkspaceScanner(tmp_path)
+    for path in scanner.iter_paths():
+        _age(path)
+    result = scanner.scan()
+    assert len(result.changed) == 3
+    assert result.unchanged == {}
+    for path in result.changed:
+        scanner.update(path, "key-" + path.name)
+    result = scanner.scan()
+    assert result.changed == []
+    assert result.unchanged[tmp_path.joinpath("one.yar")] == "key-one.yar"
+    tmp_path.joinpath("one.yar").write_text("rule Changed { condition: false }\n")
+    tmp_path.joinpath("feeds", "five.yar").unlink()
+    result = scanner.scan()
+    assert result.changed == [tmp_path.joinpath("one.yar")]
+    assert result.removed == [tmp_path.joinpath("feeds", "five.yar")]
+    assert len(result) == 2
+
+@pytest.mark.workspace
+def test_racy_files(tmp_path):
+    ''' Ensure files modified right before a scan are read again next time '''
+    rule_file = tmp_path.joinpath("fresh.yar")
+    rule_file.write_text("rule Fresh { condition: true }\n")
+    scanner = workspace.WorkspaceScanner(tmp_path)
+    scanner.update(rule_file, "ignored")
+    scanner.scan()
+    scanner.update(rule_file, "key")
+    assert scanner.scan().changed == [rule_file]
+
+@pytest.mark.workspace
+def test_manifest_persistence(tmp_path):
+    ''' Ensure known hashes survive a save and load '''
+    _make_tree(tmp_path)
+    manifest = tmp_path.joinpath(".yarals", "manifest.json")
+    scanner = workspace.WorkspaceScanner(tmp_path, manifest_path=manifest)
+    for path in scanner.iter_paths():
+        _age(path)
+    for path in scanner.scan().changed:
+        scanner.update(path, "key")
+    scanner.save()
+    assert manifest.is_file()
+    restored = workspace.WorkspaceScanner(tmp_path, manifest_path=manifest)
+    restored.load()
+    assert len(restored) == 3
+    result = restored.scan()
+    assert result.changed == []
+    assert set(result.unchanged.values()) == {"key"}
+
+@pytest.mark.workspace
+def test_forget(tmp_path):
+    ''' Ensure a forgotten file is treated as changed by the next scan '''
+    _make_tree(tmp_path)
+    scanner = workspace.WorkspaceScanner(tmp_path)
+    for path in scanner.iter_paths():
+        _age(path)
+    for path in scanner.scan().changed:
+        scanner.update(path, "key-" + path.name)
+    scanner.forget(tmp_path.joinpath("one.yar"))
+    result = scanner.scan()
+    assert result.changed == [tmp_path.joinpath("one.yar")]
+    assert len(result.unchanged) == 2
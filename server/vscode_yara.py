@@ -5,15 +5,26 @@ import json
 import logging
 import logging.handlers
 from pathlib import Path
+import sys
 
+from yarals import custom_err as ce
+from yarals import transport
 from yarals.yarals import YaraLanguageServer
 
 
 def _build_cli():
     parser = argparse.ArgumentParser(description="Start the vscode-yara language server")
-    parser.add_argument("host", help="Interface to bind server to")
-    parser.add_argument("port", type=int, help="Port to bind server to")
-    return parser.parse_args()
+    parser.add_argument("host", nargs="?", help="Interface to bind server to")
+    parser.add_argument("port", nargs="?", type=int, help="Port to bind server to")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--stdio", action="store_true", help="Serve a single client over stdin and stdout")
+    mode.add_argument("--socket", metavar="PATH", type=Path, help="Serve clients on a Unix domain socket")
+    args = parser.parse_args()
+    if (args.stdio or args.socket) and (args.host or args.port):
+        parser.error("host and port can't be used with --stdio or --socket")
+    elif not (args.stdio or args.socket) and (args.host is None or args.port is None):
+        parser.error("host and port are required unless --stdio or --socket is used")
+    return args
 
 def _build_logger():
     ''' Configure the loggers appropriately '''
@@ -22,7 +33,8 @@ def _build_logger():
     for lvl in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
         logging.addLevelName(getattr(logging, lvl), lvl.capitalize())
     logger = logging.getLogger("yara")
-    screen_hdlr = logging.StreamHandler()
+    # stdout may be carrying JSON-RPC messages, so the screen is always stderr
+    screen_hdlr = logging.StreamHandler(sys.stderr)
     screen_fmt = logging.Formatter("[%(levelname)-5s - %(asctime)s] %(name)s.%(module)s : %(message)s", datefmt="%-H:%M:%S %p")
     screen_hdlr.setFormatter(screen_fmt)
     screen_hdlr.setLevel(logging.INFO)
@@ -39,19 +51,26 @@ async def main():
     args = _build_cli()
     yarals = YaraLanguageServer()
     logger.info("Starting YARA IO language server")
-    socket_server = await asyncio.start_server(
-        client_connected_cb=yarals.handle_client,
-        host=args.host,
-        port=args.port,
-        start_serving=False
-    )
-    servhost, servport = socket_server.sockets[0].getsockname()
-    logger.info("Serving on tcp://%s:%d", servhost, servport)
     try:
+        if args.stdio:
+            # the server's lifetime is tied to the client that started it
+            await transport.serve_stdio(yarals.handle_client)
+            logger.info("Server has successfully shutdown")
+            return
+        elif args.socket:
+            socket_server = await transport.start_socket_server(yarals.handle_client, args.socket)
+            logger.info("Serving on unix://%s", args.socket)
+        else:
+            socket_server = await transport.start_tcp_server(yarals.handle_client, args.host, args.port)
+            servhost, servport = socket_server.sockets[0].getsockname()[:2]
+            logger.info("Serving on tcp://%s:%d", servhost, servport)
         async with socket_server:
             await socket_server.serve_forever()
-    except asyncio.CancelledError:
+    except (asyncio.CancelledError, ce.ServerExit):
         logger.info("Server has successfully shutdown")
+    finally:
+        if args.socket and args.socket.is_socket():
+            args.socket.unlink()
 
 try:
     logger = _build_logger()
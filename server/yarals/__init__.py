@@ -1 +1 @@
-__all__ = ["custom_err", "helpers", "protocol", "yarals"]
+__all__ = ["atoms", "cache", "compiler", "completion", "custom_err", "document", "helpers", "includes", "matcher", "metrics", "outbound", "parser", "protocol", "state", "symbols", "workspace", "yarals"]
@@ -0,0 +1,399 @@
+''' Estimate how well YARA can pick atoms for the strings in a rule
+
+Before scanning, YARA picks a short "atom" of up to four bytes from every
+string and only verifies the full string where its atom was found. Atoms
+that are short or made of common bytes are found all over a file, so the
+strings they belong to slow every scan down. The estimates here follow the
+heuristic libyara uses to rate atoms, without compiling anything
+'''
+import re
+from typing import Iterator, List, Tuple
+
+from yarals import protocol as lsp
+from yarals.document import get_line_index
+from yarals.parser import StringDef, TokenKind, get_syntax_tree
+
+# longest atom YARA picks from a string
+MAX_ATOM_LENGTH = 4
+# quality of the best possible atom
+MAX_ATOM_QUALITY = 255
+# YARA itself warns that a string is slowing down scanning below this quality
+WARNING_QUALITY = MAX_ATOM_QUALITY - 22 * MAX_ATOM_LENGTH + 38
+# atoms below this quality are pointed out with a hint, e.g. two letters
+HINT_QUALITY = MAX_ATOM_QUALITY - 22 * MAX_ATOM_LENGTH + 50
+# bytes found in most files, which make for worse atoms than the rest
+COMMON_BYTES = frozenset([0x00, 0x20, 0xCC, 0xFF])
+# atoms repeating one of these bytes are rated especially low
+REPEATED_BYTES = frozenset([0x00, 0x20, 0x90, 0xCC, 0xFF])
+# nocase strings shorter than this are pointed out, since every case combination becomes an atom
+MIN_NOCASE_LENGTH = 4
+# pieces of a hex string: bytes with optional nibble wildcards, jumps, alternatives and comments
+HEX_TOKEN_PATTERN = re.compile(r"(\s+|//[^\n]*|/\*.*?\*/)|(~?[0-9A-Fa-f?]{2})|(\[[^\]]*\])|([()|])", re.DOTALL)
+QUANTIFIER_PATTERN = re.compile(r"\{(\d*)(?:,\d*)?\}")
+# regular expression escapes that stand for a single byte
+REGEX_ESCAPES = {"n": 0x0A, "t": 0x09, "r": 0x0D, "f": 0x0C, "a": 0x07}
+# a regular expression that can match anything before its atom
+LEADING_WILDCARD_PATTERN = re.compile(r"\^?\.[*+]")
+
+# an atom is a tuple of (byte, mask) pairs. The mask has the bits of the byte that have to match
+Atom = Tuple[Tuple[int, int], ...]
+# a sequence holds (byte, mask) pairs, None where the bytes stop being contiguous,
+# and lists of sequences where one of several alternatives has to match
+BREAK = None
+
+
+def atom_quality(atom: Atom) -> int:
+    '''Rate an atom the way YARA does. Higher is better, up to MAX_ATOM_QUALITY
+
+    :atom: Tuple of (byte, mask) pairs
+    '''
+    quality = 0
+    unique = set()
+    for value, mask in atom:
+        if mask == 0x00:
+            quality += 2
+        elif mask != 0xFF:
+            quality += 4
+        else:
+            if value in COMMON_BYTES:
+                quality += 12
+            elif 0x41 <= value <= 0x5A or 0x61 <= value <= 0x7A:
+                # letters are rated a little lower, since nocase strings need an atom per case combination
+                quality += 18
+            else:
+                quality += 20
+            unique.add(value)
+    if len(unique) == 1 and unique <= REPEATED_BYTES:
+        quality -= 10 * len(atom)
+    else:
+        quality += 2 * len(unique)
+    return MAX_ATOM_QUALITY - 22 * MAX_ATOM_LENGTH + quality
+
+def best_atom(run: list) -> Tuple[int, Atom]:
+    '''Pick the best atom from a run of contiguous bytes
+
+    Returns the quality and the atom, which is empty if the run is empty
+
+    :run: List of (byte, mask) pairs
+    '''
+    if len(run) <= MAX_ATOM_LENGTH:
+        return atom_quality(tuple(run)), tuple(run)
+    windows = (tuple(run[start:start + MAX_ATOM_LENGTH]) for start in range(len(run) - MAX_ATOM_LENGTH + 1))
+    return max(((atom_quality(atom), atom) for atom in windows), key=lambda found: found[0])
+
+def sequence_atom(sequence: list) -> Tuple[int, Atom]:
+    '''Pick the best atom from a sequence
+
+    Alternatives are only as good as the worst of them, since each one needs an atom of its own
+
+    :sequence: List of (byte, mask) pairs, BREAK and lists of alternative sequences
+    '''
+    found = [best_atom([])]
+    run = []
+    for item in sequence + [BREAK]:
+        if isinstance(item, tuple):
+            run.append(item)
+            continue
+        if run:
+            found.append(best_atom(run))
+            run = []
+        if isinstance(item, list):
+            found.append(min((sequence_atom(alternative) for alternative in item), key=lambda atom: atom[0]))
+    return max(found, key=lambda atom: atom[0])
+
+def format_atom(atom: Atom) -> str:
+    '''Write an atom the way it would appear in a hex string
+
+    :atom: Tuple of (byte, mask) pairs
+    '''
+    pieces = []
+    for value, mask in atom:
+        if mask == 0xFF:
+            pieces.append("{:02X}".format(value))
+        elif mask == 0x0F:
+            pieces.append("?{:X}".format(value & 0x0F))
+        elif mask == 0xF0:
+            pieces.append("{:X}?".format(value >> 4))
+        else:
+            pieces.append("??")
+    return "{ " + " ".join(pieces) + " }"
+
+
+def _text_bytes(value: str) -> bytes:
+    ''' Unescape the contents of a quoted text string '''
+    body = value[1:-1] if len(value) > 1 and value.endswith("\"") else value[1:]
+    data = bytearray()
+    index = 0
+    while index < len(body):
+        char = body[index]
+        if char == "\\" and index + 1 < len(body):
+            escaped = body[index + 1]
+            if escaped == "x" and re.match(r"[0-9A-Fa-f]{2}$", body[index + 2:index + 4]):
+                data.append(int(body[index + 2:index + 4], 16))
+                index += 4
+                continue
+            data.extend(bytes([REGEX_ESCAPES[escaped]]) if escaped in "ntr" else escaped.encode("utf-8"))
+            index += 2
+            continue
+        data.extend(char.encode("utf-8"))
+        index += 1
+    return bytes(data)
+
+def _widen(sequence: list) -> list:
+    ''' Interleave every byte with a zero byte, the way "wide" strings are encoded '''
+    wide = []
+    for item in sequence:
+        if isinstance(item, tuple):
+            wide.extend((item, (0x00, 0xFF)))
+        elif isinstance(item, list):
+            wide.append([_widen(alternative) for alternative in item])
+        else:
+            wide.append(item)
+    return wide
+
+def parse_hex(value: str) -> list:
+    '''Turn a hex string into a sequence, or None if it can't be parsed
+
+    :value: Hex string, including its braces
+    '''
+    body = value[1:-1] if value.endswith("}") else value[1:]
+    tokens = []
+    pos = 0
+    while pos < len(body):
+        match = HEX_TOKEN_PATTERN.match(body, pos)
+        if match is None:
+            # YARA reports the syntax error
+            return None
+        if match.group(1) is None:
+            tokens.append(match.group())
+        pos = match.end()
+    sequence, end = _parse_hex_tokens(tokens, 0)
+    return sequence if end == len(tokens) else None
+
+def _parse_hex_tokens(tokens: List[str], index: int) -> Tuple[list, int]:
+    ''' Parse hex tokens into a sequence until the end of an alternative '''
+    sequence = []
+    while index < len(tokens) and tokens[index] not in ("|", ")"):
+        token = tokens[index]
+        if token == "(":
+            alternatives = []
+            while index < len(tokens) and tokens[index] in ("(", "|"):
+                alternative, index = _parse_hex_tokens(tokens, index + 1)
+                alternatives.append(alternative)
+            sequence.append(alternatives)
+        elif token.startswith("[") or token.startswith("~"):
+            # jumps and negated bytes can't be part of an atom
+            sequence.append(BREAK)
+        else:
+            high, low = token[0], token[1]
+            mask = (0x00 if high == "?" else 0xF0) | (0x00 if low == "?" else 0x0F)
+            sequence.append((int(token.replace("?", "0"), 16), mask))
+        index += 1
+    return sequence, index
+
+def parse_regex(pattern: str) -> list:
+    '''Turn the body of a regular expression into a sequence
+
+    Only bytes that every match has to contain are kept. Character classes,
+    groups and repeated bytes just break the sequence, so the estimate can
+    only ever be worse than the atom YARA actually picks
+
+    :pattern: Regular expression without its slashes and flags
+    '''
+    alternatives = _split_alternatives(pattern)
+    if len(alternatives) > 1:
+        return [[parse_regex(alternative) for alternative in alternatives]]
+    sequence = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\" and index + 1 < len(pattern):
+            escaped = pattern[index + 1]
+            index += 2
+            if escaped == "x" and re.match(r"[0-9A-Fa-f]{2}$", pattern[index:index + 2]):
+                sequence.append((int(pattern[index:index + 2], 16), 0xFF))
+                index += 2
+            elif escaped in REGEX_ESCAPES:
+                sequence.append((REGEX_ESCAPES[escaped], 0xFF))
+            elif escaped.isalnum():
+                # classes such as \d and \w, and anchors such as \b
+                sequence.append(BREAK)
+            else:
+                sequence.extend((byte, 0xFF) for byte in escaped.encode("utf-8"))
+            continue
+        if char in "[(":
+            index = _skip_group(pattern, index)
+            sequence.append(BREAK)
+            continue
+        quantifier = QUANTIFIER_PATTERN.match(pattern, index) if char == "{" else None
+        if char in "*?+" or quantifier is not None:
+            # whatever was repeated doesn't have to appear at all, unless at least once
+            if sequence and isinstance(sequence[-1], tuple) and (char in "*?" or quantifier is not None and not int(quantifier.group(1) or 0)):
+                sequence.pop()
+            sequence.append(BREAK)
+            index = quantifier.end() if quantifier is not None else index + 1
+            continue
+        if char in ".^$":
+            sequence.append(BREAK)
+        else:
+            sequence.extend((byte, 0xFF) for byte in char.encode("utf-8"))
+        index += 1
+    return sequence
+
+def _split_alternatives(pattern: str) -> List[str]:
+    ''' Split a regular expression at every "|" outside of groups and classes '''
+    alternatives = []
+    depth = 0
+    start = 0
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\":
+            index += 2
+            continue
+        if char == "[":
+            index = _skip_group(pattern, index)
+            continue
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            alternatives.append(pattern[start:index])
+            start = index + 1
+        index += 1
+    alternatives.append(pattern[start:])
+    return alternatives
+
+def _skip_group(pattern: str, index: int) -> int:
+    ''' Find the offset after the class or group starting at an offset '''
+    closing = "]" if pattern[index] == "[" else ")"
+    depth = 0
+    # "]" right after "[" or "[^" is part of the class
+    first = index + (2 if pattern[index + 1:index + 2] == "^" else 1) if closing == "]" else -1
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\":
+            index += 2
+            continue
+        if closing == "]":
+            if char == "]" and index > first:
+                return index + 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        elif char == "[":
+            index = _skip_group(pattern, index)
+            continue
+        index += 1
+    return index
+
+
+class StringAtoms(object):
+    __slots__ = ("string", "quality", "atom", "variants")
+
+    def __init__(self, string: StringDef, quality: int, atom: Atom, variants: int=1):
+        ''' The estimated atom of a string, and how many atoms YARA searches for to find it '''
+        self.string = string
+        self.quality = quality
+        self.atom = atom
+        self.variants = variants
+
+    def __repr__(self):
+        return "<StringAtoms(string={!r}, quality={:d})>".format(self.string.identifier.value, self.quality)
+
+
+def estimate_atoms(string: StringDef) -> StringAtoms:
+    '''Estimate the atom YARA picks for a string, or None if it can't be estimated
+
+    The worst of the ascii and wide forms of a string is used, since YARA
+    needs an atom for each of them. Strings searched for in forms that are
+    derived from them, such as base64, are skipped
+
+    :string: String definition to estimate
+    '''
+    value = string.value
+    modifiers = {token.value for token in string.modifiers}
+    if value is None or modifiers & {"base64", "base64wide"}:
+        return None
+    if value.kind == TokenKind.TEXT:
+        sequence = [(byte, 0xFF) for byte in _text_bytes(value.value)]
+    elif value.kind == TokenKind.HEX:
+        sequence = parse_hex(value.value)
+    elif value.kind == TokenKind.REGEX:
+        end = value.value.rindex("/")
+        # unterminated expressions have no flags
+        body, flags = (value.value[1:end], value.value[end + 1:]) if end > 0 else (value.value[1:], "")
+        sequence = parse_regex(body)
+        if "i" in flags:
+            modifiers.add("nocase")
+    else:
+        return None
+    if sequence is None:
+        return None
+    forms = []
+    if value.kind == TokenKind.HEX or "ascii" in modifiers or "wide" not in modifiers:
+        forms.append(sequence)
+    if value.kind != TokenKind.HEX and "wide" in modifiers:
+        forms.append(_widen(sequence))
+    quality, atom = min((sequence_atom(form) for form in forms), key=lambda found: found[0])
+    variants = len(forms)
+    if "nocase" in modifiers:
+        variants *= 2 ** sum(1 for byte, mask in atom if mask == 0xFF and chr(byte).isalpha() and byte < 0x80)
+    return StringAtoms(string, quality, atom, variants)
+
+def iter_findings(document: str) -> Iterator[Tuple[StringDef, lsp.DiagnosticSeverity, str]]:
+    '''Find the strings that would slow down scanning, with the severity and message for each
+
+    :document: Contents of YARA rule file
+    '''
+    for rule in get_syntax_tree(document).rules:
+        for string in rule.strings:
+            estimate = estimate_atoms(string)
+            if estimate is None:
+                continue
+            name = string.identifier.value
+            modifiers = {token.value for token in string.modifiers}
+            quality = "{} (quality {:d} of {:d})".format(format_atom(estimate.atom), estimate.quality, MAX_ATOM_QUALITY)
+            if not estimate.atom:
+                yield string, lsp.DiagnosticSeverity.WARNING, \
+                    "{} has no fixed bytes for YARA to pick an atom from, so it is checked at every offset of every file".format(name)
+            elif estimate.quality < WARNING_QUALITY:
+                yield string, lsp.DiagnosticSeverity.WARNING, \
+                    "{} may slow down scanning. The best atom YARA can pick from it is {}".format(name, quality)
+            elif string.value.kind == TokenKind.REGEX and LEADING_WILDCARD_PATTERN.match(string.value.value[1:]):
+                yield string, lsp.DiagnosticSeverity.WARNING, \
+                    "{} starts with a wildcard, so every match of its atom {} is extended backwards as far as YARA allows".format(
+                        name, format_atom(estimate.atom)
+                    )
+            elif string.value.kind == TokenKind.HEX and _starts_unanchored(parse_hex(string.value.value)):
+                yield string, lsp.DiagnosticSeverity.HINT, \
+                    "{} starts with a wildcard or jump, so every match of its atom {} has to be extended backwards".format(
+                        name, format_atom(estimate.atom)
+                    )
+            elif "nocase" in modifiers and string.value.kind == TokenKind.TEXT and len(_text_bytes(string.value.value)) < MIN_NOCASE_LENGTH:
+                yield string, lsp.DiagnosticSeverity.HINT, \
+                    "{} is a short {} string, so YARA searches for {:d} atoms like {}".format(
+                        name, " ".join(sorted(modifiers & {"nocase", "wide"}, reverse=True)), estimate.variants, quality
+                    )
+            elif estimate.quality < HINT_QUALITY:
+                yield string, lsp.DiagnosticSeverity.HINT, "{} has a weak atom: {}".format(name, quality)
+
+def _starts_unanchored(sequence: list) -> bool:
+    ''' Whether a hex sequence starts with a wildcard byte or a jump '''
+    return bool(sequence) and (sequence[0] is BREAK or isinstance(sequence[0], tuple) and sequence[0][1] != 0xFF)
+
+def atom_diagnostics(document: str) -> list:
+    '''Point out the strings that would slow down scanning, with the atom YARA is estimated to pick for each
+
+    :document: Contents of YARA rule file
+    '''
+    lines = get_line_index(document)
+    diagnostics = []
+    for string, severity, message in iter_findings(document):
+        symbol_range = lsp.Range(start=lines.position_at(string.value.start), end=lines.position_at(string.value.end))
+        diagnostics.append(lsp.Diagnostic(locrange=symbol_range, severity=severity, message=message))
+    return diagnostics
@@ -0,0 +1,420 @@
+''' Caches for results derived from rule file contents '''
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Iterable
+
+from yarals import protocol as lsp
+from yarals.workspace import RACY_NS
+
+# fraction of its maximum size the rules store is shrunk to when it is full
+EVICT_RATIO = 0.75
+
+
+def hash_text(text: str, salt: str="", encoding: str="utf-8") -> str:
+    '''Create a stable hash of some text
+
+    :text: Text to hash
+    :salt: (Optional) extra data that should change the hash, such as a library version
+    :encoding: (Optional) text encoding used to convert text to bytes
+    '''
+    digest = hashlib.sha256(salt.encode(encoding))
+    digest.update(text.encode(encoding, errors="surrogatepass"))
+    return digest.hexdigest()
+
+def save_rules(rules, path: Path):
+    '''Save compiled yara.Rules to a file without ever leaving a partial file behind
+
+    Safe to call from worker processes, even when several save the same rules at once
+
+    :rules: Compiled yara.Rules
+    :path: File to save them to
+    '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name, suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wb") as ofile:
+            rules.save(file=ofile)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class DiagnosticCache(object):
+    def __init__(self, maxsize: int=4096, path: Path=None):
+        ''' Bounded LRU cache of compile results keyed by a hash of the compiled text
+
+        When a path is given, the cache can be saved to and loaded from disk,
+        so results survive server restarts. Keys can be pinned, so the results
+        of every file in a workspace are kept however many others are cached
+        '''
+        self._logger = logging.getLogger("yara")
+        # key => list of Diagnostics. Most recently used keys are at the end
+        self._entries = OrderedDict()
+        # owner => set of keys it pinned
+        self._pinned = {}
+        # pinned key => number of owners pinning it
+        self._pin_counts = {}
+        # number of entries whose key is pinned
+        self._pinned_entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.maxsize = maxsize
+        self.path = path
+
+    def __contains__(self, key: str):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<DiagnosticCache(entries={:d}, maxsize={:d})>".format(len(self._entries), self.maxsize)
+
+    def get(self, key: str) -> list:
+        '''Get the diagnostics cached for a key, or None if the key is unknown
+
+        :key: Hash of the compiled text
+        '''
+        diagnostics = self._entries.get(key, None)
+        if diagnostics is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return list(diagnostics)
+
+    def put(self, key: str, diagnostics: list):
+        '''Cache the diagnostics for a key, evicting the least recently used entry if full
+
+        :key: Hash of the compiled text
+        :diagnostics: List of Diagnostics produced by compiling the text
+        '''
+        if key not in self._entries and key in self._pin_counts:
+            self._pinned_entries += 1
+        self._entries[key] = list(diagnostics)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        ''' Evict the least recently used entries that aren't pinned until the cache fits '''
+        # pinned entries don't count towards maxsize, so there is always an unpinned entry to evict
+        while len(self._entries) - self._pinned_entries > self.maxsize:
+            key = next(iter(self._entries))
+            if key in self._pin_counts:
+                self._entries.move_to_end(key)
+            else:
+                del self._entries[key]
+
+    def _add_pin(self, key: str):
+        ''' Count one more owner pinning a key '''
+        count = self._pin_counts.get(key, 0)
+        self._pin_counts[key] = count + 1
+        if count == 0 and key in self._entries:
+            self._pinned_entries += 1
+
+    def _drop_pin(self, key: str):
+        ''' Count one less owner pinning a key '''
+        count = self._pin_counts.pop(key) - 1
+        if count > 0:
+            self._pin_counts[key] = count
+        elif key in self._entries:
+            self._pinned_entries -= 1
+
+    def clear(self):
+        ''' Remove all entries '''
+        self._entries.clear()
+        self._pinned_entries = 0
+
+    def pin(self, owner, keys: Iterable[str], replace: bool=True):
+        '''Keep the entries of some keys, however many other entries are added
+
+        Each owner has a single set of pinned keys. Pinned keys don't count towards maxsize
+
+        :owner: Whatever needs the keys, such as the root of a workspace
+        :keys: Keys to keep. Keys may be pinned before anything is cached for them
+        :replace: (Optional) unpin the keys the owner pinned before. Otherwise the keys are added to them
+        '''
+        keys = set(keys)
+        pinned = self._pinned.pop(owner, set())
+        if replace:
+            for key in pinned - keys:
+                self._drop_pin(key)
+            pinned &= keys
+        for key in keys - pinned:
+            self._add_pin(key)
+        pinned |= keys
+        if pinned:
+            self._pinned[owner] = pinned
+        else:
+            self._pinned.pop(owner, None)
+        self._evict()
+
+    def resize(self, maxsize: int):
+        '''Change how many entries are kept besides the pinned ones, evicting entries if needed
+
+        :maxsize: Number of entries to keep
+        '''
+        self.maxsize = maxsize
+        self._evict()
+
+    def load(self):
+        ''' Replace the cached entries with the contents of the cache file, if it exists '''
+        if self.path is None or not self.path.is_file():
+            return
+        try:
+            entries = json.loads(self.path.read_text())
+            self.clear()
+            for key, diagnostics in entries.items():
+                self.put(key, [
+                    lsp.Diagnostic(
+                        locrange=lsp.Range(
+                            start=lsp.Position(line=start_line, char=start_char),
+                            end=lsp.Position(line=end_line, char=end_char)
+                        ),
+                        severity=severity,
+                        message=message
+                    ) for start_line, start_char, end_line, end_char, severity, message in diagnostics
+                ])
+            self._logger.info("Loaded %d compile results from %s", len(self._entries), self.path)
+        except (OSError, TypeError, ValueError) as err:
+            self._logger.warning("Could not load compile cache %s: %s", self.path, err)
+
+    def save(self):
+        ''' Write all cached entries to the cache file '''
+        if self.path is None:
+            return
+        entries = OrderedDict()
+        # snapshot the entries, since saves can run on another thread
+        for key, diagnostics in list(self._entries.items()):
+            entries[key] = [
+                (diag.range.start.line, diag.range.start.char, diag.range.end.line, diag.range.end.char, diag.severity, diag.message)
+                for diag in diagnostics
+            ]
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so an interrupted save never leaves a corrupt cache behind
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(entries))
+            tmp_path.replace(self.path)
+        except OSError as err:
+            self._logger.warning("Could not save compile cache %s: %s", self.path, err)
+
+
+class FileCache(object):
+    def __init__(self, maxsize: int=1024):
+        ''' Bounded LRU cache of the text of files on disk
+
+        Entries are checked against the file's modification time and size
+        on every read, so a changed file is always read again. Files
+        modified just before they were read are not cached, since they
+        may change again without their modification time changing
+        '''
+        # file path => (mtime_ns, size, text). Most recently used paths are at the end
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.maxsize = maxsize
+
+    def __contains__(self, file_path: str):
+        return file_path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<FileCache(entries={:d}, maxsize={:d})>".format(len(self._entries), self.maxsize)
+
+    def clear(self):
+        ''' Remove all entries '''
+        self._entries.clear()
+
+    def read(self, file_path: str) -> str:
+        '''Get the text of a file, reading it only if it changed since it was cached
+
+        Raises OSError if the file cannot be read
+
+        :file_path: Path of the file to read
+        '''
+        stat = os.stat(file_path)
+        entry = self._entries.get(file_path, None)
+        if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            self.hits += 1
+            self._entries.move_to_end(file_path)
+            return entry[2]
+        self.misses += 1
+        with open(file_path, "r") as rule_file:
+            text = rule_file.read()
+        if stat.st_mtime_ns < time.time_ns() - RACY_NS:
+            self._entries[file_path] = (stat.st_mtime_ns, stat.st_size, text)
+            self._entries.move_to_end(file_path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.pop(file_path, None)
+        return text
+
+
+class RulesStore(object):
+    def __init__(self, path: Path=None, max_bytes: int=64 * 2**20):
+        ''' Folder of compiled yara.Rules saved by Rules.save(), keyed like compile results
+
+        Artifacts are loaded with yara.load() instead of compiling the
+        same text again. The least recently used artifacts are deleted once
+        the folder grows past max_bytes. Nothing is stored without a path
+        '''
+        self._logger = logging.getLogger("yara")
+        self._lock = threading.Lock()
+        self.path = path
+        self.max_bytes = max_bytes
+        # total size of the artifacts, counted the first time an artifact is added
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str):
+        artifact = self.artifact(key)
+        return artifact is not None and artifact.is_file()
+
+    def __repr__(self):
+        return "<RulesStore(path={}, max_bytes={:d})>".format(self.path, self.max_bytes)
+
+    def configure(self, path: Path=None, max_bytes: int=None):
+        '''Move the store to another folder, or change how big it may grow
+
+        :path: (Optional) folder to save artifacts to. Nothing is stored without one
+        :max_bytes: (Optional) total size the artifacts may take up
+        '''
+        with self._lock:
+            if path != self.path:
+                self.path = path
+                self._size = None
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+
+    def artifact(self, key: str) -> Path:
+        '''Get the file compiled rules for a key are saved to, or None if nothing is stored
+
+        :key: Hash of the compiled text
+        '''
+        if self.path is None or self.max_bytes <= 0:
+            return None
+        return Path(self.path).joinpath(key + ".yarc")
+
+    def get(self, key: str):
+        '''Load the compiled rules saved for a key, or None if there are none
+
+        :key: Hash of the compiled text
+        '''
+        artifact = self.artifact(key)
+        if artifact is None:
+            return None
+        if not artifact.is_file():
+            self.misses += 1
+            return None
+        # the loader is imported here, since the compiler imports this module
+        from yarals.compiler import load_yara
+        yara = load_yara()
+        try:
+            rules = yara.load(str(artifact))
+            # eviction goes by modification time, so loading counts as using it
+            os.utime(str(artifact))
+        except (OSError, yara.Error) as err:
+            self._logger.warning("Could not load compiled rules %s: %s", artifact, err)
+            self._remove(artifact)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rules
+
+    def put(self, key: str, rules):
+        '''Save compiled rules for a key, evicting the least recently used artifacts if the store is full
+
+        :key: Hash of the compiled text
+        :rules: Compiled yara.Rules
+        '''
+        artifact = self.artifact(key)
+        if artifact is None:
+            return
+        try:
+            save_rules(rules, artifact)
+        except OSError as err:
+            self._logger.warning("Could not save compiled rules %s: %s", artifact, err)
+            return
+        self.added(key)
+
+    def added(self, key: str):
+        '''Account for an artifact saved by another process, evicting artifacts if the store is full
+
+        :key: Hash of the compiled text
+        '''
+        artifact = self.artifact(key)
+        if artifact is None:
+            return
+        try:
+            size = artifact.stat().st_size
+        except OSError:
+            # the file did not compile, so nothing was saved
+            return
+        with self._lock:
+            if self._size is None:
+                # artifacts may be left over from earlier runs
+                self._size = sum(size for _, size, _ in self._scan())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict(artifact)
+
+    def _scan(self) -> list:
+        ''' List the (path, size, mtime_ns) of every artifact '''
+        artifacts = []
+        try:
+            with os.scandir(str(self.path)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".yarc"):
+                        try:
+                            stat = entry.stat()
+                            artifacts.append((Path(entry.path), stat.st_size, stat.st_mtime_ns))
+                        except OSError:
+                            continue
+        except OSError as err:
+            self._logger.warning("Could not list compiled rules in %s: %s", self.path, err)
+        return artifacts
+
+    def _evict(self, keep: Path):
+        ''' Delete the least recently used artifacts until the store is well under max_bytes again '''
+        artifacts = sorted(self._scan(), key=lambda artifact: artifact[2])
+        self._size = sum(size for _, size, _ in artifacts)
+        # leave some room, so the folder isn't listed again on every save once it is full
+        target = self.max_bytes * EVICT_RATIO
+        for path, size, _ in artifacts:
+            if self._size <= target:
+                break
+            # the artifact that was just added is kept, even when it is bigger than the whole store
+            if path != keep and self._remove(path):
+                self._size -= size
+        self._logger.debug("Compiled rules in %s take up %d bytes after eviction", self.path, self._size)
+
+    def _remove(self, artifact: Path) -> bool:
+        try:
+            artifact.unlink()
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        ''' Delete every artifact '''
+        if self.path is None:
+            return
+        with self._lock:
+            for path, _, _ in self._scan():
+                self._remove(path)
+            self._size = 0
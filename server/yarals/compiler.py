@@ -0,0 +1,289 @@
+''' Compile YARA rules and convert the results into diagnostics '''
+import asyncio
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import importlib.util
+from itertools import chain
+import logging
+import os
+import re
+import time
+
+from yarals import helpers
+from yarals.atoms import atom_diagnostics
+from yarals import protocol as lsp
+from yarals.cache import DiagnosticCache, RulesStore, hash_text, save_rules
+from yarals.document import get_line_index
+from yarals.includes import IncludeCallback, load_includes
+from yarals.metrics import Histogram
+from yarals.parser import get_syntax_tree
+
+# errors inside included files are reported as "{requested path}({line number}): {message}"
+INCLUDE_RESULT_PATTERN = re.compile(r"^(.+)\((\d+)\): (.*)$", re.DOTALL)
+
+# bumped whenever the diagnostics produced for the same text change, so cached results are not reused
+DIAGNOSTICS_VERSION = 3
+
+# only check whether yara-python is installed here. It is imported the first time
+# something is compiled, so the server can start answering requests sooner
+HAS_YARA = importlib.util.find_spec("yara") is not None
+
+
+@lru_cache(maxsize=1)
+def load_yara():
+    ''' Import yara-python on first use '''
+    import yara
+    return yara
+
+def get_yara_version() -> str:
+    ''' Version of yara-python, or an empty string if it is not installed '''
+    return load_yara().__version__ if HAS_YARA else ""
+
+
+def _to_diagnostic(result: str, severity: lsp.DiagnosticSeverity, document: str, callback: IncludeCallback=None) -> lsp.Diagnostic:
+    ''' Convert a YARA compilation error or warning into a diagnostic '''
+    match = INCLUDE_RESULT_PATTERN.match(result)
+    if match is None:
+        line_no, msg = helpers.parse_result(result)
+        # VSCode is zero-indexed
+        line_no -= 1
+    else:
+        # point at the include statement that pulled in the file with the error
+        requested, included_line, msg = match.groups()
+        msg = "{} ({} line {})".format(msg.strip(), requested, included_line)
+        line_no = _include_line(document, None if callback is None else callback.origin(requested))
+    first_char = helpers.get_first_non_whitespace_index(get_line_index(document).get_line(line_no))
+    symbol_range = lsp.Range(
+        start=lsp.Position(line_no, first_char),
+        end=lsp.Position(line_no, 10000)
+    )
+    return lsp.Diagnostic(locrange=symbol_range, severity=severity, message=msg)
+
+def _include_line(document: str, requested: str) -> int:
+    ''' Find the line of the include statement for a requested path, or the first line if there is none '''
+    for node in get_syntax_tree(document).includes:
+        if node.module == requested:
+            return get_line_index(document).position_at(node.token.start).line
+    return 0
+
+def compile_diagnostics(document: str, file_uri: str=None, sources: dict=None, encoding: str="utf-8", artifact: str=None) -> list:
+    '''Compile a YARA rule file and return any errors or warnings as diagnostics
+
+    The rules are compiled into a namespace named after the file's URI
+
+    :document: Contents of YARA rule file
+    :file_uri: (Optional) URI of the rule file, which relative include paths are resolved against
+    :sources: (Optional) dictionary of file_uri => text of the files it includes. See load_includes()
+    :encoding: (Optional) string encoding to parse URIs with
+    :artifact: (Optional) file to save the compiled rules to, if the file compiles
+    '''
+    diagnostics = []
+    yara = load_yara()
+    # includes are only ever answered from the sources, never from the server's working directory
+    callback = IncludeCallback(file_uri, sources or {}, encoding)
+    try:
+        rules = yara.compile(sources={file_uri or "default": document}, include_callback=callback)
+        if artifact is not None:
+            try:
+                save_rules(rules, artifact)
+            except OSError as err:
+                logging.getLogger("yara").warning("Could not save compiled rules %s: %s", artifact, err)
+    except yara.SyntaxError as error:
+        diagnostics.append(_to_diagnostic(str(error), lsp.DiagnosticSeverity.ERROR, document, callback))
+    except yara.WarningError as warning:
+        diagnostics.append(_to_diagnostic(str(warning), lsp.DiagnosticSeverity.WARNING, document, callback))
+    if callback.missing:
+        # YARA only reports the last error, which is rarely the missing include that caused it
+        diagnostics = [diag for diag in diagnostics if "include resource" not in diag.message]
+        for requested in callback.missing:
+            line_no = _include_line(document, callback.origin(requested))
+            symbol_range = lsp.Range(start=lsp.Position(line_no, 0), end=lsp.Position(line_no, 10000))
+            msg = "can't open include file: {}".format(requested)
+            diagnostics.insert(0, lsp.Diagnostic(locrange=symbol_range, severity=lsp.DiagnosticSeverity.ERROR, message=msg))
+    # strings that would slow down scanning, which YARA doesn't report on its own.
+    # Files that don't compile only get their errors, since the strings may be what is broken
+    if not any(diag.severity == lsp.DiagnosticSeverity.ERROR for diag in diagnostics):
+        diagnostics.extend(atom_diagnostics(document))
+    return diagnostics
+
+def compile_file(file_uri: str, document: str=None, encoding: str="utf-8", sources: dict=None, artifact: str=None) -> list:
+    '''Compile a single rule file. Meant to be run inside of a worker process
+
+    :file_uri: URI of the rule file
+    :document: (Optional) contents of the file. Read from disk if not provided
+    :encoding: (Optional) text encoding of the file on disk
+    :sources: (Optional) dictionary of file_uri => text of the files it includes
+    :artifact: (Optional) file to save the compiled rules to, if the file compiles
+    '''
+    if document is None:
+        document = read_file(file_uri, encoding)
+    return compile_diagnostics(document, file_uri, sources, encoding, artifact)
+
+def get_cache_key(document: str, sources: dict=None) -> str:
+    '''Key compile results by the compiled text, the text of its includes and the version of YARA compiling it
+
+    :document: Contents of YARA rule file
+    :sources: (Optional) dictionary of file_uri => text of the files it includes
+    '''
+    if sources:
+        document = "\0".join(chain([document], chain.from_iterable(sources.items())))
+    # compile results can change between YARA versions, so cached results are keyed on it too
+    return hash_text(document, salt="{}:{:d}".format(get_yara_version(), DIAGNOSTICS_VERSION))
+
+def get_rules_key(key: str, file_uri: str=None) -> str:
+    '''Key compiled rules by the compiled text and the namespace it was compiled into
+
+    :key: Cache key of the compiled text. See get_cache_key()
+    :file_uri: (Optional) URI of the rule file, which names the namespace
+    '''
+    return hash_text(key, salt=file_uri or "default")
+
+def read_file(file_uri: str, encoding: str="utf-8") -> str:
+    '''Read a rule file from disk
+
+    :file_uri: URI of the rule file
+    :encoding: (Optional) text encoding of the file on disk
+    '''
+    file_path = helpers.parse_uri(file_uri, encoding=encoding)
+    with open(file_path, "rb") as ifile:
+        return ifile.read().decode(encoding, errors="replace")
+
+def _load_file(file_uri: str, document: str, encoding: str, overlay: dict=None) -> tuple:
+    ''' Read a file and its includes if necessary and hash their contents. Meant to be run in a thread '''
+    if document is None:
+        document = read_file(file_uri, encoding)
+    overlay = overlay or {}
+    read = lambda include_uri: overlay[include_uri] if include_uri in overlay else read_file(include_uri, encoding)
+    sources = load_includes(file_uri, document, read, encoding) if file_uri else {}
+    return document, sources, get_cache_key(document, sources)
+
+
+class CompileEngine(object):
+    def __init__(self, max_workers: int=None, cache: DiagnosticCache=None, rules: RulesStore=None):
+        ''' Shards compilation of many rule files across a pool of worker processes
+
+        The pool is only started the first time it is needed, and defaults
+        to one worker per CPU core. Text that was already compiled is answered
+        from the cache instead of being compiled again. Files that compile
+        are saved to the rules store, so they can be loaded instead of compiled again
+        '''
+        self._logger = logging.getLogger("yara")
+        self.cache = DiagnosticCache() if cache is None else cache
+        self.rules = RulesStore() if rules is None else rules
+        self._pool = None
+        # single documents are compiled one at a time on a background thread
+        self._thread = ThreadPoolExecutor(max_workers=1)
+        self.max_workers = max_workers
+        # time spent compiling text that was not in the cache
+        self.compile_times = Histogram()
+
+    @property
+    def pool(self):
+        ''' Process pool used to run compilations '''
+        if self._pool is None:
+            # multiprocessing is slow to import, so wait until a pool is actually needed
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    async def _compile(self, file_uri: str, document: str, encoding: str, limit: asyncio.Semaphore, keys: dict, overlay: dict, owner) -> tuple:
+        ''' Compile a single file in the pool, logging instead of raising errors '''
+        loop = asyncio.get_event_loop()
+        try:
+            # limit the number of files held in memory at once
+            async with limit:
+                known = keys.get(file_uri, None) if document is None else None
+                diagnostics = None if known is None else self.cache.get(known)
+                if diagnostics is None:
+                    document, sources, key = await loop.run_in_executor(None, _load_file, file_uri, document, encoding, overlay)
+                    if sources:
+                        # the file can't be known to be unchanged without reading what it includes
+                        keys.pop(file_uri, None)
+                    else:
+                        keys[file_uri] = key
+                    if owner is not None:
+                        self.cache.pin(owner, (key,), replace=False)
+                    if key != known:
+                        diagnostics = self.cache.get(key)
+                if diagnostics is None:
+                    start = time.perf_counter()
+                    rules_key = get_rules_key(key, file_uri)
+                    artifact = self.rules.artifact(rules_key)
+                    diagnostics = await loop.run_in_executor(
+                        self.pool, compile_file, file_uri, document, encoding, sources, None if artifact is None else str(artifact)
+                    )
+                    self.compile_times.record((time.perf_counter() - start) * 1000)
+                    self.cache.put(key, diagnostics)
+                    self.rules.added(rules_key)
+            return file_uri, diagnostics
+        except BrokenExecutor as err:
+            # a worker died (e.g. a crash inside libyara). Start a new pool for the next compile
+            self._logger.error("Compile worker exited unexpectedly while compiling %s: %s", file_uri, err)
+            self._pool = None
+        except Exception as err:
+            self._logger.error("Could not compile %s: %s", file_uri, err)
+        return file_uri, None
+
+    async def compile(self, document: str, file_uri: str=None, encoding: str="utf-8", overlay: dict=None, store_rules: bool=False) -> list:
+        '''Compile a single document without blocking the event loop
+
+        :document: Contents of YARA rule file
+        :file_uri: (Optional) URI of the rule file, which relative include paths are resolved against
+        :encoding: (Optional) text encoding of included files on disk
+        :overlay: (Optional) dictionary of file_uri => text of open documents, used instead of their on-disk contents
+        :store_rules: (Optional) save the compiled rules to the rules store. Off by default,
+            since most of the text compiled as the user types is never scanned with
+        '''
+        loop = asyncio.get_event_loop()
+        document, sources, key = await loop.run_in_executor(self._thread, _load_file, file_uri, document, encoding, overlay)
+        diagnostics = self.cache.get(key)
+        rules_key = get_rules_key(key, file_uri)
+        artifact = self.rules.artifact(rules_key) if store_rules else None
+        # text compiled as it was typed has its diagnostics cached but its rules not saved
+        if diagnostics is not None and artifact is not None and rules_key not in self.rules:
+            if not any(diag.severity == lsp.DiagnosticSeverity.ERROR for diag in diagnostics):
+                diagnostics = None
+        if diagnostics is None:
+            start = time.perf_counter()
+            diagnostics = await loop.run_in_executor(self._thread, compile_diagnostics, document, file_uri, sources, encoding, artifact)
+            self.compile_times.record((time.perf_counter() - start) * 1000)
+            self.cache.put(key, diagnostics)
+            self.rules.added(rules_key)
+        return diagnostics
+
+    async def compile_all(self, files: dict, encoding: str="utf-8", keys: dict=None, overlay: dict=None, owner=None):
+        '''Compile many files in parallel, yielding (file_uri, diagnostics) as each file finishes
+
+        Files that could not be compiled at all are skipped
+
+        :files: Dictionary of file_uri => document text. Text may be None to have workers read the file from disk
+        :encoding: (Optional) text encoding of files on disk
+        :keys: (Optional) dictionary of file_uri => cache key for files on disk that are known
+               to be unchanged. Their cached results are used without reading them. The keys
+               of every file that had to be read are added to it, unless the file includes others
+        :overlay: (Optional) dictionary of file_uri => text of open documents, used instead of their on-disk contents
+        :owner: (Optional) the results of every file are pinned in the cache for this owner. See DiagnosticCache.pin()
+        '''
+        keys = {} if keys is None else keys
+        limit = asyncio.Semaphore((self.max_workers or os.cpu_count() or 1) * 4)
+        pending = {
+            asyncio.ensure_future(self._compile(file_uri, document, encoding, limit, keys, overlay, owner))
+            for file_uri, document in files.items()
+        }
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    file_uri, diagnostics = task.result()
+                    if diagnostics is not None:
+                        yield file_uri, diagnostics
+        finally:
+            # the caller stopped early or was cancelled, so nobody wants the remaining results
+            for task in pending:
+                task.cancel()
+
+    def shutdown(self):
+        ''' Stop all worker processes '''
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -0,0 +1,99 @@
+''' Completion items for module members, precomputed from the modules schema '''
+from bisect import bisect_left
+from typing import List
+
+from yarals import protocol as lsp
+
+
+def get_item_kind(kind_str) -> lsp.CompletionItemKind:
+    '''Convert a kind from the modules schema to a completion item kind
+
+    :kind_str: Kind string from the schema. Nested objects (dictionaries) are classes
+    '''
+    kind_str = str(kind_str).lower()
+    if kind_str == "enum":
+        return lsp.CompletionItemKind.ENUM
+    elif kind_str == "property":
+        return lsp.CompletionItemKind.PROPERTY
+    elif kind_str == "method":
+        return lsp.CompletionItemKind.METHOD
+    return lsp.CompletionItemKind.CLASS
+
+
+class CompletionEntry(object):
+    __slots__ = ("data", "items", "labels")
+
+    def __init__(self, members: dict):
+        ''' Serialized completion items for the members of one module or structure
+
+        Items are encoded to JSON once. A sorted index of lowercase labels
+        is kept alongside them to find the items matching a typed prefix
+        '''
+        encoded = [
+            (label.lower(), lsp.dumps(lsp.CompletionItem(label, get_item_kind(kind)).to_dict()))
+            for label, kind in members.items()
+        ]
+        # the full list keeps the schema's order
+        self.data = lsp.RawJSON(b"[" + b",".join(item for _, item in encoded) + b"]")
+        encoded.sort(key=lambda pair: pair[0])
+        self.labels = [label for label, _ in encoded]
+        self.items = [item for _, item in encoded]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "<CompletionEntry(items={:d})>".format(len(self.items))
+
+    def filter(self, prefix: str) -> lsp.RawJSON:
+        '''Get the items whose label starts with a prefix, ignoring case
+
+        :prefix: Partially typed member name
+        '''
+        prefix = prefix.lower()
+        start = bisect_left(self.labels, prefix)
+        end = bisect_left(self.labels, prefix + "\U0010ffff", lo=start)
+        return lsp.RawJSON(b"[" + b",".join(self.items[start:end]) + b"]")
+
+
+class CompletionTable(object):
+    def __init__(self, schema: dict):
+        ''' Completion items for every module and structure in the modules schema
+
+        Entries are keyed by dotted path, such as "pe" or "pe.data_directories",
+        so offering completions is a dictionary lookup
+        '''
+        # dotted path => CompletionEntry
+        self._entries = {}
+        self._add(schema, [])
+
+    def __contains__(self, path: str):
+        return path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<CompletionTable(paths={:d})>".format(len(self._entries))
+
+    def _add(self, members: dict, path: List[str]):
+        ''' Add entries for a schema object and every object nested in it '''
+        for name, value in members.items():
+            if isinstance(value, dict):
+                self._entries[".".join(path + [name])] = CompletionEntry(value)
+                self._add(value, path + [name])
+
+    def get(self, symbol: str) -> lsp.RawJSON:
+        '''Get the serialized completion items for a symbol, or None if nothing can complete it
+
+        :symbol: Dotted path of a module or structure ("pe.data_directories"),
+                 optionally followed by a partially typed member ("pe.data_d")
+        '''
+        entry = self._entries.get(symbol, None)
+        if entry is not None:
+            return entry.data
+        path, _, prefix = symbol.rpartition(".")
+        entry = self._entries.get(path, None)
+        if entry is not None and prefix:
+            return entry.filter(prefix)
+        return None
@@ -22,5 +22,8 @@ class NoYaraPython(Exception):
 class RenameError(Exception):
     pass
 
+class ScanError(Exception):
+    pass
+
 class SymbolReferenceError(Exception):
     pass
@@ -0,0 +1,209 @@
+''' In-memory text documents synchronized with the client '''
+from bisect import bisect_right
+from functools import lru_cache
+import re
+from typing import Iterator, List
+
+from yarals import protocol as lsp
+
+
+# the protocol only recognizes these three line terminators
+EOL_PATTERN = re.compile(r"(\r\n|\r|\n)")
+
+
+def split_lines(text: str) -> List[str]:
+    '''Split text into lines, keeping the line terminators attached
+
+    The last element never ends with a terminator, so a document ending
+    with a newline has a trailing empty line, just like an editor shows it
+
+    :text: Text to split
+    '''
+    parts = EOL_PATTERN.split(text)
+    # re.split() with a capture group alternates text and terminators, always ending with text
+    lines = [parts[index] + parts[index+1] for index in range(0, len(parts) - 1, 2)]
+    lines.append(parts[-1])
+    return lines
+
+
+@lru_cache(maxsize=8)
+def get_line_index(text: str):
+    '''Get the line index for a given document text
+
+    Indexes are cached by the text itself. Buffers hand out the same string
+    object until their next edit, so every request made against one version
+    of a document shares a single index
+
+    :text: Full document text
+    '''
+    return LineIndex(text)
+
+
+class LineIndex(object):
+    def __init__(self, text: str):
+        ''' Table of line start offsets into a document
+
+        Converts between offsets and (line, character) positions without
+        splitting the document into separate line strings
+        '''
+        self.text = text
+        self._starts = [0]
+        self._starts.extend(match.end() for match in EOL_PATTERN.finditer(text))
+
+    def __repr__(self):
+        return "<LineIndex(lines={:d})>".format(len(self._starts))
+
+    @property
+    def line_count(self) -> int:
+        ''' Number of lines in the document '''
+        return len(self._starts)
+
+    def line_span(self, line: int) -> tuple:
+        '''Get the start and end offsets of a line, excluding its terminator
+
+        :line: Zero-based line number
+        '''
+        if line < 0 or line >= len(self._starts):
+            raise IndexError("line {:d} is out of range".format(line))
+        start = self._starts[line]
+        if line + 1 < len(self._starts):
+            end = self._starts[line+1]
+            # strip the terminator from the end of the line
+            if self.text[end-1] == "\n":
+                end -= 1
+            if end > start and self.text[end-1] == "\r":
+                end -= 1
+        else:
+            end = len(self.text)
+        return start, end
+
+    def get_line(self, line: int) -> str:
+        '''Get a single line of text without its terminator
+
+        :line: Zero-based line number
+        '''
+        start, end = self.line_span(line)
+        return self.text[start:end]
+
+    def iter_lines(self, start: int=0, end: int=None) -> Iterator[str]:
+        '''Iterate over a range of lines without their terminators
+
+        :start: First line to return
+        :end: (Optional) line to stop before. Defaults to the end of the document
+        '''
+        end = len(self._starts) if end is None else min(end, len(self._starts))
+        for line in range(max(start, 0), end):
+            yield self.get_line(line)
+
+    def offset_at(self, pos: lsp.Position) -> int:
+        '''Convert a position to an offset, clamping it to the document bounds
+
+        :pos: Position to convert
+        '''
+        if pos.line < 0:
+            return 0
+        elif pos.line >= len(self._starts):
+            return len(self.text)
+        start, end = self.line_span(pos.line)
+        return start + max(0, min(pos.char, end - start))
+
+    def position_at(self, offset: int) -> lsp.Position:
+        '''Convert an offset into the document to a position
+
+        :offset: Character offset into the document
+        '''
+        offset = max(0, min(offset, len(self.text)))
+        line = bisect_right(self._starts, offset) - 1
+        return lsp.Position(line=line, char=offset - self._starts[line])
+
+
+class TextDocument(object):
+    def __init__(self, uri: str, text: str, version: int=0):
+        ''' Line-indexed buffer holding the client's copy of a document
+
+        Edits are applied in place to the lines they touch, so incremental
+        changes cost time proportional to the edit rather than the file
+        '''
+        self.uri = str(uri)
+        self.version = int(version or 0)
+        self._lines = split_lines(text)
+        self._text = text
+
+    def __len__(self):
+        return len(self.text)
+
+    def __repr__(self):
+        return "<TextDocument(uri={}, version={:d}, lines={:d})>".format(self.uri, self.version, len(self._lines))
+
+    def __str__(self):
+        return self.text
+
+    @property
+    def line_count(self) -> int:
+        ''' Number of lines in the document '''
+        return len(self._lines)
+
+    @property
+    def index(self) -> LineIndex:
+        ''' Line index for the current version of the document '''
+        return get_line_index(self.text)
+
+    @property
+    def text(self) -> str:
+        ''' Full document text. Only joined together once per version '''
+        if self._text is None:
+            self._text = "".join(self._lines)
+        return self._text
+
+    def _clamp(self, line: int, char: int) -> tuple:
+        ''' Clamp a position to the bounds of the document '''
+        if line < 0:
+            return 0, 0
+        elif line >= len(self._lines):
+            last = len(self._lines) - 1
+            return last, len(self._lines[last])
+        content = self._lines[line].rstrip("\r\n")
+        return line, max(0, min(char, len(content)))
+
+    def apply_change(self, change: dict, version: int=None):
+        '''Apply a single TextDocumentContentChangeEvent
+
+        :change: Dictionary with a "text" key and an optional "range" key.
+                 When no range is given the full document text is replaced
+        :version: (Optional) document version after this change
+        '''
+        text = change.get("text", "")
+        locrange = change.get("range", None)
+        if locrange is None:
+            self._lines = split_lines(text)
+            self._text = text
+        else:
+            start_line, start_char = self._clamp(locrange["start"]["line"], locrange["start"]["character"])
+            end_line, end_char = self._clamp(locrange["end"]["line"], locrange["end"]["character"])
+            if (end_line, end_char) < (start_line, start_char):
+                start_line, start_char, end_line, end_char = end_line, end_char, start_line, start_char
+            prefix = self._lines[start_line][:start_char]
+            # a lone carriage return on the previous line could merge with a leading newline
+            if start_line > 0 and self._lines[start_line-1].endswith("\r"):
+                start_line -= 1
+                prefix = self._lines[start_line] + prefix
+            suffix = self._lines[end_line][end_char:]
+            replacement = split_lines(prefix + text + suffix)
+            # the last edited line is followed by other lines, so it keeps its terminator
+            if end_line < len(self._lines) - 1 and replacement[-1] == "":
+                replacement.pop()
+            self._lines[start_line:end_line+1] = replacement
+            self._text = None
+        if version is not None:
+            self.version = int(version)
+
+    def apply_changes(self, changes: List[dict], version: int=None):
+        '''Apply a list of content changes in the order they were sent
+
+        :changes: List of TextDocumentContentChangeEvent dictionaries
+        :version: (Optional) document version after all changes
+        '''
+        for change in changes:
+            self.apply_change(change)
+        if version is not None:
+            self.version = int(version)
@@ -3,9 +3,16 @@ import platform
 import re
 from typing import Tuple
 from urllib.parse import quote, unquote, urlsplit
-from urllib.request import url2pathname
 
 from yarals import protocol as lsp
+from yarals.document import get_line_index
+
+# urllib.request picks one of these the same way, but takes a long time to import
+if platform.system() == "Windows":
+    from nturl2path import url2pathname
+else:
+    def url2pathname(pathname: str) -> str:
+        return unquote(pathname)
 
 
 def create_file_uri(path: str):
@@ -30,25 +37,25 @@ def get_rule_range(document: str, pos: lsp.Position) -> lsp.Range:
     '''Get the range of the YARA rule that a given symbol is in
 
     :document: Text to search in
-               To determine line numbers, text is split at newlines, and carriage returns are ignored
+               To determine line numbers, the document's cached line index is used, so line terminators are ignored
     :pos: Symbol position to base range off of
     '''
     start_pattern = re.compile(r"^((private|global) )?rule\b")
     end_pattern = re.compile("^}$")
-    lines = document.replace("\r", "").split("\n")
+    lines = get_line_index(document)
     # default to assuming the entire document is within range
     start_pos = lsp.Position(line=0, char=0)
-    end_pos = lsp.Position(line=len(lines), char=0)
+    end_pos = lsp.Position(line=lines.line_count, char=0)
     # work backwards from the given position and find the start of rule
-    for index in range(pos.line, 0, -1):
-        line = lines[index]
+    for index in range(min(pos.line, lines.line_count - 1), 0, -1):
+        line = lines.get_line(index)
         match = start_pattern.match(line)
         if match:
             start_pos = lsp.Position(line=index, char=0)
             break
     # start from the given position and find the first end of rule
-    for index in range(pos.line, len(lines)):
-        line = lines[index]
+    for index in range(pos.line, lines.line_count):
+        line = lines.get_line(index)
         match = end_pattern.match(line)
         if match:
             end_pos = lsp.Position(line=index, char=0)
@@ -79,11 +86,11 @@ def resolve_symbol(document: str, pos: lsp.Position) -> str:
     '''Resolve a symbol located at the given position
 
     :document: Text to search in
-               To determine line numbers, text is split at newlines, and carriage returns are ignored
+               To determine line numbers, the document's cached line index is used, so line terminators are ignored
     :pos: Symbol position to base range off of
     '''
     try:
-        symbol_line = document.split("\n")[pos.line]
+        symbol_line = get_line_index(document).get_line(pos.line)
         line_end = len(symbol_line)
         # find the left-bound of the symbol by looking backwards until a whitespace
         index = pos.char - 1
@@ -0,0 +1,214 @@
+''' Resolve include statements and track which rule files include which '''
+from collections import OrderedDict
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List
+
+from yarals import helpers
+from yarals.parser import SyntaxTree, get_syntax_tree
+
+
+def resolve_include(file_uri: str, name: str, encoding: str="utf-8") -> str:
+    '''Find the file an include statement refers to
+
+    Relative paths are resolved against the folder of the including file,
+    the same way YARA resolves them. Returns the URI of the included file,
+    or None if it cannot be resolved (e.g. the including file is unsaved)
+
+    :file_uri: URI of the file containing the include statement
+    :name: Path given in the include statement
+    :encoding: (Optional) string encoding to parse the URI with
+    '''
+    if os.path.isabs(name):
+        path = name
+    else:
+        file_path = helpers.parse_uri(file_uri, encoding=encoding)
+        if not file_path or not os.path.isabs(file_path):
+            return None
+        path = os.path.join(os.path.dirname(file_path), name)
+    return Path(os.path.normpath(path)).as_uri()
+
+def has_includes(document: str) -> bool:
+    '''Check whether a document might contain include statements, without parsing it
+
+    May be wrong about documents mentioning the word "include" elsewhere,
+    but never about documents that do include other files
+
+    :document: Text of the document
+    '''
+    return "include" in document
+
+def find_includes(file_uri: str, document: str, encoding: str="utf-8", tree: SyntaxTree=None) -> List[str]:
+    '''Resolve every include statement in a document
+
+    :file_uri: URI of the document
+    :document: Text of the document
+    :encoding: (Optional) string encoding to parse URIs with
+    :tree: (Optional) syntax tree of the document. Defaults to the cached tree
+    '''
+    includes = []
+    # most rule files don't include anything, and don't need to be parsed to find that out
+    if not has_includes(document):
+        return includes
+    tree = get_syntax_tree(document) if tree is None else tree
+    for node in tree.includes:
+        include_uri = resolve_include(file_uri, node.module, encoding)
+        if include_uri is not None and include_uri not in includes:
+            includes.append(include_uri)
+    return includes
+
+def load_includes(file_uri: str, document: str, read: Callable[[str], str], encoding: str="utf-8") -> Dict[str, str]:
+    '''Read every file a document includes, directly or through other included files
+
+    Returns a dictionary of file_uri => text, in the order the files were found.
+    Files that cannot be read are left out, so compiling reports them as missing
+
+    :file_uri: URI of the document
+    :document: Text of the document
+    :read: Callable returning the text of a file_uri. Raises OSError if it cannot be read
+    :encoding: (Optional) string encoding to parse URIs with
+    '''
+    sources = OrderedDict()
+    pending = [(file_uri, document)]
+    while pending:
+        parent_uri, text = pending.pop()
+        for include_uri in find_includes(parent_uri, text, encoding):
+            # include cycles are reported by YARA, so only read each file once
+            if include_uri in sources or include_uri == file_uri:
+                continue
+            try:
+                sources[include_uri] = read(include_uri)
+            except OSError:
+                continue
+            pending.append((include_uri, sources[include_uri]))
+    return sources
+
+
+def walk_graph(edges: Callable[[str], Iterable[str]], file_uri: str) -> List[str]:
+    '''Follow the edges of a graph from a file, visiting each file once
+
+    :edges: Callable returning the files a file has an edge to
+    :file_uri: File to start from, which is left out of the results
+    '''
+    found = []
+    seen = {file_uri}
+    pending = [file_uri]
+    while pending:
+        for other_uri in edges(pending.pop()):
+            if other_uri not in seen:
+                seen.add(other_uri)
+                found.append(other_uri)
+                pending.append(other_uri)
+    return found
+
+
+class IncludeCallback(object):
+    def __init__(self, file_uri: str, sources: Dict[str, str], encoding: str="utf-8"):
+        ''' Feeds included files to yara.compile() from text that was already loaded
+
+        YARA passes nested includes the requested path of the file including
+        them, so the URI every requested path resolved to is remembered
+        '''
+        self.file_uri = file_uri
+        self.sources = sources
+        self.encoding = encoding
+        # requested path => (URI it resolved to, requested path of the file including it)
+        self.requested = {}
+        # requested paths that could not be found
+        self.missing = []
+
+    def __call__(self, requested: str, filename: str, namespace: str) -> str:
+        parent_uri = self.file_uri if filename is None else self.requested.get(filename, (self.file_uri, None))[0]
+        include_uri = resolve_include(parent_uri, requested, self.encoding)
+        self.requested.setdefault(requested, (include_uri, filename))
+        source = self.sources.get(include_uri, None)
+        if source is None and requested not in self.missing:
+            self.missing.append(requested)
+        # YARA reports None as an include that could not be found
+        return source
+
+    def __repr__(self):
+        return "<IncludeCallback(sources={:d})>".format(len(self.sources))
+
+    def origin(self, requested: str) -> str:
+        '''Find the include statement in the compiled document that led to a requested path
+
+        :requested: Path YARA reported an error in
+        '''
+        seen = set()
+        while requested in self.requested and requested not in seen:
+            seen.add(requested)
+            parent = self.requested[requested][1]
+            if parent is None:
+                return requested
+            requested = parent
+        return None
+
+
+class DependencyGraph(object):
+    def __init__(self):
+        ''' Map rule files to the files they include, and back '''
+        # file_uri => tuple of URIs it includes
+        self._includes = {}
+        # file_uri => set of URIs including it
+        self._included_by = {}
+
+    def __contains__(self, file_uri: str):
+        return file_uri in self._includes
+
+    def __len__(self):
+        return len(self._includes)
+
+    def __repr__(self):
+        return "<DependencyGraph(files={:d}, included={:d})>".format(len(self._includes), len(self._included_by))
+
+    def dependencies(self, file_uri: str) -> List[str]:
+        '''Get every file a file includes, directly or through other files
+
+        :file_uri: File to look up
+        '''
+        return walk_graph(self.includes, file_uri)
+
+    def dependents(self, file_uri: str) -> List[str]:
+        '''Get every file that includes a file, directly or through other files
+
+        :file_uri: File to look up
+        '''
+        return walk_graph(self.included_by, file_uri)
+
+    def included_by(self, file_uri: str) -> frozenset:
+        '''Get the files that include a file directly
+
+        :file_uri: File to look up
+        '''
+        return frozenset(self._included_by.get(file_uri, ()))
+
+    def includes(self, file_uri: str) -> tuple:
+        '''Get the files a file includes directly
+
+        :file_uri: File to look up
+        '''
+        return self._includes.get(file_uri, ())
+
+    def remove(self, file_uri: str):
+        '''Drop the includes of a file. Files including it keep their edges to it
+
+        :file_uri: File to remove from the graph
+        '''
+        for include_uri in self._includes.pop(file_uri, ()):
+            parents = self._included_by.get(include_uri, set())
+            parents.discard(file_uri)
+            if not parents:
+                self._included_by.pop(include_uri, None)
+
+    def update(self, file_uri: str, includes: Iterable[str]):
+        '''Replace the includes of a file
+
+        :file_uri: File that was scanned
+        :includes: URIs of the files it includes
+        '''
+        self.remove(file_uri)
+        includes = tuple(includes)
+        self._includes[file_uri] = includes
+        for include_uri in includes:
+            self._included_by.setdefault(include_uri, set()).add(file_uri)
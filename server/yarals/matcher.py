@@ -0,0 +1,200 @@
+''' Scan sample files with compiled rules '''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import mmap
+import os
+from pathlib import Path
+import time
+from typing import Dict, Iterable, Iterator
+
+from yarals.cache import RulesStore, hash_text
+from yarals.compiler import get_cache_key, get_rules_key, load_yara, read_file
+from yarals.includes import IncludeCallback, load_includes
+from yarals.metrics import Histogram
+
+# libyara refuses to scan with one set of rules on more threads than this at once
+MAX_SCAN_THREADS = 32
+# seconds a single file may be scanned for before YARA gives up on it
+SCAN_TIMEOUT = 60
+# matched string instances reported for each rule, so a string matching everywhere can't flood the client
+MAX_INSTANCES = 100
+
+
+def compile_rules(documents: Dict[str, str], encoding: str="utf-8", overlay: dict=None, store: RulesStore=None):
+    '''Compile every rule file into one set of rules. Meant to be run in a thread
+
+    Each file is compiled into a namespace named after its URI, so rules
+    with the same name in different files don't conflict. Raises
+    yara.SyntaxError if any of the files has an error. When a store is
+    given, rules that were already compiled are loaded from it instead,
+    including single files saved after compiling for their diagnostics
+
+    :documents: Dictionary of file_uri => document text. Text may be None to read the file from disk
+    :encoding: (Optional) text encoding of files on disk
+    :overlay: (Optional) dictionary of file_uri => text of open documents, used instead of their on-disk contents
+    :store: (Optional) RulesStore to load compiled rules from and save them to
+    '''
+    yara = load_yara()
+    overlay = overlay or {}
+    read = lambda file_uri: overlay[file_uri] if file_uri in overlay else read_file(file_uri, encoding)
+    sources = {}
+    # namespace => IncludeCallback, since relative includes are resolved against each file's folder
+    callbacks = {}
+    keys = []
+    for file_uri, document in documents.items():
+        document = read(file_uri) if document is None else document
+        sources[file_uri] = document
+        included = load_includes(file_uri, document, read, encoding)
+        callbacks[file_uri] = IncludeCallback(file_uri, included, encoding)
+        keys.append(get_rules_key(get_cache_key(document, included), file_uri))
+    # a single file has the same key it was saved under when it was compiled for its diagnostics
+    key = keys[0] if len(keys) == 1 else hash_text("\0".join(sorted(keys)))
+    rules = None if store is None else store.get(key)
+    if rules is None:
+        rules = yara.compile(
+            sources=sources,
+            include_callback=lambda requested, filename, namespace: callbacks[namespace](requested, filename, namespace)
+        )
+        if store is not None:
+            store.put(key, rules)
+    return rules
+
+def iter_samples(folder: Path) -> Iterator[Path]:
+    '''Find every file in a folder and its subfolders
+
+    Symlinked folders are skipped, since they can loop back on themselves
+
+    :folder: Folder to search
+    '''
+    logger = logging.getLogger("yara")
+    folders = [str(folder)]
+    while folders:
+        current = folders.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif entry.is_file():
+                            yield Path(entry.path)
+                    except OSError as err:
+                        logger.warning("Could not scan %s: %s", entry.path, err)
+        except OSError as err:
+            logger.warning("Could not scan %s: %s", current, err)
+
+def _to_match(match) -> dict:
+    ''' Convert a yara.Match into something that can be sent to the client '''
+    strings = []
+    for string in match.strings:
+        for instance in string.instances:
+            if len(strings) >= MAX_INSTANCES:
+                break
+            strings.append({"identifier": string.identifier, "offset": instance.offset, "length": instance.matched_length})
+    return {
+        "rule": match.rule,
+        "namespace": match.namespace,
+        "tags": list(match.tags),
+        "meta": match.meta,
+        "strings": strings
+    }
+
+def scan_file(rules, path: Path, timeout: int=SCAN_TIMEOUT) -> dict:
+    '''Scan a single file. Meant to be run in a thread, since YARA releases the GIL while matching
+
+    The file is memory-mapped rather than read, so only the pages YARA
+    looks at are loaded. Returns the file's URI, its matches and how long the scan took
+
+    :rules: Compiled yara.Rules
+    :path: File to scan
+    :timeout: (Optional) seconds to scan for before giving up
+    '''
+    start = time.perf_counter()
+    result = {"uri": Path(path).as_uri(), "matches": []}
+    try:
+        with open(str(path), "rb") as ifile:
+            # empty files cannot be mapped
+            if os.fstat(ifile.fileno()).st_size == 0:
+                matches = rules.match(data=b"", timeout=timeout)
+            else:
+                with mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    matches = rules.match(data=data, timeout=timeout)
+        result["matches"] = [_to_match(match) for match in matches]
+    except (OSError, ValueError, load_yara().Error) as err:
+        result["error"] = str(err)
+    result["time_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+
+class MatchEngine(object):
+    def __init__(self, max_workers: int=None, rules: RulesStore=None):
+        ''' Scans many files at once on a pool of threads
+
+        YARA does not hold the GIL while matching, so threads can share one
+        set of compiled rules instead of every worker having to compile its own.
+        The pool is only started the first time it is needed. Compiled rules
+        are loaded from the rules store when they are in it
+        '''
+        self._logger = logging.getLogger("yara")
+        self.rules = RulesStore() if rules is None else rules
+        self._pool = None
+        self.max_workers = min(max_workers or os.cpu_count() or 1, MAX_SCAN_THREADS)
+        # time spent scanning each file
+        self.scan_times = Histogram()
+
+    def __repr__(self):
+        return "<MatchEngine(max_workers={:d})>".format(self.max_workers)
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        ''' Thread pool used to compile rules and scan files '''
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    async def compile(self, documents: Dict[str, str], encoding: str="utf-8", overlay: dict=None):
+        '''Compile every rule file into one set of rules without blocking the event loop
+
+        :documents: Dictionary of file_uri => document text. Text may be None to read the file from disk
+        :encoding: (Optional) text encoding of files on disk
+        :overlay: (Optional) dictionary of file_uri => text of open documents, used instead of their on-disk contents
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.pool, compile_rules, documents, encoding, overlay, self.rules)
+
+    async def scan_all(self, rules, paths: Iterable[Path], timeout: int=SCAN_TIMEOUT):
+        '''Scan many files in parallel, yielding the result of each file as it finishes
+
+        :rules: Compiled yara.Rules
+        :paths: Files to scan
+        :timeout: (Optional) seconds to scan each file for before giving up
+        '''
+        loop = asyncio.get_event_loop()
+        paths = iter(paths)
+        pending = set()
+        try:
+            while True:
+                # only keep every worker busy, instead of queueing up every file at once
+                for path in paths:
+                    pending.add(loop.run_in_executor(self.pool, scan_file, rules, path, timeout))
+                    if len(pending) >= self.max_workers * 2:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    self.scan_times.record(result["time_ms"])
+                    self._logger.debug("Scanned %s in %.3f ms", result["uri"], result["time_ms"])
+                    yield result
+        finally:
+            # the caller stopped early or was cancelled, so files that have not started are skipped
+            for task in pending:
+                task.cancel()
+
+    def shutdown(self):
+        ''' Stop all worker threads '''
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
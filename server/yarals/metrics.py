@@ -0,0 +1,188 @@
+''' Request counters and latency histograms for the language server '''
+from bisect import bisect_left
+import time
+
+
+# upper bounds of the latency buckets, in milliseconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+
+class Histogram(object):
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        ''' Fixed-bucket histogram of durations
+
+        Recording is a bisect and an increment, so it is cheap enough to do
+        for every message. Percentiles are estimated from the buckets
+        '''
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<Histogram(count={:d})>".format(self.count)
+
+    def record(self, millis: float):
+        '''Add one duration
+
+        :millis: Duration in milliseconds
+        '''
+        self.counts[bisect_left(BUCKETS, millis)] += 1
+        self.count += 1
+        self.total += millis
+        if millis > self.max:
+            self.max = millis
+
+    def percentile(self, fraction: float) -> float:
+        '''Estimate a percentile as the upper bound of the bucket it falls in
+
+        :fraction: Percentile to estimate, between 0 and 1
+        '''
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5), 3),
+            "p90_ms": round(self.percentile(0.9), 3),
+            "p99_ms": round(self.percentile(0.99), 3),
+            "max_ms": round(self.max, 3),
+            # only buckets that were used, keyed by their upper bound
+            "buckets": {str(bound): count for bound, count in zip(BUCKETS, self.counts) if count}
+        }
+
+
+class MethodStats(object):
+    __slots__ = ("calls", "errors", "cancelled", "latency")
+
+    def __init__(self):
+        ''' Counters for a single JSON-RPC method '''
+        self.calls = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.latency = Histogram()
+
+    def __repr__(self):
+        return "<MethodStats(calls={:d})>".format(self.calls)
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "latency": self.latency.to_dict()
+        }
+
+
+class Metrics(object):
+    def __init__(self):
+        ''' Counters for everything the server has handled since it started '''
+        self.started = time.monotonic()
+        # method name => MethodStats
+        self.methods = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+
+    def __repr__(self):
+        return "<Metrics(methods={:d}, messages_in={:d})>".format(len(self.methods), self.messages_in)
+
+    def _method(self, method: str) -> MethodStats:
+        stats = self.methods.get(method, None)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        return stats
+
+    @property
+    def calls(self) -> int:
+        ''' Number of messages handled across every method '''
+        return sum(stats.calls for stats in self.methods.values())
+
+    def cancelled(self, method: str):
+        '''Count a request that was cancelled before it was answered
+
+        :method: JSON-RPC method of the request
+        '''
+        self._method(method).cancelled += 1
+
+    def error(self, method: str):
+        '''Count a message that could not be handled
+
+        :method: JSON-RPC method of the message
+        '''
+        self._method(method).errors += 1
+
+    def received(self, size: int):
+        '''Count a message read from a client
+
+        :size: Size of the message in bytes, including headers
+        '''
+        self.messages_in += 1
+        self.bytes_in += size
+
+    def record(self, method: str, seconds: float):
+        '''Count a handled message and how long it took
+
+        :method: JSON-RPC method of the message
+        :seconds: Time from reading the message until it was handled or answered
+        '''
+        stats = self._method(method)
+        stats.calls += 1
+        stats.latency.record(seconds * 1000)
+
+    def sent(self, size: int):
+        '''Count a message written to a client
+
+        :size: Size of the message in bytes, including headers
+        '''
+        self.messages_out += 1
+        self.bytes_out += size
+
+    def summary(self) -> str:
+        ''' Describe the busiest and slowest methods in a single line '''
+        busiest = sorted(self.methods.items(), key=lambda item: item[1].calls, reverse=True)[:3]
+        slowest = max(self.methods.items(), key=lambda item: item[1].latency.percentile(0.99), default=None)
+        parts = [
+            "{:d} messages in ({:.1f} KiB), {:d} out ({:.1f} KiB)".format(
+                self.messages_in, self.bytes_in / 1024, self.messages_out, self.bytes_out / 1024
+            ),
+            "busiest: " + ", ".join("{} x{:d}".format(method, stats.calls) for method, stats in busiest)
+        ]
+        if slowest is not None:
+            parts.append("slowest p99: {} {:g} ms".format(slowest[0], slowest[1].latency.percentile(0.99)))
+        return "; ".join(parts)
+
+    def to_dict(self) -> dict:
+        return {
+            "uptime_seconds": round(time.monotonic() - self.started, 1),
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "methods": {method: stats.to_dict() for method, stats in sorted(self.methods.items())}
+        }
+
+
+def hit_rate(hits: int, misses: int) -> dict:
+    '''Describe how well a cache is doing
+
+    :hits: Lookups answered from the cache
+    :misses: Lookups that were not
+    '''
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": round(hits / total, 3) if total else None}
@@ -0,0 +1,141 @@
+''' Buffered, coalescing output stream for language server clients '''
+import asyncio
+from collections import OrderedDict
+from itertools import count
+import logging
+
+
+class MessageQueue(object):
+    def __init__(self, writer: asyncio.StreamWriter, high_water: int=4*2**20, batch_size: int=64*2**10):
+        ''' Queue of framed messages waiting to be written to a client
+
+        Messages queued during the same event loop iteration are joined into
+        a few large writes instead of one write and drain per message. A message
+        queued with a key replaces any message with the same key that has not
+        been written yet, so only the newest diagnostics for a file are sent.
+        Once more than high_water bytes are waiting, drain() blocks callers
+        until the client has caught up
+
+        Behaves enough like an asyncio.StreamWriter to be used in its place
+        '''
+        self._logger = logging.getLogger("yara")
+        self._writer = writer
+        # key => framed message. Messages without a key get a unique one
+        self._frames = OrderedDict()
+        self._ids = count()
+        self._size = 0
+        self._flusher = None
+        self._error = None
+        self._closing = False
+        self._write_eof = False
+        # set whenever the amount of queued data is below the low water mark
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.batch_size = batch_size
+        self.high_water = high_water
+        self.low_water = high_water // 4
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __repr__(self):
+        return "<MessageQueue(messages={:d}, bytes={:d})>".format(len(self._frames), self._size)
+
+    @property
+    def transport(self) -> asyncio.BaseTransport:
+        ''' Transport of the underlying stream '''
+        return self._writer.transport
+
+    def can_write_eof(self) -> bool:
+        ''' Whether the underlying stream supports half-closing '''
+        return self._writer.can_write_eof()
+
+    def close(self):
+        ''' Close the underlying stream once every queued message is written '''
+        self._closing = True
+        self._start()
+
+    async def drain(self):
+        ''' Wait until the amount of queued data is below the low water mark '''
+        while self._error is None and self._size > self.high_water:
+            self._drained.clear()
+            await self._drained.wait()
+        if self._error is not None:
+            raise self._error
+
+    def get_extra_info(self, name: str, default=None):
+        ''' Get optional information about the underlying transport '''
+        return self._writer.get_extra_info(name, default)
+
+    def is_closing(self) -> bool:
+        ''' Whether the queue has been closed or the stream failed '''
+        return self._closing or self._error is not None or self._writer.is_closing()
+
+    async def wait_closed(self):
+        ''' Wait for queued messages to be written and the underlying stream to close '''
+        if self._flusher is not None:
+            await asyncio.shield(self._flusher)
+        await self._writer.wait_closed()
+
+    def write(self, data: bytes, key=None):
+        '''Queue a framed message to be written
+
+        :data: Complete message, including headers
+        :key: (Optional) replace any unwritten message queued with the same key
+        '''
+        if self._error is not None or self._closing:
+            self._logger.debug("Dropping %d bytes for a closed client", len(data))
+            return
+        if key is None:
+            key = next(self._ids)
+        elif key in self._frames:
+            # the older message was never sent, so nobody will miss it
+            self._size -= len(self._frames[key])
+            self.coalesced += 1
+        # replacing a key keeps its place in line
+        self._frames[key] = data
+        self._size += len(data)
+        self._start()
+
+    def write_eof(self):
+        ''' Half-close the underlying stream once every queued message is written '''
+        self._write_eof = True
+        self._start()
+
+    def _start(self):
+        ''' Make sure a task is writing out queued messages '''
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        ''' Write queued messages in batches until the queue is empty '''
+        # let the current event loop iteration finish queueing messages first
+        await asyncio.sleep(0)
+        try:
+            while self._frames:
+                batch = []
+                batch_len = 0
+                while self._frames and (not batch or batch_len < self.batch_size):
+                    _, data = self._frames.popitem(last=False)
+                    batch.append(data)
+                    batch_len += len(data)
+                self._writer.write(b"".join(batch))
+                await self._writer.drain()
+                self._size -= batch_len
+                if self._size <= self.low_water:
+                    self._drained.set()
+            if self._write_eof and self._writer.can_write_eof():
+                self._write_eof = False
+                self._writer.write_eof()
+            if self._closing:
+                self._writer.close()
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionError, OSError) as err:
+            self._logger.error("Could not write to client: %s", err)
+            self._error = err
+            self._frames.clear()
+            self._size = 0
+            self._drained.set()
+            self._writer.close()
@@ -0,0 +1,778 @@
+''' Tokenizer and parser for YARA rule files '''
+from bisect import bisect_left, bisect_right
+from collections import deque
+from enum import IntEnum
+from functools import lru_cache
+import re
+from typing import Iterator, List, Tuple
+
+
+# reserved words that can never be rule or string names
+KEYWORDS = frozenset([
+    "all", "and", "any", "ascii", "at", "base64", "base64wide", "condition", "contains", "endswith",
+    "entrypoint", "false", "filesize", "for", "fullword", "global", "icontains", "iendswith", "iequals",
+    "import", "in", "include", "int16", "int16be", "int32", "int32be", "int8", "int8be",
+    "istartswith", "matches", "meta", "nocase", "none", "not", "of", "or", "private", "rule",
+    "startswith", "strings", "them", "true", "uint16", "uint16be", "uint32", "uint32be", "uint8",
+    "uint8be", "wide", "xor", "defined"
+])
+# rule headers always start a line, so documents are split into chunks at them
+RULE_PATTERN = re.compile(r"^[ \t]*(?:(?:private|global)[ \t]+)*rule[ \t]+([A-Za-z_]\w*)", re.MULTILINE)
+# operators are matched before string identifiers so "!=" is not read as a length
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?P<open_comment>/\*)
+    |(?P<text>"(?:\\.|[^"\\\n])*"?)
+    |(?P<operator>==|!=|<=|>=|<<|>>|\.\.)
+    |(?P<string>[$#@!][A-Za-z0-9_]*\*?)
+    |(?P<number>0x[0-9A-Fa-f]+|0o[0-7]+|\d+(?:\.\d+)?(?:KB|MB)?)
+    |(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<punct>.)
+""", re.DOTALL | re.VERBOSE)
+# hex strings may span lines. Regular expressions may not
+HEX_PATTERN = re.compile(r"\{[^}]*\}?")
+REGEX_PATTERN = re.compile(r"/(?:\\.|[^/\\\n])*/?[is]*")
+RULE_MODIFIERS = frozenset(["global", "private"])
+SECTIONS = frozenset(["condition", "meta", "strings"])
+
+
+class TokenKind(IntEnum):
+    IDENTIFIER = 1
+    KEYWORD = 2
+    # $name, #name, @name and !name
+    STRING_ID = 3
+    STRING_COUNT = 4
+    STRING_OFFSET = 5
+    STRING_LENGTH = 6
+    TEXT = 7
+    HEX = 8
+    REGEX = 9
+    NUMBER = 10
+    OPERATOR = 11
+
+
+STRING_KINDS = {
+    "$": TokenKind.STRING_ID,
+    "#": TokenKind.STRING_COUNT,
+    "@": TokenKind.STRING_OFFSET,
+    "!": TokenKind.STRING_LENGTH
+}
+
+
+class Token(object):
+    __slots__ = ("kind", "value", "start", "end")
+
+    def __init__(self, kind: TokenKind, value: str, start: int, end: int):
+        ''' A single lexical token and the offsets it spans '''
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "<Token(kind={}, value={!r}, start={:d}, end={:d})>".format(self.kind.name, self.value, self.start, self.end)
+
+    @property
+    def is_string(self) -> bool:
+        ''' Whether this token names a string: $name, #name, @name or !name '''
+        return TokenKind.STRING_ID <= self.kind <= TokenKind.STRING_LENGTH
+
+    @property
+    def name(self) -> str:
+        ''' Token value without a string sigil '''
+        return self.value[1:] if self.is_string else self.value
+
+    def is_op(self, value: str) -> bool:
+        ''' Whether this token is the given operator or punctuation '''
+        return self.kind == TokenKind.OPERATOR and self.value == value
+
+    def shifted(self, delta: int):
+        ''' Copy of this token moved by a number of characters '''
+        return Token(self.kind, self.value, self.start + delta, self.end + delta)
+
+
+class Import(object):
+    __slots__ = ("module", "token")
+
+    def __init__(self, token: Token):
+        ''' An import or include statement. The module name or path has its quotes removed '''
+        self.token = token
+        self.module = token.value.strip("\"")
+
+    def __repr__(self):
+        return "<Import(module={!r})>".format(self.module)
+
+    def shifted(self, delta: int):
+        return Import(self.token.shifted(delta))
+
+
+class Meta(object):
+    __slots__ = ("key", "value")
+
+    def __init__(self, key: Token, value: Token):
+        ''' A key/value pair in a rule's meta section '''
+        self.key = key
+        self.value = value
+
+    def __repr__(self):
+        return "<Meta(key={!r})>".format(self.key.value)
+
+    def shifted(self, delta: int):
+        return Meta(self.key.shifted(delta), self.value.shifted(delta) if self.value else None)
+
+
+class StringDef(object):
+    __slots__ = ("identifier", "equals", "value", "modifiers", "end")
+
+    def __init__(self, identifier: Token, equals: Token, value: Token, modifiers: List[Token], end: int):
+        ''' A string definition in a rule's strings section
+
+        Spans from the identifier to the end of its last modifier
+        '''
+        self.identifier = identifier
+        self.equals = equals
+        self.value = value
+        self.modifiers = modifiers
+        self.end = end
+
+    def __repr__(self):
+        return "<StringDef(identifier={!r})>".format(self.identifier.value)
+
+    @property
+    def name(self) -> str:
+        ''' Identifier without the "$" '''
+        return self.identifier.name
+
+    @property
+    def start(self) -> int:
+        return self.identifier.start
+
+    def shifted(self, delta: int):
+        return StringDef(
+            self.identifier.shifted(delta), self.equals.shifted(delta),
+            self.value.shifted(delta) if self.value else None,
+            [token.shifted(delta) for token in self.modifiers], self.end + delta
+        )
+
+
+class Rule(object):
+    __slots__ = ("name_token", "modifiers", "tags", "meta", "strings", "condition", "sections", "start", "end", "_table")
+
+    def __init__(self, name_token: Token, modifiers: List[Token], start: int):
+        ''' A rule declaration and everything in its body '''
+        self.name_token = name_token
+        self.modifiers = modifiers
+        self.tags = []
+        self.meta = []
+        self.strings = []
+        self.condition = []
+        # section name => keyword token
+        self.sections = {}
+        self.start = start
+        self.end = name_token.end
+        self._table = None
+
+    def __repr__(self):
+        return "<Rule(name={!r}, strings={:d})>".format(self.name, len(self.strings))
+
+    @property
+    def name(self) -> str:
+        return self.name_token.value
+
+    @property
+    def string_table(self):
+        ''' Table of this rule's string definitions and usages, built on first use '''
+        if self._table is None:
+            self._table = StringTable(self)
+        return self._table
+
+    def iter_string_refs(self) -> Iterator[Token]:
+        ''' Iterate over every $, #, @ and ! token used in the condition '''
+        return (token for token in self.condition if token.is_string)
+
+    def shifted(self, delta: int):
+        ''' Copy of this rule moved by a number of characters '''
+        if delta == 0:
+            return self
+        rule = Rule(self.name_token.shifted(delta), [token.shifted(delta) for token in self.modifiers], self.start + delta)
+        rule.tags = [token.shifted(delta) for token in self.tags]
+        rule.meta = [meta.shifted(delta) for meta in self.meta]
+        rule.strings = [string.shifted(delta) for string in self.strings]
+        rule.condition = [token.shifted(delta) for token in self.condition]
+        rule.sections = {name: token.shifted(delta) for name, token in self.sections.items()}
+        rule.end = self.end + delta
+        return rule
+
+
+class StringTable(object):
+    __slots__ = ("definitions", "usages", "_names")
+
+    def __init__(self, rule: Rule):
+        ''' Index of a rule's string identifiers
+
+        Maps every name (without its sigil) to the strings defining it and
+        to the $, #, @ and ! tokens using it in the condition. Tables belong
+        to the cached rule nodes, so an edit only rebuilds the table of the
+        rule it changed
+        '''
+        # name => list of StringDef
+        self.definitions = {}
+        # name => list of Token
+        self.usages = {}
+        for string in rule.strings:
+            self.definitions.setdefault(string.name, []).append(string)
+        for token in rule.iter_string_refs():
+            # anonymous strings and wildcards don't name a single string
+            if token.name and not token.name.endswith("*"):
+                self.usages.setdefault(token.name, []).append(token)
+        self._names = sorted(self.definitions)
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def __repr__(self):
+        return "<StringTable(strings={:d}, usages={:d})>".format(len(self.definitions), len(self.usages))
+
+    def find_definitions(self, name: str) -> List[StringDef]:
+        '''Get the strings defined with a name
+
+        :name: String name without its sigil. Names ending in "*" match every name starting with the rest
+        '''
+        if not name.endswith("*"):
+            return self.definitions.get(name, [])
+        prefix = name[:-1]
+        start = bisect_left(self._names, prefix)
+        end = bisect_left(self._names, prefix + "\U0010ffff", lo=start)
+        return sorted(
+            (string for found in self._names[start:end] for string in self.definitions[found]),
+            key=lambda string: string.start
+        )
+
+    def find_references(self, name: str) -> List[Token]:
+        '''Get the identifiers of the strings defined with a name and every usage of that name
+
+        Wildcards only match definitions, since "$a*" in a condition does not name one string
+
+        :name: String name without its sigil
+        '''
+        tokens = [string.identifier for string in self.find_definitions(name)]
+        if not name.endswith("*"):
+            tokens.extend(self.usages.get(name, []))
+        return tokens
+
+
+def tokenize(text: str) -> Tuple[List[Token], bool]:
+    '''Split text into tokens, skipping whitespace and comments
+
+    Returns the list of tokens and whether the text ends inside of a block comment
+
+    :text: Text to tokenize
+    '''
+    tokens = []
+    unterminated = False
+    pos = 0
+    end = len(text)
+    # hex strings and regular expressions can only follow "=" or "matches"
+    literal_ok = False
+    while pos < end:
+        char = text[pos]
+        if literal_ok and char == "{":
+            match = HEX_PATTERN.match(text, pos)
+            tokens.append(Token(TokenKind.HEX, match.group(), pos, match.end()))
+        elif literal_ok and char == "/" and text[pos+1:pos+2] not in ("/", "*"):
+            match = REGEX_PATTERN.match(text, pos)
+            tokens.append(Token(TokenKind.REGEX, match.group(), pos, match.end()))
+        else:
+            match = TOKEN_PATTERN.match(text, pos)
+            group = match.lastgroup
+            value = match.group()
+            if group in ("space", "comment"):
+                pos = match.end()
+                continue
+            elif group == "open_comment":
+                unterminated = True
+                break
+            elif group == "text":
+                kind = TokenKind.TEXT
+            elif group == "string":
+                kind = STRING_KINDS[value[0]]
+            elif group == "number":
+                kind = TokenKind.NUMBER
+            elif group == "word":
+                kind = TokenKind.KEYWORD if value in KEYWORDS else TokenKind.IDENTIFIER
+            else:
+                kind = TokenKind.OPERATOR
+            tokens.append(Token(kind, value, pos, match.end()))
+        pos = match.end()
+        last = tokens[-1]
+        literal_ok = last.is_op("=") or (last.kind == TokenKind.KEYWORD and last.value == "matches")
+    return tokens, unterminated
+
+
+class ParsedChunk(object):
+    __slots__ = ("tokens", "imports", "includes", "rules", "unterminated")
+
+    def __init__(self, text: str):
+        ''' Tokens and top-level nodes for a piece of a document
+
+        Offsets are relative to the start of the piece
+        '''
+        self.tokens, self.unterminated = tokenize(text)
+        self.imports = []
+        self.includes = []
+        self.rules = []
+        _Parser(self).parse()
+
+    def __repr__(self):
+        return "<ParsedChunk(tokens={:d}, rules={:d})>".format(len(self.tokens), len(self.rules))
+
+
+class _Parser(object):
+    def __init__(self, chunk: ParsedChunk):
+        ''' Recursive descent parser filling in a chunk's nodes from its tokens
+
+        Syntax errors never stop the parser. It skips ahead to the next
+        token it understands, so incomplete rules still produce nodes
+        '''
+        self.chunk = chunk
+        self.tokens = chunk.tokens
+        self.index = 0
+
+    def peek(self, ahead: int=0) -> Token:
+        ''' Get an upcoming token, or None past the end '''
+        index = self.index + ahead
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def at_keyword(self, values, ahead: int=0) -> bool:
+        token = self.peek(ahead)
+        return token is not None and token.kind == TokenKind.KEYWORD and token.value in values
+
+    def at_op(self, value: str, ahead: int=0) -> bool:
+        token = self.peek(ahead)
+        return token is not None and token.is_op(value)
+
+    def at_rule_start(self) -> bool:
+        ''' Whether the next tokens begin a rule declaration '''
+        ahead = 0
+        while self.at_keyword(RULE_MODIFIERS, ahead):
+            ahead += 1
+        return self.at_keyword(("rule",), ahead)
+
+    def at_section(self) -> bool:
+        return self.at_keyword(SECTIONS) and self.at_op(":", 1)
+
+    def parse(self):
+        ''' Parse every top-level statement '''
+        while self.index < len(self.tokens):
+            token = self.tokens[self.index]
+            if self.at_keyword(("import", "include")):
+                target = self.peek(1)
+                if target is not None and target.kind == TokenKind.TEXT:
+                    nodes = self.chunk.imports if token.value == "import" else self.chunk.includes
+                    nodes.append(Import(target))
+                    self.index += 2
+                    continue
+            elif self.at_rule_start():
+                self.chunk.rules.append(self.parse_rule())
+                continue
+            self.index += 1
+
+    def parse_rule(self) -> Rule:
+        ''' Parse a rule declaration, starting at its first modifier or "rule" keyword '''
+        start = self.peek().start
+        modifiers = []
+        while self.at_keyword(RULE_MODIFIERS):
+            modifiers.append(self.peek())
+            self.index += 1
+        # skip "rule"
+        self.index += 1
+        name_token = self.peek()
+        if name_token is None or name_token.kind != TokenKind.IDENTIFIER:
+            # keep the node so the rule's position is known, even without a usable name
+            keyword = self.tokens[self.index-1]
+            return Rule(Token(TokenKind.IDENTIFIER, "", keyword.end, keyword.end), modifiers, start)
+        rule = Rule(name_token, modifiers, start)
+        self.index += 1
+        if self.at_op(":"):
+            self.index += 1
+            while self.peek() is not None and self.peek().kind == TokenKind.IDENTIFIER:
+                rule.tags.append(self.peek())
+                self.index += 1
+        if self.at_op("{"):
+            self.index += 1
+        section = None
+        while self.index < len(self.tokens):
+            token = self.tokens[self.index]
+            if token.is_op("}"):
+                rule.end = token.end
+                self.index += 1
+                return rule
+            if self.at_rule_start() or self.at_keyword(("import", "include")):
+                # the rule was never closed
+                break
+            if self.at_section():
+                section = token.value
+                rule.sections[section] = token
+                self.index += 2
+            elif section == "meta":
+                self.parse_meta(rule)
+            elif section == "strings":
+                self.parse_string(rule)
+            elif section == "condition":
+                rule.condition.append(token)
+                self.index += 1
+            else:
+                self.index += 1
+            rule.end = token.end
+        rule.end = self.tokens[self.index-1].end
+        return rule
+
+    def parse_meta(self, rule: Rule):
+        ''' Parse a "key = value" pair '''
+        key = self.peek()
+        if key.kind not in (TokenKind.IDENTIFIER, TokenKind.KEYWORD) or not self.at_op("=", 1):
+            self.index += 1
+            return
+        self.index += 2
+        value = self.peek()
+        if value is None or value.is_op("}") or self.at_section():
+            # the value is missing
+            rule.meta.append(Meta(key, None))
+            return
+        if value.is_op("-") and self.peek(1) is not None and self.peek(1).kind == TokenKind.NUMBER:
+            # negative numbers
+            value = Token(TokenKind.NUMBER, "-" + self.peek(1).value, value.start, self.peek(1).end)
+            self.index += 1
+        rule.meta.append(Meta(key, value))
+        self.index += 1
+
+    def at_string_end(self) -> bool:
+        ''' Whether the current string definition's modifiers are over '''
+        token = self.peek()
+        return token is None or token.is_op("}") or token.kind == TokenKind.STRING_ID and self.at_op("=", 1) \
+            or self.at_section() or self.at_rule_start()
+
+    def parse_string(self, rule: Rule):
+        ''' Parse a "$name = value modifiers" definition '''
+        identifier = self.peek()
+        if identifier.kind != TokenKind.STRING_ID or not self.at_op("=", 1):
+            self.index += 1
+            return
+        equals = self.peek(1)
+        self.index += 2
+        value = None
+        if not self.at_string_end():
+            value = self.peek()
+            self.index += 1
+        end = value.end if value is not None else equals.end
+        modifiers = []
+        while not self.at_string_end():
+            token = self.peek()
+            if token.is_op("("):
+                # modifier arguments, such as xor(0x01-0xff) or base64("...")
+                depth = 0
+                while self.peek() is not None:
+                    if self.at_op("("):
+                        depth += 1
+                    elif self.at_op(")"):
+                        depth -= 1
+                    end = self.peek().end
+                    self.index += 1
+                    if depth == 0 or self.at_string_end():
+                        break
+                continue
+            if token.kind in (TokenKind.KEYWORD, TokenKind.IDENTIFIER):
+                modifiers.append(token)
+            end = token.end
+            self.index += 1
+        rule.strings.append(StringDef(identifier, equals, value, modifiers, end))
+
+
+class ChunkCache(object):
+    def __init__(self, maxtrees: int=8):
+        ''' Pieces of the documents parsed most recently, looked up by their text
+
+        Each document version keeps its own map of pieces, so the cache never
+        has to hold a fixed number of pieces. A new version of a document
+        only parses the pieces that differ from a recent version, however
+        many rules it has, as long as fewer than maxtrees other documents
+        were parsed in the meantime. Bulk parses, such as indexing a workspace,
+        should not go through it. See SyntaxTree
+        '''
+        # one dictionary of piece text => ParsedChunk per document version, newest last
+        self._recent = deque(maxlen=maxtrees)
+        self.hits = 0
+        self.misses = 0
+        self.maxtrees = maxtrees
+
+    def __len__(self):
+        return len(self._recent)
+
+    def __repr__(self):
+        return "<ChunkCache(trees={:d}, maxtrees={:d})>".format(len(self._recent), self.maxtrees)
+
+    def add(self, chunks: dict):
+        '''Remember the pieces of a document version, forgetting the oldest version if full
+
+        :chunks: Dictionary of piece text => ParsedChunk
+        '''
+        self._recent.append(chunks)
+
+    def clear(self):
+        ''' Forget every document version '''
+        self._recent.clear()
+
+    def parse(self, text: str) -> ParsedChunk:
+        '''Get a piece parsed for a recent document version, or parse it
+
+        :text: Text of the piece
+        '''
+        # trees are built on worker threads too. Copying the deque is atomic, iterating it is not.
+        # Newer versions are likelier to match
+        for chunks in reversed(list(self._recent)):
+            chunk = chunks.get(text, None)
+            if chunk is not None:
+                self.hits += 1
+                return chunk
+        self.misses += 1
+        return ParsedChunk(text)
+
+
+# pieces shared by every syntax tree
+CHUNK_CACHE = ChunkCache()
+
+
+def parse_chunk(text: str) -> ParsedChunk:
+    '''Parse one piece of a document
+
+    Pieces of recently parsed documents are reused, so after an edit
+    only the rules that actually changed are tokenized and parsed again
+
+    :text: Text of the piece
+    '''
+    return CHUNK_CACHE.parse(text)
+
+
+def split_chunks(text: str) -> List[int]:
+    '''Get the offsets a document is split into separately parsed pieces at
+
+    The first piece holds everything before the first rule, such as imports.
+    Every other piece starts at a rule declaration
+
+    :text: Full document text
+    '''
+    bases = [match.start() for match in RULE_PATTERN.finditer(text)]
+    if not bases or bases[0] != 0:
+        bases.insert(0, 0)
+    return bases
+
+
+@lru_cache(maxsize=8)
+def get_syntax_tree(text: str):
+    '''Get the syntax tree for a given document text
+
+    Trees are cached by the text itself, just like line indexes, so every
+    request made against one version of a document shares a single parse.
+    Meant for open documents. Files parsed in bulk should use SyntaxTree(text, cache=False)
+
+    :text: Full document text
+    '''
+    return SyntaxTree(text)
+
+
+class SyntaxTree(object):
+    def __init__(self, text: str, cache: bool=True):
+        ''' Parsed representation of a whole document
+
+        The document is parsed in pieces starting at each rule declaration.
+        Nodes are stored relative to their piece and moved to document
+        offsets when they are requested. Trees built without the cache
+        neither reuse nor keep pieces, so parsing many files at once
+        doesn't push out the pieces of the documents being edited
+        '''
+        self.text = text
+        self._bases = []
+        self._chunks = []
+        # piece text => ParsedChunk, for the next version of the document to reuse
+        pieces = {}
+        parse = parse_chunk if cache else ParsedChunk
+        bases = split_chunks(text)
+        for index, base in enumerate(bases):
+            end = bases[index+1] if index + 1 < len(bases) else len(text)
+            piece = text[base:end]
+            chunk = pieces.get(piece, None) or parse(piece)
+            if chunk.unterminated and end != len(text):
+                # a block comment runs into the next piece and may hide rule declarations,
+                # so the pieces can't be parsed on their own
+                pieces = {text: parse(text)}
+                self._bases = [0]
+                self._chunks = [pieces[text]]
+                break
+            pieces[piece] = chunk
+            self._bases.append(base)
+            self._chunks.append(chunk)
+        if cache:
+            CHUNK_CACHE.add(pieces)
+        self._rules = None
+
+    def __repr__(self):
+        return "<SyntaxTree(chunks={:d})>".format(len(self._chunks))
+
+    def _segment(self, offset: int) -> Tuple[int, ParsedChunk]:
+        ''' Get the piece containing an offset and the offset the piece starts at '''
+        index = max(bisect_right(self._bases, offset) - 1, 0)
+        return self._bases[index], self._chunks[index]
+
+    @property
+    def imports(self) -> List[Import]:
+        ''' Every import statement in the document '''
+        return [node.shifted(base) for base, chunk in zip(self._bases, self._chunks) for node in chunk.imports]
+
+    @property
+    def includes(self) -> List[Import]:
+        ''' Every include statement in the document '''
+        return [node.shifted(base) for base, chunk in zip(self._bases, self._chunks) for node in chunk.includes]
+
+    @property
+    def rules(self) -> List[Rule]:
+        ''' Every rule in the document, in order '''
+        if self._rules is None:
+            self._rules = [rule.shifted(base) for base, chunk in zip(self._bases, self._chunks) for rule in chunk.rules]
+        return self._rules
+
+    def find_rules(self, name: str) -> Iterator[Rule]:
+        '''Iterate over the rules declared with a given name
+
+        :name: Rule name to look for
+        '''
+        for base, chunk in zip(self._bases, self._chunks):
+            for rule in chunk.rules:
+                if rule.name == name:
+                    yield rule.shifted(base)
+
+    def iter_rule_refs(self, name: str) -> Iterator[Token]:
+        '''Iterate over the tokens naming a rule, in declarations and conditions
+
+        Module members, such as the "name" in "pe.name", are skipped
+
+        :name: Rule name to look for
+        '''
+        for base, chunk in zip(self._bases, self._chunks):
+            for rule in chunk.rules:
+                if rule.name == name:
+                    yield rule.name_token.shifted(base)
+                previous = None
+                for token in rule.condition:
+                    if token.kind == TokenKind.IDENTIFIER and token.value == name \
+                    and not (previous is not None and previous.is_op(".")):
+                        yield token.shifted(base)
+                    previous = token
+
+    def _rule_segment(self, offset: int) -> Tuple[int, Rule]:
+        ''' Get the unshifted rule an offset is in and the offset its piece starts at '''
+        base, chunk = self._segment(offset)
+        for rule in chunk.rules:
+            if rule.start <= offset - base <= rule.end:
+                return base, rule
+        return base, None
+
+    def rule_at(self, offset: int) -> Rule:
+        '''Get the rule a document offset is in, or None
+
+        :offset: Offset into the document
+        '''
+        base, rule = self._rule_segment(offset)
+        return None if rule is None else rule.shifted(base)
+
+    def string_definitions(self, offset: int, name: str) -> List[StringDef]:
+        '''Get the strings defined with a name in the rule a document offset is in
+
+        :offset: Offset into the document
+        :name: String name without its sigil, optionally ending in "*"
+        '''
+        base, rule = self._rule_segment(offset)
+        if rule is None:
+            return []
+        return [string.shifted(base) for string in rule.string_table.find_definitions(name)]
+
+    def string_references(self, offset: int, name: str) -> List[Token]:
+        '''Get the definitions and usages of a string name in the rule a document offset is in
+
+        :offset: Offset into the document
+        :name: String name without its sigil, optionally ending in "*"
+        '''
+        base, rule = self._rule_segment(offset)
+        if rule is None:
+            return []
+        return [token.shifted(base) for token in rule.string_table.find_references(name)]
+
+    def token_at(self, offset: int) -> Token:
+        '''Get the token a document offset is in, or that ends at the offset. None between tokens
+
+        :offset: Offset into the document
+        '''
+        base, chunk = self._segment(offset)
+        index = self._token_index(chunk, offset - base)
+        return None if index is None else chunk.tokens[index].shifted(base)
+
+    @staticmethod
+    def _token_index(chunk: ParsedChunk, offset: int) -> int:
+        ''' Find the index of the token covering a chunk offset '''
+        tokens = chunk.tokens
+        low, high = 0, len(tokens)
+        while low < high:
+            middle = (low + high) // 2
+            if tokens[middle].end < offset:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(tokens) and tokens[low].start <= offset <= tokens[low].end:
+            # prefer the token starting at the offset over the one ending there
+            if low + 1 < len(tokens) and tokens[low+1].start == offset:
+                return low + 1
+            return low
+        return None
+
+    def dotted_name_at(self, offset: int) -> str:
+        '''Get the dotted module path ending at an offset, such as "pe.sections.name"
+
+        Index expressions are dropped, so "pe.sections[0].na" becomes "pe.sections.na".
+        At a trailing ".", the path before it is returned
+
+        :offset: Offset into the document
+        '''
+        base, chunk = self._segment(offset)
+        tokens = chunk.tokens
+        index = self._token_index(chunk, offset - base)
+        if index is None:
+            return ""
+        if tokens[index].is_op("."):
+            index = self._skip_subscript(tokens, index - 1)
+        parts = []
+        while index >= 0:
+            token = tokens[index]
+            if token.kind not in (TokenKind.IDENTIFIER, TokenKind.KEYWORD):
+                break
+            parts.append(token.value)
+            if index > 0 and tokens[index-1].is_op("."):
+                index = self._skip_subscript(tokens, index - 2)
+            else:
+                break
+        return ".".join(reversed(parts))
+
+    @staticmethod
+    def _skip_subscript(tokens: List[Token], index: int) -> int:
+        ''' Step back over a "[...]" ending at a token index '''
+        if index < 0 or not tokens[index].is_op("]"):
+            return index
+        depth = 0
+        while index >= 0:
+            if tokens[index].is_op("]"):
+                depth += 1
+            elif tokens[index].is_op("["):
+                depth -= 1
+                if depth == 0:
+                    return index - 1
+            index -= 1
+        return index
@@ -6,6 +6,13 @@ from enum import Enum, IntEnum
 import json
 from typing import Union, List
 
+try:
+    # optional, but much faster at encoding and decoding large messages
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 EOL: list = ["\n", "\r\n", "\r"]
 
 # Protocol Constants
@@ -19,6 +26,11 @@ class CompletionTriggerKind(IntEnum):
     # Completion was re-triggered as the current completion list is incomplete.
     INCOMPLETE = 3
 
+class FileChangeType(IntEnum):
+    CREATED = 1
+    CHANGED = 2
+    DELETED = 3
+
 class JsonRPCError(IntEnum):
     METHOD_NOT_FOUND = -32601
     INTERNAL_ERROR = -32603
@@ -60,6 +72,8 @@ class TextSyncKind(IntEnum):
     INCREMENTAL = 2
 
 class Position(object):
+    __slots__ = ("line", "char")
+
     def __init__(self, line: int, char: int):
         ''' Line position in a document (zero-based)
 
@@ -77,7 +91,13 @@ class Position(object):
     def __repr__(self):
         return "<Position(line={:d}, char={:d})>".format(self.line, self.char)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"line": self.line, "character": self.char}
+
 class Range(object):
+    __slots__ = ("start", "end")
+
     def __init__(self, start: Position, end: Position):
         ''' A range in a text document expressed as (zero-based) start and end positions
 
@@ -93,7 +113,18 @@ class Range(object):
     def __repr__(self):
         return "<Range(start={}, end={})>".format(self.start, self.end)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        # build the positions inline, since ranges are serialized far more than anything else
+        start, end = self.start, self.end
+        return {
+            "start": {"line": start.line, "character": start.char},
+            "end": {"line": end.line, "character": end.char}
+        }
+
 class CompletionItem(object):
+    __slots__ = ("label", "kind")
+
     def __init__(self, label: str, kind=CompletionItemKind.CLASS):
         ''' Suggested items for the programmer '''
         self.label = str(label)
@@ -102,7 +133,13 @@ class CompletionItem(object):
     def __repr__(self):
         return "<CompletionItem(label={}, kind={:d})>".format(self.label, self.kind)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"label": self.label, "kind": self.kind}
+
 class Diagnostic(object):
+    __slots__ = ("message", "range", "relatedInformation", "severity")
+
     def __init__(self, locrange: Range, severity: int, message: str, relatedInformation: list=[]):
         ''' Represents a diagnostic, such as a compiler error or warning
 
@@ -120,7 +157,18 @@ class Diagnostic(object):
     def __repr__(self):
         return "<Diagnostic(severity={:d}, message={})>".format(self.severity, self.message)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {
+            "message": self.message,
+            "range": self.range.to_dict(),
+            "relatedInformation": self.relatedInformation,
+            "severity": self.severity
+        }
+
 class Location(object):
+    __slots__ = ("range", "uri")
+
     def __init__(self, locrange: Range, uri: str):
         ''' Represents a location inside a resource
         such as a line inside a text file
@@ -133,7 +181,13 @@ class Location(object):
     def __repr__(self):
         return "<Location(range={}, uri={})>".format(self.range, self.uri)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"range": self.range.to_dict(), "uri": self.uri}
+
 class MarkupContent(object):
+    __slots__ = ("kind", "value")
+
     def __init__(self, kind: MarkupKind, content: str):
         ''' Represents a string value which content
         is interpreted base on its kind flag
@@ -146,7 +200,13 @@ class MarkupContent(object):
     def __repr__(self):
         return "<MarkupContent(value={}, kind={:d})>".format(self.value, self.kind)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"kind": self.kind.value, "value": self.value}
+
 class Hover(object):
+    __slots__ = ("contents", "range")
+
     def __init__(self, contents: MarkupContent, locrange: Range=None):
         ''' Represents hover information at
         a given text document position
@@ -159,8 +219,16 @@ class Hover(object):
             raise TypeError("Contents cannot be {}. Must be MarkupContent".format(type(contents)))
         self.contents = contents
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        if hasattr(self, "range"):
+            return {"range": self.range.to_dict(), "contents": self.contents.to_dict()}
+        return {"contents": self.contents.to_dict()}
+
 class TextEdit(object):
     ''' A textual edit applicable to a text document. '''
+    __slots__ = ("range", "newText")
+
     def __init__(self, locrange: Range, newText: str):
         if not isinstance(locrange, Range):
             raise TypeError("Location range cannot be {}. Must be Range".format(type(locrange)))
@@ -172,7 +240,13 @@ class TextEdit(object):
     def __repr__(self):
         return "<TextEdit(newText={})>".format(self.newText)
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {"range": self.range.to_dict(), "newText": self.newText}
+
 class WorkspaceEdit(object):
+    __slots__ = ("changes", "uri")
+
     def __init__(self, file_uri, changes: List=[]):
         '''Represents changes to many resources
         managed in the workspace
@@ -194,63 +268,65 @@ class WorkspaceEdit(object):
     def __repr__(self):
         return "<WorkspaceEdit(changes={:d})>".format(len(self.changes))
 
+    def to_dict(self) -> dict:
+        ''' Convert to a JSON-serializable dictionary '''
+        return {
+            "changes": {
+                self.uri: [change.to_dict() for change in self.changes]
+            }
+        }
+
+class RawJSON(object):
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        ''' A value that has already been encoded to UTF-8 JSON
+
+        Responses made of a single RawJSON result are copied into the message
+        without being encoded again
+        '''
+        if not isinstance(data, bytes):
+            raise TypeError("Data cannot be {}. Must be bytes".format(type(data)))
+        self.data = data
+
+    def __repr__(self):
+        return "<RawJSON(bytes={:d})>".format(len(self.data))
+
+    def to_dict(self):
+        ''' Decode the value, for when it is nested inside of another message '''
+        return json.loads(self.data)
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        ''' Custom JSON encoder '''
-        if isinstance(obj, CompletionItem):
-            return {
-                "label": obj.label,
-                "kind": obj.kind
-            }
-        elif isinstance(obj, Diagnostic):
-            return {
-                "message": obj.message,
-                "range": obj.range,
-                "relatedInformation": obj.relatedInformation,
-                "severity": obj.severity
-            }
-        elif isinstance(obj, Hover):
-            if hasattr(obj, "range"):
-                return {
-                    "range": obj.range,
-                    "contents": obj.contents
-                }
-            else:
-                return {
-                    "contents": obj.contents
-                }
-        elif isinstance(obj, Location):
-            return {
-                "range": obj.range,
-                "uri": obj.uri
-            }
-        elif isinstance(obj, MarkupContent):
-            return {
-                "kind": obj.kind,
-                "value": obj.value
-            }
+        ''' Custom JSON encoder
+
+        Protocol objects convert themselves and everything nested in them in
+        a single to_dict() call, so the encoder is only consulted once per object tree
+        '''
+        to_dict = getattr(obj, "to_dict", None)
+        if to_dict is not None:
+            return to_dict()
         elif isinstance(obj, MarkupKind):
             return obj.value
-        elif isinstance(obj, Position):
-            return {
-                "line": obj.line,
-                "character": obj.char
-            }
-        elif isinstance(obj, Range):
-            return {
-                "start": obj.start,
-                "end": obj.end
-            }
-        elif isinstance(obj, TextEdit):
-            return {
-                "range": obj.range,
-                "newText": obj.newText
-            }
-        elif isinstance(obj, WorkspaceEdit):
-            return {
-                "changes": {
-                    obj.uri: obj.changes
-                }
-            }
-        else:
-            super().default(obj)
+        return super().default(obj)
+
+# shared instance so orjson can fall back to it for protocol objects
+_ENCODER = JSONEncoder()
+
+def dumps(obj) -> bytes:
+    '''Serialize a message to UTF-8 encoded JSON, using orjson if available
+
+    :obj: Message to serialize. May contain any of the protocol objects
+    '''
+    if HAS_ORJSON:
+        return orjson.dumps(obj, default=_ENCODER.default)
+    return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False).encode("utf-8")
+
+def loads(data: bytes):
+    '''Deserialize a UTF-8 encoded JSON message, using orjson if available
+
+    :data: Raw message body
+    '''
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,110 @@
+''' Workspace state shared by every client connected to the same workspace folder '''
+import logging
+from pathlib import Path
+
+from yarals.symbols import SymbolIndex, SymbolOverlay
+from yarals.workspace import WorkspaceScanner
+
+
+class WorkspaceState(object):
+    def __init__(self, root: Path=None):
+        ''' Everything derived from the files in one workspace folder
+
+        One state is kept per folder, no matter how many clients have it
+        open, so the folder is only scanned and indexed once. Each client
+        reads the shared index through its own overlay, which holds the
+        documents that client has open. Clients without a workspace folder
+        each get a state of their own without a root
+        '''
+        self._logger = logging.getLogger("yara")
+        self.root = root
+        # finds rule files in the folder and remembers which ones changed
+        self.scanner = WorkspaceScanner(root) if root else None
+        # rule definitions, references & includes of the files on disk
+        self.symbols = SymbolIndex()
+        # number of clients using this state
+        self.clients = 0
+        # task building the index, if it has been started
+        self.indexer = None
+
+    def __repr__(self):
+        return "<WorkspaceState(root={}, clients={:d})>".format(self.root, self.clients)
+
+    def includes(self, path: Path) -> bool:
+        '''Check whether a file belongs to the workspace
+
+        :path: File to check
+        '''
+        return self.scanner is not None and self.scanner.includes(path)
+
+    def overlay(self) -> SymbolOverlay:
+        ''' Create a view of the shared index for a new client '''
+        return SymbolOverlay(self.symbols)
+
+    def close(self):
+        ''' Stop indexing and save the manifest once the last client is gone '''
+        if self.indexer is not None and not self.indexer.done():
+            self.indexer.cancel()
+        if self.scanner is not None:
+            self.scanner.save()
+
+
+class WorkspaceRegistry(object):
+    def __init__(self):
+        ''' Hand out one WorkspaceState per workspace folder, and drop it once no client uses it '''
+        self._logger = logging.getLogger("yara")
+        # resolved root => WorkspaceState
+        self._states = {}
+
+    def __contains__(self, root: Path):
+        return Path(root).resolve() in self._states
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def __len__(self):
+        return len(self._states)
+
+    def __repr__(self):
+        return "<WorkspaceRegistry(workspaces={:d})>".format(len(self._states))
+
+    def get(self, root: Path) -> WorkspaceState:
+        '''Get the state of a workspace folder that is already open, or None
+
+        :root: Workspace folder
+        '''
+        return self._states.get(Path(root).resolve(), None)
+
+    def open(self, root: Path=None) -> WorkspaceState:
+        '''Start using the state of a workspace folder, creating it for the first client
+
+        :root: (Optional) workspace folder. Clients without one get a private state
+        '''
+        if not root:
+            state = WorkspaceState()
+        else:
+            key = Path(root).resolve()
+            state = self._states.get(key, None)
+            if state is None:
+                state = self._states[key] = WorkspaceState(Path(root))
+            else:
+                self._logger.info("Sharing workspace %s with %d other client(s)", root, state.clients)
+        state.clients += 1
+        return state
+
+    def release(self, state: WorkspaceState) -> bool:
+        '''Stop using a workspace state. It is closed once its last client releases it
+
+        Returns whether the state was closed
+
+        :state: State that was returned by open()
+        '''
+        state.clients -= 1
+        if state.clients > 0:
+            return False
+        if state.root:
+            key = Path(state.root).resolve()
+            if self._states.get(key, None) is state:
+                del self._states[key]
+        state.close()
+        return True
@@ -0,0 +1,308 @@
+''' Workspace-wide index of rule definitions, references and includes '''
+from itertools import chain
+import logging
+from pathlib import Path
+from typing import Callable, Container, Dict, Iterator, List
+
+from yarals import protocol as lsp
+from yarals.document import LineIndex
+from yarals.includes import DependencyGraph, find_includes, walk_graph
+from yarals.parser import SyntaxTree, TokenKind, get_syntax_tree
+from yarals.workspace import WorkspaceScanner
+
+
+def scan_rules(text: str, tree: SyntaxTree=None) -> tuple:
+    '''Find rule definitions and the rule names referenced in conditions
+
+    Returns two dictionaries mapping rule names to a list of (line, start char, end char) tuples.
+    The first holds definitions and the second holds references
+
+    :text: Document text to scan
+    :tree: (Optional) syntax tree of the text. Defaults to the cached tree
+    '''
+    definitions = {}
+    references = {}
+    lines = LineIndex(text)
+    tree = get_syntax_tree(text) if tree is None else tree
+    for rule in tree.rules:
+        if not rule.name:
+            continue
+        start = lines.position_at(rule.name_token.start)
+        definitions.setdefault(rule.name, []).append((start.line, start.char, start.char + len(rule.name)))
+        # rule references can only occur in conditions. Module members are never rule names
+        previous = None
+        for token in rule.condition:
+            if token.kind == TokenKind.IDENTIFIER and not (previous is not None and previous.is_op(".")):
+                start = lines.position_at(token.start)
+                references.setdefault(token.value, []).append((start.line, start.char, start.char + len(token.value)))
+            previous = token
+    return definitions, references
+
+
+class SymbolIndex(object):
+    def __init__(self):
+        ''' Map rule names to the files and locations they are defined and referenced in,
+        and rule files to the files they include
+
+        Open documents are only re-scanned when a query needs them,
+        so edits to a document do not pay for a scan on every keystroke
+        '''
+        self._logger = logging.getLogger("yara")
+        # rule name => file_uri => list of (line, start char, end char) tuples
+        self._definitions = {}
+        self._references = {}
+        # file_uri => (defined names, referenced names)
+        self._files = {}
+        # file_uri => callable returning the latest text for that file
+        self._stale = {}
+        # which files include which
+        self._graph = DependencyGraph()
+
+    def __contains__(self, file_uri: str):
+        return file_uri in self._files or file_uri in self._stale
+
+    def __len__(self):
+        return len(self._files)
+
+    def __repr__(self):
+        return "<SymbolIndex(files={:d}, rules={:d})>".format(len(self._files), len(self._definitions))
+
+    @classmethod
+    def from_workspace(cls, workspace: Path, encoding: str="utf-8", scanner: WorkspaceScanner=None):
+        '''Build an index from every rule file in a workspace
+
+        :workspace: Root directory of the workspace
+        :encoding: (Optional) text encoding of the rule files
+        :scanner: (Optional) scanner deciding which files to index. Defaults to every .yar and .yara file
+        '''
+        index = cls()
+        scanner = WorkspaceScanner(workspace) if scanner is None else scanner
+        for file in scanner.iter_paths():
+            try:
+                # each file is only parsed once, so the parse caches are left to the open documents
+                index.update(file.as_uri(), file.read_text(encoding=encoding, errors="replace"), cache=False)
+            except OSError as err:
+                index._logger.warning("Could not index %s: %s", file, err)
+        return index
+
+    @staticmethod
+    def _to_locations(table: Dict[str, list], exclude: str=None, hidden: Container[str]=()) -> Iterator[lsp.Location]:
+        ''' Convert a table of file_uri => positions to Locations, one at a time '''
+        for file_uri, positions in list(table.items()):
+            if file_uri == exclude or file_uri in hidden:
+                continue
+            for line, start, end in sorted(positions):
+                locrange = lsp.Range(
+                    start=lsp.Position(line=line, char=start),
+                    end=lsp.Position(line=line, char=end)
+                )
+                yield lsp.Location(locrange, file_uri)
+
+    def _refresh(self):
+        ''' Re-scan documents that have changed since they were last indexed '''
+        while self._stale:
+            file_uri, loader = self._stale.popitem()
+            try:
+                self.update(file_uri, loader())
+            except OSError as err:
+                self._logger.warning("Could not index %s: %s", file_uri, err)
+                self.remove(file_uri)
+
+    def definitions(self, name: str, exclude: str=None) -> List[lsp.Location]:
+        '''Get the locations a rule is defined at
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        '''
+        return list(self.iter_definitions(name, exclude))
+
+    def dependents(self, file_uri: str) -> List[str]:
+        '''Get every indexed file that includes a file, directly or through other files
+
+        :file_uri: File to look up
+        '''
+        self._refresh()
+        return self._graph.dependents(file_uri)
+
+    def includes(self, file_uri: str) -> tuple:
+        '''Get the files a file includes directly
+
+        :file_uri: File to look up
+        '''
+        self._refresh()
+        return self._graph.includes(file_uri)
+
+    def invalidate(self, file_uri: str, loader: Callable[[], str]):
+        '''Mark a file as changed. It will be re-scanned before the next query
+
+        :file_uri: File that changed
+        :loader: Callable returning the file's new text
+        '''
+        self._stale[file_uri] = loader
+
+    def iter_definitions(self, name: str, exclude: str=None, hidden: Container[str]=()) -> Iterator[lsp.Location]:
+        '''Iterate over the locations a rule is defined at without building a list of them
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        :hidden: (Optional) more file URIs to leave out of the results
+        '''
+        self._refresh()
+        return self._to_locations(self._definitions.get(name, {}), exclude, hidden)
+
+    def iter_references(self, name: str, exclude: str=None, hidden: Container[str]=()) -> Iterator[lsp.Location]:
+        '''Iterate over the locations a rule is defined or referenced at without building a list of them
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        :hidden: (Optional) more file URIs to leave out of the results
+        '''
+        self._refresh()
+        table = {}
+        for file_uri, positions in chain(self._definitions.get(name, {}).items(), self._references.get(name, {}).items()):
+            table.setdefault(file_uri, []).extend(positions)
+        return self._to_locations(table, exclude, hidden)
+
+    def references(self, name: str, exclude: str=None) -> List[lsp.Location]:
+        '''Get the locations a rule is defined or referenced at
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        '''
+        return list(self.iter_references(name, exclude))
+
+    def remove(self, file_uri: str):
+        '''Drop all symbols found in a file
+
+        :file_uri: File to remove from the index
+        '''
+        self._stale.pop(file_uri, None)
+        self._graph.remove(file_uri)
+        defined, referenced = self._files.pop(file_uri, ((), ()))
+        for names, table in ((defined, self._definitions), (referenced, self._references)):
+            for name in names:
+                uris = table.get(name, {})
+                uris.pop(file_uri, None)
+                if not uris:
+                    table.pop(name, None)
+
+    def replace(self, other: "SymbolIndex"):
+        '''Take over everything another index holds, keeping this object for whoever references it
+
+        Files invalidated here while the other index was being built are
+        still re-scanned, since the other index may have read them before they changed
+
+        :other: Index to take the symbols of
+        '''
+        other._stale.update(self._stale)
+        self._definitions = other._definitions
+        self._references = other._references
+        self._files = other._files
+        self._stale = other._stale
+        self._graph = other._graph
+
+    def update(self, file_uri: str, text: str, cache: bool=True):
+        '''Re-scan a file and replace the symbols previously found in it
+
+        :file_uri: File to index
+        :text: Current text of the file
+        :cache: (Optional) parse the file through the parse caches, which only pays off for files being edited
+        '''
+        self.remove(file_uri)
+        tree = get_syntax_tree(text) if cache else SyntaxTree(text, cache=False)
+        definitions, references = scan_rules(text, tree)
+        for name, positions in definitions.items():
+            self._definitions.setdefault(name, {})[file_uri] = positions
+        for name, positions in references.items():
+            self._references.setdefault(name, {})[file_uri] = positions
+        self._files[file_uri] = (frozenset(definitions), frozenset(references))
+        self._graph.update(file_uri, find_includes(file_uri, text, tree=tree))
+
+
+class SymbolOverlay(object):
+    def __init__(self, base: SymbolIndex):
+        ''' A single client's view of an index shared with other clients
+
+        Documents the client has open are indexed separately, hiding whatever
+        the shared index holds for the same files. Unsaved changes therefore
+        never leak to other clients, and nothing is copied until the client
+        actually opens a document
+        '''
+        self.base = base
+        # open documents of this client only
+        self._local = SymbolIndex()
+
+    def __contains__(self, file_uri: str):
+        return file_uri in self._local or file_uri in self.base
+
+    def __len__(self):
+        return len(self.base) + sum(1 for file_uri in self._local._files if file_uri not in self.base)
+
+    def __repr__(self):
+        return "<SymbolOverlay(local={:d}, base={!r})>".format(len(self._local), self.base)
+
+    def close(self, file_uri: str):
+        '''Drop an open document, so the shared index answers for its file again
+
+        :file_uri: Document that was closed
+        '''
+        self._local.remove(file_uri)
+
+    def definitions(self, name: str, exclude: str=None) -> List[lsp.Location]:
+        '''Get the locations a rule is defined at
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        '''
+        return list(self.iter_definitions(name, exclude))
+
+    def dependents(self, file_uri: str) -> List[str]:
+        '''Get every indexed file that includes a file, directly or through other files
+
+        :file_uri: File to look up
+        '''
+        self._local._refresh()
+        self.base._refresh()
+        local, base = self._local._graph, self.base._graph
+        # open documents replace the shared index's edges from their files
+        edges = lambda uri: local.included_by(uri).union(parent for parent in base.included_by(uri) if parent not in self._local)
+        return walk_graph(edges, file_uri)
+
+    def includes(self, file_uri: str) -> tuple:
+        '''Get the files a file includes directly
+
+        :file_uri: File to look up
+        '''
+        return self._local.includes(file_uri) if file_uri in self._local else self.base.includes(file_uri)
+
+    def invalidate(self, file_uri: str, loader: Callable[[], str]):
+        '''Mark an open document as changed. It will be re-scanned before the next query
+
+        :file_uri: Document that changed
+        :loader: Callable returning the document's new text
+        '''
+        self._local.invalidate(file_uri, loader)
+
+    def iter_definitions(self, name: str, exclude: str=None) -> Iterator[lsp.Location]:
+        '''Iterate over the locations a rule is defined at without building a list of them
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        '''
+        return chain(self._local.iter_definitions(name, exclude), self.base.iter_definitions(name, exclude, self._local))
+
+    def iter_references(self, name: str, exclude: str=None) -> Iterator[lsp.Location]:
+        '''Iterate over the locations a rule is defined or referenced at without building a list of them
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        '''
+        return chain(self._local.iter_references(name, exclude), self.base.iter_references(name, exclude, self._local))
+
+    def references(self, name: str, exclude: str=None) -> List[lsp.Location]:
+        '''Get the locations a rule is defined or referenced at
+
+        :name: Rule name to look up
+        :exclude: (Optional) file URI to leave out of the results
+        '''
+        return list(self.iter_references(name, exclude))
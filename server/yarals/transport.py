@@ -0,0 +1,89 @@
+''' Connect the language server to clients over TCP, stdio or Unix domain sockets '''
+import asyncio
+import logging
+import os
+from pathlib import Path
+import sys
+from typing import Awaitable, Callable, Tuple
+
+# handle_client(reader, writer) coroutine of a language server
+ClientHandler = Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable]
+
+
+async def open_stdio(stdin=None, stdout=None) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    '''Wrap a pair of pipes in asyncio streams
+
+    Nothing but JSON-RPC messages may be written to stdout once
+    this is used, so logs have to go to stderr or a file instead
+
+    :stdin: (Optional) binary file to read from. Defaults to sys.stdin
+    :stdout: (Optional) binary file to write to. Defaults to sys.stdout
+    '''
+    loop = asyncio.get_event_loop()
+    stdin = sys.stdin.buffer if stdin is None else stdin
+    stdout = sys.stdout.buffer if stdout is None else stdout
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin)
+    transport, protocol = await loop.connect_write_pipe(_WritePipeProtocol, stdout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+async def serve_stdio(handler: ClientHandler, stdin=None, stdout=None):
+    '''Serve a single client over stdio until it disconnects
+
+    :handler: Coroutine handling the client's messages
+    :stdin: (Optional) binary file to read from. Defaults to sys.stdin
+    :stdout: (Optional) binary file to write to. Defaults to sys.stdout
+    '''
+    logger = logging.getLogger("yara")
+    reader, writer = await open_stdio(stdin, stdout)
+    logger.info("Serving on stdio")
+    await handler(reader, writer)
+
+async def start_socket_server(handler: ClientHandler, path: Path) -> asyncio.AbstractServer:
+    '''Listen for clients on a Unix domain socket
+
+    A socket file left behind by a server that did not exit cleanly is replaced
+
+    :handler: Coroutine handling each client's messages
+    :path: Path of the socket file
+    '''
+    path = Path(path)
+    if path.is_socket():
+        path.unlink()
+    server = await asyncio.start_unix_server(handler, path=str(path), start_serving=False)
+    # only the user running the server may connect to it
+    os.chmod(str(path), 0o600)
+    return server
+
+async def start_tcp_server(handler: ClientHandler, host: str, port: int) -> asyncio.AbstractServer:
+    '''Listen for clients on a TCP port
+
+    :handler: Coroutine handling each client's messages
+    :host: Interface to bind to
+    :port: Port to bind to
+    '''
+    return await asyncio.start_server(handler, host=host, port=port, start_serving=False)
+
+
+class _WritePipeProtocol(asyncio.streams.FlowControlMixin):
+    def __init__(self, loop=None):
+        ''' Protocol of a pipe that is only written to, which StreamWriter.wait_closed() can wait on
+
+        FlowControlMixin alone supports drain(), but has nothing to tell
+        when the pipe closed, so wait_closed() raised NotImplementedError
+        '''
+        super().__init__(loop)
+        self._closed = self._loop.create_future()
+
+    def __repr__(self):
+        return "<_WritePipeProtocol(closed={})>".format(self._closed.done())
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        # a pipe the client already closed is as good as closed cleanly
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def _get_close_waiter(self, stream: asyncio.StreamWriter) -> asyncio.Future:
+        return self._closed
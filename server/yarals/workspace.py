@@ -0,0 +1,236 @@
+''' Find rule files in a workspace and keep track of which ones changed '''
+import fnmatch
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import time
+from typing import Iterable, Iterator, Tuple
+
+
+DEFAULT_INCLUDE = ("*.yara", "*.yar")
+# version control, dependencies and the server's own cache folder
+DEFAULT_EXCLUDE = (".git", ".hg", ".svn", "node_modules", "__pycache__", ".yarals")
+MANIFEST_VERSION = 2
+# files modified this close to a scan may change again without their mtime changing
+RACY_NS = 2 * 10**9
+
+
+def compile_patterns(patterns: Iterable[str]):
+    '''Combine glob patterns into a single regular expression
+
+    :patterns: Glob patterns, such as "*.yar" or "vendor/feeds"
+    '''
+    patterns = [fnmatch.translate(pattern) for pattern in patterns if pattern]
+    if not patterns:
+        # matches nothing
+        return re.compile(r"(?!)")
+    return re.compile("|".join(patterns))
+
+
+class FileState(object):
+    __slots__ = ("mtime_ns", "size", "key")
+
+    def __init__(self, mtime_ns: int, size: int, key: str=None):
+        ''' What a file looked like the last time it was scanned, and the hash of its contents if they were read '''
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.key = key
+
+    def __repr__(self):
+        return "<FileState(size={:d}, key={})>".format(self.size, self.key)
+
+
+class ScanResult(object):
+    __slots__ = ("changed", "unchanged", "removed")
+
+    def __init__(self):
+        ''' Files found by a scan, sorted by whether they changed since the previous scan '''
+        # list of Paths that are new or were modified
+        self.changed = []
+        # Path => hash of the contents, for files that look the same as last time
+        self.unchanged = {}
+        # list of Paths that no longer exist or are no longer included
+        self.removed = []
+
+    def __len__(self):
+        return len(self.changed) + len(self.unchanged)
+
+    def __repr__(self):
+        return "<ScanResult(changed={:d}, unchanged={:d}, removed={:d})>".format(
+            len(self.changed), len(self.unchanged), len(self.removed)
+        )
+
+
+class WorkspaceScanner(object):
+    def __init__(self, root: Path, include: Iterable[str]=DEFAULT_INCLUDE, exclude: Iterable[str]=DEFAULT_EXCLUDE, manifest_path: Path=None):
+        ''' Walks a workspace for rule files in a single pass
+
+        Files and folders are matched by name or by their path relative to the
+        workspace root. Every scan is compared to a manifest of each file's
+        modification time, size and content hash, so files that did not
+        change since the last scan don't have to be read again. When a
+        manifest path is given, the manifest can be saved to and loaded from disk
+        '''
+        self._logger = logging.getLogger("yara")
+        self.root = Path(root)
+        self.manifest_path = manifest_path
+        # relative POSIX path => FileState
+        self._manifest = {}
+        self._scanned_ns = 0
+        self.include = ()
+        self.exclude = ()
+        self.configure(include, exclude)
+
+    def __len__(self):
+        return len(self._manifest)
+
+    def __repr__(self):
+        return "<WorkspaceScanner(root={}, files={:d})>".format(self.root, len(self._manifest))
+
+    def _relative(self, path: str) -> str:
+        return Path(os.path.relpath(path, str(self.root))).as_posix()
+
+    def configure(self, include: Iterable[str]=DEFAULT_INCLUDE, exclude: Iterable[str]=DEFAULT_EXCLUDE) -> bool:
+        '''Change which files are scanned
+
+        Returns whether the patterns changed
+
+        :include: Glob patterns of the files to scan
+        :exclude: Glob patterns of the files and folders to skip
+        '''
+        include, exclude = tuple(include), tuple(exclude)
+        if (include, exclude) == (self.include, self.exclude):
+            return False
+        self.include, self.exclude = include, exclude
+        self._include = compile_patterns(include)
+        self._exclude = compile_patterns(exclude)
+        return True
+
+    def _matches(self, pattern, name: str, relpath: str) -> bool:
+        return pattern.match(name) is not None or pattern.match(relpath) is not None
+
+    def includes(self, path: Path) -> bool:
+        '''Check whether a single file would be found by a scan, without walking the workspace
+
+        :path: File to check
+        '''
+        relpath = self._relative(str(path))
+        if relpath.startswith("../") or relpath == ".":
+            return False
+        parts = relpath.split("/")
+        # the file is skipped if any of the folders it is in are excluded
+        for index, name in enumerate(parts):
+            if self._matches(self._exclude, name, "/".join(parts[:index + 1])):
+                return False
+        return self._matches(self._include, parts[-1], relpath)
+
+    def watch_patterns(self) -> list:
+        ''' Glob patterns a client can watch to be notified about every included file '''
+        # include patterns without a folder match files at any depth
+        return [pattern if "/" in pattern else "**/" + pattern for pattern in self.include]
+
+    def _walk(self) -> Iterator[Tuple[str, str, os.stat_result]]:
+        ''' Iterate over the path, relative POSIX path and stat() result of every included file '''
+        # (folder path, its path relative to the root with a trailing "/")
+        folders = [(str(self.root), "")]
+        while folders:
+            folder, prefix = folders.pop()
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        relpath = prefix + entry.name
+                        if self._matches(self._exclude, entry.name, relpath):
+                            continue
+                        try:
+                            # symlinked folders are skipped, since they can loop back on themselves
+                            if entry.is_dir(follow_symlinks=False):
+                                folders.append((entry.path, relpath + "/"))
+                            elif entry.is_file() and self._matches(self._include, entry.name, relpath):
+                                yield entry.path, relpath, entry.stat()
+                        except OSError as err:
+                            self._logger.warning("Could not scan %s: %s", entry.path, err)
+            except OSError as err:
+                self._logger.warning("Could not scan %s: %s", folder, err)
+
+    def iter_paths(self) -> Iterator[Path]:
+        ''' Iterate over every included file '''
+        return (Path(path) for path, _, _ in self._walk())
+
+    def scan(self) -> ScanResult:
+        ''' Walk the workspace and compare every file to the manifest '''
+        result = ScanResult()
+        manifest = {}
+        self._scanned_ns = time.time_ns()
+        for path, relpath, stat in self._walk():
+            state = self._manifest.get(relpath, None)
+            if state is not None and state.key is not None \
+            and state.mtime_ns == stat.st_mtime_ns and state.size == stat.st_size:
+                result.unchanged[Path(path)] = state.key
+                manifest[relpath] = state
+            else:
+                result.changed.append(Path(path))
+                manifest[relpath] = FileState(stat.st_mtime_ns, stat.st_size)
+        result.removed = [self.root.joinpath(relpath) for relpath in self._manifest if relpath not in manifest]
+        self._manifest = manifest
+        return result
+
+    def update(self, path: Path, key: str):
+        '''Remember the hash of a file's contents after it was read
+
+        The file has to have been found by a scan first. Files modified just
+        before the scan are not trusted and will be read again next time
+
+        :path: File that was read
+        :key: Hash of its contents
+        '''
+        state = self._manifest.get(self._relative(str(path)), None)
+        if state is not None and state.mtime_ns < self._scanned_ns - RACY_NS:
+            state.key = key
+
+    def forget(self, path: Path):
+        '''Forget a single file, so the next scan treats it as changed or removed
+
+        :path: File that changed or was deleted
+        '''
+        self._manifest.pop(self._relative(str(path)), None)
+
+    def clear(self):
+        ''' Forget every file, so the next scan treats them all as changed '''
+        self._manifest.clear()
+
+    def load(self):
+        ''' Replace the manifest with the contents of the manifest file, if it exists '''
+        if self.manifest_path is None or not self.manifest_path.is_file():
+            return
+        try:
+            data = json.loads(self.manifest_path.read_text())
+            if data.get("version", None) != MANIFEST_VERSION:
+                self._logger.info("Ignoring outdated manifest %s", self.manifest_path)
+                return
+            self._manifest = {
+                relpath: FileState(mtime_ns, size, key)
+                for relpath, (mtime_ns, size, key) in data.get("files", {}).items()
+            }
+            self._logger.info("Loaded %d files from manifest %s", len(self._manifest), self.manifest_path)
+        except (OSError, TypeError, ValueError, AttributeError) as err:
+            self._logger.warning("Could not load manifest %s: %s", self.manifest_path, err)
+
+    def save(self):
+        ''' Write the manifest to the manifest file '''
+        if self.manifest_path is None:
+            return
+        # snapshot the manifest, since saves can run on another thread
+        files = {
+            relpath: (state.mtime_ns, state.size, state.key)
+            for relpath, state in list(self._manifest.items()) if state.key is not None
+        }
+        try:
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so an interrupted save never leaves a corrupt manifest behind
+            tmp_path = self.manifest_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps({"version": MANIFEST_VERSION, "files": files}))
+            tmp_path.replace(self.manifest_path)
+        except OSError as err:
+            self._logger.warning("Could not save manifest %s: %s", self.manifest_path, err)
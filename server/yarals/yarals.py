@@ -1,21 +1,37 @@
 ''' Implements a VSCode language server for YARA '''
 import asyncio
-from copy import deepcopy
-from itertools import chain
+from functools import partial
+from itertools import chain, count
 import json
 import logging
 from pathlib import Path
-import re
+import time
+from typing import Awaitable, Callable
 
 from yarals import custom_err as ce
 from yarals import helpers
 from yarals import protocol as lsp
+from yarals.cache import FileCache
+from yarals.compiler import HAS_YARA, CompileEngine, load_yara
+from yarals.completion import CompletionTable
+from yarals.document import TextDocument, get_line_index
+from yarals.includes import has_includes
+from yarals.matcher import MatchEngine, iter_samples
+from yarals.metrics import Metrics, hit_rate
+from yarals.outbound import MessageQueue
+from yarals.parser import CHUNK_CACHE, TokenKind, get_syntax_tree
+from yarals.state import WorkspaceRegistry, WorkspaceState
+from yarals.symbols import SymbolIndex, SymbolOverlay
+from yarals.workspace import DEFAULT_EXCLUDE, DEFAULT_INCLUDE
 
-try:
-    import yara
-    HAS_YARA = True
-except ModuleNotFoundError:
-    HAS_YARA = False
+# number of matches a provider handles before letting other tasks run
+YIELD_INTERVAL = 1000
+# number of locations sent in each $/progress notification when streaming partial results
+PARTIAL_RESULT_SIZE = 500
+# registration id of the file watchers requested from clients
+WATCHER_REGISTRATION = "yara.watchedFiles"
+
+if not HAS_YARA:
     # cannot notify user at this point unfortunately - no clients have connected
     logging.warning("yara-python is not installed. Diagnostics and Compile commands are disabled")
 
@@ -32,6 +48,10 @@ class LanguageServer(object):
         self._eol=b"\r\n"
         self._logger = logging.getLogger(__name__)
         self.num_clients = 0
+        # request counts, latencies and traffic across all clients
+        self.metrics = Metrics()
+        # ids of requests sent to clients
+        self._request_ids = count(1)
 
     def _exc_handler(self, loop, context: dict):
         ''' Appropriately handle exceptions '''
@@ -61,20 +81,38 @@ class LanguageServer(object):
         ''' Read data from the client '''
         # we don't want handle_client() to deal with anything other than dicts
         request = {}
-        data = await reader.readline()
-        if data:
-            # self._logger.debug("header <= %r", data)
-            key, value = tuple(data.decode(self._encoding).strip().split(" "))
-            # read the extra separator after the initial header
-            await reader.readuntil(separator=self._eol)
-            if key == "Content-Length:":
-                data = await reader.readexactly(int(value))
-            else:
-                data = await reader.readline()
-            self._logger.debug("input <= %r", data)
-            request = json.loads(data.decode(self._encoding))
+        try:
+            # the header block ends with an empty line
+            header_block = await reader.readuntil(separator=self._eol * 2)
+        except asyncio.IncompleteReadError:
+            # the client closed the stream
+            return request
+        headers = self.parse_headers(header_block)
+        if b"content-length" in headers:
+            data = await reader.readexactly(int(headers[b"content-length"]))
+        else:
+            data = await reader.readline()
+        self._logger.debug("input <= %r", data)
+        self.metrics.received(len(header_block) + len(data))
+        # parse straight from the raw bytes, since the JSON decoders handle UTF-8 themselves
+        request = lsp.loads(data)
         return request
 
+    @staticmethod
+    def parse_headers(header_block: bytes) -> dict:
+        '''Parse a block of JSON-RPC headers, such as Content-Length and Content-Type
+
+        Returns a dictionary of lowercase header names => raw values
+
+        :header_block: Header lines, including the trailing empty line
+        '''
+        headers = {}
+        for line in header_block.split(b"\r\n"):
+            name, sep, value = line.partition(b":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
     async def remove_client(self, writer: asyncio.StreamWriter):
         ''' Close the cient input & output streams '''
         if writer.can_write_eof():
@@ -85,38 +123,77 @@ class LanguageServer(object):
 
     async def send_error(self, code: int, curr_id: int, msg: str, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC error message to the client '''
-        message = json.dumps({
+        message = lsp.dumps({
             "jsonrpc": "2.0",
             "id": curr_id,
             "error": {
                 "code": code,
                 "message": msg
             }
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
 
     async def send_notification(self, method: str, params: dict, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC notification to the client '''
-        message = json.dumps({
+        message = lsp.dumps({
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params
+        })
+        key = None
+        if method == "textDocument/publishDiagnostics":
+            # only the newest diagnostics for a file matter, so unsent ones can be replaced
+            key = (method, params.get("uri", None))
+        await self.write_data(message, writer, key=key)
+
+    async def send_request(self, method: str, params: dict, writer: asyncio.StreamWriter) -> int:
+        '''Write a JSON-RPC request to the client
+
+        The client's response is only logged, so this is meant for requests
+        whose result the server does not need. Returns the id of the request
+        '''
+        curr_id = next(self._request_ids)
+        message = lsp.dumps({
             "jsonrpc": "2.0",
+            "id": curr_id,
             "method": method,
             "params": params
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
+        return curr_id
 
     async def send_response(self, curr_id: int, response: dict, writer: asyncio.StreamWriter):
         ''' Write back a JSON-RPC response to the client '''
-        message = json.dumps({
+        if isinstance(response, lsp.RawJSON):
+            # the result is already encoded, so just copy it into place
+            message = b'{"jsonrpc":"2.0","id":%s,"result":%s}' % (lsp.dumps(curr_id), response.data)
+            await self.write_data(message, writer)
+            return
+        message = lsp.dumps({
             "jsonrpc": "2.0",
             "id": curr_id,
             "result": response,
-        }, cls=lsp.JSONEncoder)
+        })
         await self.write_data(message, writer)
 
-    async def write_data(self, message: str, writer: asyncio.StreamWriter):
-        ''' Write a JSON-RPC message to the given stream with the proper encoding and formatting '''
-        self._logger.debug("output => %r", message.encode(self._encoding))
-        writer.write("Content-Length: {:d}\r\n\r\n{:s}".format(len(message), message).encode(self._encoding))
+    async def write_data(self, message, writer: asyncio.StreamWriter, key=None):
+        ''' Write a JSON-RPC message to the given stream with the proper encoding and formatting
+
+        :message: JSON message, either as text or already encoded to bytes
+        :writer: asyncio.StreamWriter or MessageQueue to write to
+        :key: (Optional) let a MessageQueue replace an unsent message queued with the same key
+        '''
+        if isinstance(message, str):
+            message = message.encode(self._encoding)
+        self._logger.debug("output => %r", message)
+        # Content-Length counts bytes, not characters
+        frame = b"Content-Length: %d\r\n\r\n" % len(message) + message
+        self.metrics.sent(len(frame))
+        if key is not None and isinstance(writer, MessageQueue):
+            writer.write(frame, key=key)
+        else:
+            writer.write(frame)
+        # only waits for a MessageQueue when the client has fallen far behind
         await writer.drain()
 
 class YaraLanguageServer(LanguageServer):
@@ -124,20 +201,81 @@ class YaraLanguageServer(LanguageServer):
         ''' Handle the particulars of the server's YARA implementation '''
         super().__init__()
         self._logger = logging.getLogger("yara")
-        # variable symbols have a few possible first characters
-        self._varchar = ["$", "#", "@", "!"]
         self.diagnostics_warned = False
         self.hover_langs = [lsp.MarkupKind.Markdown, lsp.MarkupKind.Plaintext]
+        # the modules schema is only loaded once a client connects. See load_modules()
+        self._modules = None
+        self._completions = None
+        # scanners & symbol indexes of every open workspace folder, shared by the clients that opened it
+        self.workspaces = WorkspaceRegistry()
+        # text of files on disk, shared by every client
+        self.files = FileCache()
+        # worker processes for compiling many files at once
+        self.compiler = CompileEngine()
+        # worker threads for scanning sample files with compiled rules
+        self.matcher = MatchEngine(rules=self.compiler.rules)
+        # seconds between summaries of the metrics in the log
+        self.stats_interval = 300
+        self._stats_logger = None
+
+    @property
+    def completions(self) -> CompletionTable:
+        ''' Completion items for every module member, serialized ahead of time '''
+        if self._completions is None:
+            self._completions = CompletionTable(self.modules)
+        return self._completions
+
+    @property
+    def modules(self) -> dict:
+        ''' Schema of the modules and members YARA provides '''
+        if self._modules is None:
+            self.load_modules()
+        return self._modules
+
+    def load_modules(self):
+        ''' Read the modules schema from disk '''
         schema = Path(__file__).parent.joinpath("data", "modules.json").resolve()
-        self.modules = json.loads(schema.read_text())
+        self._modules = json.loads(schema.read_text())
 
     def _get_document(self, file_uri: str, dirty_files: dict) -> str:
         ''' Return the document text for a given file URI either from disk or memory '''
         if file_uri in dirty_files:
-            return dirty_files[file_uri]
+            # open documents are held as TextDocument buffers
+            return str(dirty_files[file_uri])
         file_path = helpers.parse_uri(file_uri, encoding=self._encoding)
-        with open(file_path, "r") as rule_file:
-            return rule_file.read()
+        return self.files.read(file_path)
+
+    def _get_loader(self, file_uri: str, dirty_files: dict):
+        ''' Build a callable that returns the latest text of a file when the symbol index needs it '''
+        if file_uri in dirty_files:
+            document = dirty_files[file_uri]
+            return lambda: str(document)
+        return lambda: self._get_document(file_uri, {})
+
+    @staticmethod
+    def _snapshot(dirty_files: dict) -> dict:
+        ''' Copy the text of every open document, so it can be read outside of the event loop '''
+        return {file_uri: str(document) for file_uri, document in dirty_files.items()}
+
+    @staticmethod
+    def _resolve_symbol(params: dict, document: str) -> tuple:
+        '''Find the symbol at a request's position
+
+        Returns the document's syntax tree, the offset of the position,
+        and the identifier or string token at it (or None)
+        '''
+        pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
+        offset = get_line_index(document).offset_at(pos)
+        tree = get_syntax_tree(document)
+        token = tree.token_at(offset)
+        if token is None or not (token.is_string or token.kind == TokenKind.IDENTIFIER) or not token.name.strip("*"):
+            return tree, offset, None
+        return tree, offset, token
+
+    @staticmethod
+    def _token_range(token, lines) -> lsp.Range:
+        ''' Convert a token's offsets to a range '''
+        return lsp.Range(start=lines.position_at(token.start), end=lines.position_at(token.end))
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         '''React and respond to client messages
@@ -146,16 +284,37 @@ class YaraLanguageServer(LanguageServer):
         :writer: asyncio.StreamWriter. The connected client will read from this stream
         '''
         config = {}
-        # file_uri => contents
+        # file_uri => TextDocument
         dirty_files = {}
+        # file_uri => diagnostics task that has not published yet
+        pending_diagnostics = {}
+        # request id => task answering the request
+        requests = {}
+        # diagnostics for files changed outside of the editor that have not published yet
+        background = set()
         has_started = False
+        # whether the client can be asked to watch the workspace for changes
+        watch_files = False
+        # workspace shared with other clients, and this client's view of its symbols
+        state = None
+        symbols = None
+        # batch outgoing messages and stop producing them if the client stops reading
+        writer = MessageQueue(writer)
         self._logger.info("Client connected")
         self.num_clients += 1
+        if self._stats_logger is None or self._stats_logger.done():
+            self._stats_logger = asyncio.ensure_future(self.log_stats())
         while True:
             try:
                 if reader.at_eof():
                     self._logger.warning("Client has closed")
                     self.num_clients -= 1
+                    for task in chain(requests.values(), pending_diagnostics.values(), background):
+                        task.cancel()
+                    if state is not None:
+                        self.release_workspace(state)
+                    if self.num_clients <= 0:
+                        self._stats_logger.cancel()
                     break
                 elif self.num_clients <= 0:
                     # clear out memory
@@ -163,25 +322,38 @@ class YaraLanguageServer(LanguageServer):
                     # remove connected clients
                     await self.remove_client(writer)
                 message = await self.read_request(reader)
+                received = time.perf_counter()
                 # this matches some kind of JSON-RPC message
                 if "jsonrpc" in message:
                     method = message.get("method", "")
                     self._logger.debug("Client sent a '%s' message", method)
+                    # if there is no method, this is the response to a request the server sent
+                    if not method:
+                        if "error" in message:
+                            self._logger.warning("Client could not handle request %s: %s", message.get("id", None), message["error"])
+                        continue
                     # if an id is present, this is a JSON-RPC request
-                    if "id" in message:
+                    elif "id" in message:
                         if not has_started and method == "initialize":
-                            rootdir = helpers.parse_uri(message["params"]["rootUri"], encoding=self._encoding)
+                            rootdir = helpers.parse_uri(message["params"].get("rootUri", None), encoding=self._encoding)
                             if rootdir:
-                                self.workspace = Path(rootdir)
-                                self._logger.info("Client workspace folder: %s", self.workspace)
+                                self._logger.info("Client workspace folder: %s", rootdir)
                             else:
                                 self._logger.info("No client workspace specified")
-                                self.workspace = False
+                            state = self.workspaces.open(Path(rootdir) if rootdir else None)
+                            symbols = state.overlay()
                             client_options = message.get("params", {}).get("capabilities", {})
+                            watch_files = client_options.get("workspace", {}).get("didChangeWatchedFiles", {}).get("dynamicRegistration", False)
                             announcement = self.initialize(client_options)
                             await self.send_response(message["id"], announcement, writer)
+                            # the client has its answer, so load everything startup skipped
+                            asyncio.ensure_future(self.warm_up())
+                            # only the first client of a workspace has to wait for it to be indexed
+                            if state.root and state.indexer is None:
+                                state.indexer = asyncio.ensure_future(self.index_workspace(state))
                         elif has_started and method == "shutdown":
                             self._logger.info("Client requested shutdown")
+                            self.compiler.cache.save()
                             await self.send_response(message["id"], {}, writer)
                             # explicitly clear the dirty files on shutdown
                             dirty_files.clear()
@@ -189,14 +361,18 @@ class YaraLanguageServer(LanguageServer):
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
                             if file_uri:
                                 document = self._get_document(file_uri, dirty_files)
-                                completions = await self.provide_code_completion(message["params"], document)
-                                await self.send_response(message["id"], completions, writer)
+                                handler = partial(self.provide_code_completion, message["params"], document)
+                                self.start_request(message["id"], handler, requests, writer, method)
                         elif has_started and method == "textDocument/definition":
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
                             if file_uri:
                                 document = self._get_document(file_uri, dirty_files)
-                                definition = await self.provide_definition(message["params"], document)
-                                await self.send_response(message["id"], definition, writer)
+                                token = message["params"].get("partialResultToken", None)
+                                if token is None:
+                                    handler = partial(self.provide_definition, message["params"], document, symbols)
+                                else:
+                                    handler = partial(self.stream_results, token, self.iter_definitions(message["params"], document, symbols), writer)
+                                self.start_request(message["id"], handler, requests, writer, method)
                         # elif has_started and method == "textDocument/documentHighlight":
                         #     highlights = await self.provide_highlight(message["params"])
                         #     await self.send_response(message["id"], highlights, writer)
@@ -204,29 +380,41 @@ class YaraLanguageServer(LanguageServer):
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
                             if file_uri:
                                 document = self._get_document(file_uri, dirty_files)
-                                hovers = await self.provide_hover(message["params"], document)
-                                await self.send_response(message["id"], hovers, writer)
+                                handler = partial(self.provide_hover, message["params"], document)
+                                self.start_request(message["id"], handler, requests, writer, method)
                         elif has_started and method == "textDocument/references":
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
                             if file_uri:
                                 document = self._get_document(file_uri, dirty_files)
-                                references = await self.provide_reference(message["params"], document)
-                                await self.send_response(message["id"], references, writer)
+                                token = message["params"].get("partialResultToken", None)
+                                if token is None:
+                                    handler = partial(self.provide_reference, message["params"], document, symbols)
+                                else:
+                                    handler = partial(self.stream_results, token, self.iter_references(message["params"], document, symbols), writer)
+                                self.start_request(message["id"], handler, requests, writer, method)
                         elif has_started and method == "textDocument/rename":
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
                             if file_uri:
                                 document = self._get_document(file_uri, dirty_files)
-                                renames = await self.provide_rename(message["params"], document, file_uri)
-                                await self.send_response(message["id"], renames, writer)
+                                handler = partial(self.provide_rename, message["params"], document, file_uri)
+                                self.start_request(message["id"], handler, requests, writer, method)
+                        elif has_started and method == "yara/stats":
+                            await self.send_response(message["id"], self.get_stats(), writer)
                         elif has_started and method == "workspace/executeCommand":
-                            await self.execute_command(message["params"], dirty_files, writer)
+                            # commands can take a long time, so keep serving other requests while they run
+                            handler = partial(self.execute_command, message["params"], dirty_files, writer, state)
+                            self.start_request(message["id"], handler, requests, writer, method)
                     # if no id is present, this is a JSON-RPC notification
                     else:
-                        if method == "initialized":
+                        if method == "$/cancelRequest":
+                            await self.cancel_request(message.get("params", {}).get("id", None), requests, writer)
+                        elif method == "initialized":
                             self._logger.info("Client has been successfully initialized")
                             has_started = True
                             params = {"type": lsp.MessageType.INFO, "message": "Successfully connected"}
                             await self.send_notification("window/showMessageRequest", params, writer)
+                            if watch_files and state.root and state.root.is_dir():
+                                await self.register_file_watchers(state, writer)
                         elif has_started and method == "exit":
                             # first remove the client associated with this handler
                             await self.remove_client(writer)
@@ -234,39 +422,85 @@ class YaraLanguageServer(LanguageServer):
                         elif has_started and method == "workspace/didChangeConfiguration":
                             config = message.get("params", {}).get("settings", {}).get("yara", {})
                             self._logger.debug("Changed workspace config to %s", json.dumps(config))
-                        elif has_started and method == "textDocument/didChange":
-                            file_uri = message.get("params", {}).get("textDocument", {}).get("uri", None)
+                            self.configure_cache(config, state)
+                            if self.configure_workspace(config, state) and watch_files and state.root.is_dir():
+                                # watch the files matching the new patterns instead
+                                await self.register_file_watchers(state, writer, replace=True)
+                        elif has_started and method == "workspace/didChangeWatchedFiles":
+                            changes = message.get("params", {}).get("changes", [])
+                            changed, deleted = self.apply_file_changes(changes, state, dirty_files)
+                            self._logger.info("%d rule files changed and %d were deleted outside of the editor", len(changed), len(deleted))
+                            for file_uri in deleted:
+                                if file_uri in pending_diagnostics:
+                                    pending_diagnostics.pop(file_uri).cancel()
+                                params = {"uri": file_uri, "diagnostics": []}
+                                await self.send_notification("textDocument/publishDiagnostics", params, writer)
+                            if (changed or deleted) and config.get("compile_on_save", False):
+                                # only the files that changed and the files including them are compiled
+                                files = dict.fromkeys(changed)
+                                for file_uri in chain(changed, deleted):
+                                    files.update(dict.fromkeys(symbols.dependents(file_uri)))
+                                self.schedule_file_diagnostics(list(files), dirty_files, pending_diagnostics, background, writer)
+                        elif has_started and method == "textDocument/didOpen":
+                            text_doc = message.get("params", {}).get("textDocument", {})
+                            file_uri = text_doc.get("uri", None)
                             if file_uri:
                                 self._logger.debug("Adding %s to dirty files list", file_uri)
-                                for changes in message.get("params", {}).get("contentChanges", []):
-                                    # full text is submitted with each change
-                                    change = changes.get("text", None)
-                                    if change:
-                                        dirty_files[file_uri] = change
+                                dirty_files[file_uri] = TextDocument(file_uri, text_doc.get("text", ""), text_doc.get("version", 0))
+                                # unsaved text is only visible to this client
+                                symbols.invalidate(file_uri, self._get_loader(file_uri, dirty_files))
+                        elif has_started and method == "textDocument/didChange":
+                            text_doc = message.get("params", {}).get("textDocument", {})
+                            file_uri = text_doc.get("uri", None)
+                            if file_uri:
+                                if file_uri not in dirty_files:
+                                    self._logger.debug("Adding %s to dirty files list", file_uri)
+                                    dirty_files[file_uri] = TextDocument(file_uri, self._get_document(file_uri, dirty_files))
+                                # changes are either range edits or the full text of the document
+                                changes = message.get("params", {}).get("contentChanges", [])
+                                dirty_files[file_uri].apply_changes(changes, text_doc.get("version", None))
+                                symbols.invalidate(file_uri, self._get_loader(file_uri, dirty_files))
+                                if config.get("compile_on_type", False):
+                                    # wait for a pause in typing before compiling
+                                    delay = config.get("compile_on_type_delay", 500) / 1000
+                                    self.schedule_diagnostics(file_uri, dirty_files[file_uri], pending_diagnostics, writer, delay, dirty_files)
+                                    # open files including this one are compiled against the unsaved text too
+                                    for dependent_uri in symbols.dependents(file_uri):
+                                        if dependent_uri in dirty_files:
+                                            self.schedule_diagnostics(dependent_uri, dirty_files[dependent_uri], pending_diagnostics, writer, delay, dirty_files)
                         elif has_started and method == "textDocument/didClose":
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", "")
                             # file is no longer dirty after closing
                             if file_uri in dirty_files:
                                 del dirty_files[file_uri]
                                 self._logger.debug("Removed %s from dirty files list", file_uri)
+                            if file_uri in pending_diagnostics:
+                                pending_diagnostics.pop(file_uri).cancel()
+                            # fall back to the shared index of whatever is on disk (if anything)
+                            symbols.close(file_uri)
                         elif has_started and method == "textDocument/didSave":
                             file_uri = message.get("params", {}).get("textDocument", {}).get("uri", "")
-                            # file is no longer dirty after saving
-                            if file_uri in dirty_files:
-                                del dirty_files[file_uri]
-                                self._logger.debug("Removed %s from dirty files list", file_uri)
+                            if state.includes(Path(helpers.parse_uri(file_uri, encoding=self._encoding) or "")):
+                                # the saved text is on disk now, so every client should see it
+                                state.symbols.invalidate(file_uri, self._get_loader(file_uri, {}))
+                            # the buffer is kept after saving, since incremental changes
+                            # will keep being applied to it until the file is closed
                             if config.get("compile_on_save", False):
-                                file_path = helpers.parse_uri(file_uri)
-                                with open(file_path, "rb") as ifile:
-                                    document = ifile.read().decode(self._encoding)
-                                diagnostics = await self.provide_diagnostic(document)
+                                document = dirty_files[file_uri] if file_uri in dirty_files else self._get_document(file_uri, dirty_files)
+                                # saved files are the ones likely to be scanned with, so their rules are kept
+                                self.schedule_diagnostics(file_uri, document, pending_diagnostics, writer, dirty_files=dirty_files, store_rules=True)
+                                # files including this one may have broken (or been fixed) too
+                                dependents = symbols.dependents(file_uri)
+                                self.schedule_file_diagnostics(dependents, dirty_files, pending_diagnostics, background, writer)
                             else:
-                                diagnostics = []
-                            params = {
-                                "uri": file_uri,
-                                "diagnostics": diagnostics
-                            }
-                            await self.send_notification("textDocument/publishDiagnostics", params, writer)
+                                params = {
+                                    "uri": file_uri,
+                                    "diagnostics": []
+                                }
+                                await self.send_notification("textDocument/publishDiagnostics", params, writer)
+                    # requests answered in their own task are timed by handle_request()
+                    if message.get("id", None) not in requests:
+                        self.metrics.record(method, time.perf_counter() - received)
             except ce.NoYaraPython as warn:
                 self._logger.warning(warn)
                 params = {
@@ -275,13 +509,117 @@ class YaraLanguageServer(LanguageServer):
                 }
                 await self.send_notification("window/showMessage", params, writer)
             except (ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, ce.HighlightError, \
-                    ce.HoverError, ce.RenameError, ce.SymbolReferenceError) as err:
+                    ce.HoverError, ce.RenameError, ce.ScanError, ce.SymbolReferenceError) as err:
                 self._logger.error(err)
+                self.metrics.error(method)
                 params = {
                     "type": lsp.MessageType.ERROR,
                     "message": str(err)
                 }
                 await self.send_notification("window/showMessage", params, writer)
+            except ConnectionResetError:
+                # stop sharing the workspace with a client that is gone, then let _exc_handler() remove it
+                if state is not None:
+                    self.release_workspace(state)
+                raise
+
+    def start_request(self, curr_id: int, handler: Callable[[], Awaitable], requests: dict, writer: asyncio.StreamWriter, method: str=None):
+        '''Answer a request in a separate task, so other messages can be handled in the meantime
+
+        :curr_id: ID of the request
+        :handler: Callable returning the coroutine that provides the result
+        :requests: Dictionary of request id => running tasks for the client
+        :writer: asyncio.StreamWriter to respond to
+        :method: (Optional) JSON-RPC method of the request, for the metrics
+        '''
+        task = asyncio.ensure_future(self.handle_request(curr_id, handler, requests, writer, method, time.perf_counter()))
+        requests[curr_id] = task
+        task.add_done_callback(lambda done: requests.pop(curr_id) if requests.get(curr_id) is done else None)
+        return task
+
+    async def handle_request(self, curr_id: int, handler: Callable[[], Awaitable], requests: dict, writer: asyncio.StreamWriter,
+                             method: str=None, started: float=None):
+        '''Run a request handler and send its result back to the client
+
+        :curr_id: ID of the request
+        :handler: Callable returning the coroutine that provides the result
+        :requests: Dictionary of request id => running tasks for the client
+        :writer: asyncio.StreamWriter to respond to
+        :method: (Optional) JSON-RPC method of the request, for the metrics
+        :started: (Optional) time.perf_counter() value from when the request arrived
+        '''
+        method = method or "unknown"
+        started = time.perf_counter() if started is None else started
+        try:
+            result = await handler()
+            # past this point the request can no longer be cancelled
+            if requests.pop(curr_id, None) is None:
+                # ... unless cancel_request() already answered while the handler was finishing up
+                return
+            await self.send_response(curr_id, result, writer)
+            self.metrics.record(method, time.perf_counter() - started)
+        except asyncio.CancelledError:
+            # cancel_request() has already answered the client
+            self.metrics.cancelled(method)
+        except ce.NoYaraPython as warn:
+            self._logger.warning(warn)
+            self.metrics.error(method)
+            params = {
+                "type": lsp.MessageType.WARNING,
+                "message": str(warn)
+            }
+            await self.send_notification("window/showMessage", params, writer)
+        except (ce.CodeCompletionError, ce.DefinitionError, ce.DiagnosticError, ce.HighlightError, \
+                ce.HoverError, ce.RenameError, ce.ScanError, ce.SymbolReferenceError) as err:
+            self._logger.error(err)
+            self.metrics.error(method)
+            params = {
+                "type": lsp.MessageType.ERROR,
+                "message": str(err)
+            }
+            await self.send_notification("window/showMessage", params, writer)
+        except Exception as err:
+            # a bug in a handler must not leave the client waiting for an answer forever
+            self._logger.exception("Could not handle %s request %s", method, curr_id)
+            self.metrics.error(method)
+            await self.send_error(lsp.JsonRPCError.INTERNAL_ERROR, curr_id, str(err), writer)
+
+    async def stream_results(self, token, results, writer: asyncio.StreamWriter) -> list:
+        '''Report results to the client in chunks, as they are found
+
+        Only one chunk is held in memory at a time. Per the protocol, the final
+        response is empty once results have been reported with $/progress
+
+        :token: partialResultToken sent by the client with the request
+        :results: Async iterator producing the results
+        :writer: asyncio.StreamWriter to report results to
+        '''
+        chunk = []
+        try:
+            async for result in results:
+                chunk.append(result)
+                if len(chunk) >= PARTIAL_RESULT_SIZE:
+                    await self.send_notification("$/progress", {"token": token, "value": chunk}, writer)
+                    chunk = []
+            if chunk:
+                await self.send_notification("$/progress", {"token": token, "value": chunk}, writer)
+        finally:
+            # stop the search right away if the request was cancelled
+            await results.aclose()
+        return []
+
+    async def cancel_request(self, curr_id: int, requests: dict, writer: asyncio.StreamWriter):
+        '''Cancel a running request, if it has not already been answered
+
+        :curr_id: ID of the request to cancel
+        :requests: Dictionary of request id => running tasks for the client
+        :writer: asyncio.StreamWriter to respond to
+        '''
+        task = requests.pop(curr_id, None)
+        if task is not None and not task.done():
+            self._logger.debug("Cancelling request %s", curr_id)
+            task.cancel()
+            await self.send_error(lsp.JsonRPCError.REQUEST_CANCELLED, curr_id, "Request cancelled", writer)
 
     def initialize(self, client_options: dict) -> dict:
         '''Announce language support methods
@@ -311,6 +649,8 @@ class YaraLanguageServer(LanguageServer):
             if HAS_YARA:
                 server_options["executeCommandProvider"]["commands"].append("yara.CompileRule")
                 server_options["executeCommandProvider"]["commands"].append("yara.CompileAllRules")
+                server_options["executeCommandProvider"]["commands"].append("yara.ScanFile")
+                server_options["executeCommandProvider"]["commands"].append("yara.ScanDirectory")
         # if doc_options.get("formatting", {}).get("dynamicRegistration", False):
         #     server_options["documentFormattingProvider"] = True
         if doc_options.get("references", {}).get("dynamicRegistration", False):
@@ -318,174 +658,526 @@ class YaraLanguageServer(LanguageServer):
         if doc_options.get("rename", {}).get("dynamicRegistration", False):
             server_options["renameProvider"] = True
         if doc_options.get("synchronization", {}).get("dynamicRegistration", False):
-            # Documents are synced by always sending the full content of the document
-            server_options["textDocumentSync"] = lsp.TextSyncKind.FULL
+            # Documents are synced by sending only the edited ranges of the document
+            server_options["textDocumentSync"] = lsp.TextSyncKind.INCREMENTAL
         return {"capabilities": server_options}
 
-    async def execute_command(self, params: dict, dirty_files: dict, writer: asyncio.StreamWriter):
+    def schedule_diagnostics(self, file_uri: str, document, pending: dict, writer: asyncio.StreamWriter, delay: float=0, dirty_files: dict=None, store_rules: bool=False):
+        '''Compile a document in the background and publish its diagnostics
+
+        Any compile already scheduled for the same document is cancelled,
+        so bursts of changes only compile once, after the last change
+
+        :file_uri: URI of the document
+        :document: TextDocument buffer or plain document text
+        :pending: Dictionary of file_uri => scheduled tasks for the client
+        :writer: asyncio.StreamWriter to publish diagnostics to
+        :delay: (Optional) seconds to wait before compiling
+        :dirty_files: (Optional) open documents, which included files are read from before the disk
+        :store_rules: (Optional) save the compiled rules to the rules store
+        '''
+        if file_uri in pending:
+            pending.pop(file_uri).cancel()
+        task = asyncio.ensure_future(self.publish_diagnostics(file_uri, document, writer, delay, dirty_files, store_rules))
+        pending[file_uri] = task
+        task.add_done_callback(lambda done: pending.pop(file_uri) if pending.get(file_uri) is done else None)
+        return task
+
+    async def publish_diagnostics(self, file_uri: str, document, writer: asyncio.StreamWriter, delay: float=0, dirty_files: dict=None, store_rules: bool=False):
+        '''Compile a document and publish the results, unless the document changed in the meantime
+
+        :file_uri: URI of the document
+        :document: TextDocument buffer or plain document text
+        :writer: asyncio.StreamWriter to publish diagnostics to
+        :delay: (Optional) seconds to wait before compiling
+        :dirty_files: (Optional) open documents, which included files are read from before the disk
+        :store_rules: (Optional) save the compiled rules to the rules store
+        '''
+        if delay > 0:
+            await asyncio.sleep(delay)
+        version = getattr(document, "version", None)
+        text = str(document)
+        # only documents with includes need the text of the other open documents
+        overlay = self._snapshot(dirty_files) if dirty_files and has_includes(text) else None
+        try:
+            diagnostics = await self.provide_diagnostic(text, file_uri, overlay, store_rules)
+        except ce.NoYaraPython as warn:
+            self._logger.warning(warn)
+            params = {"type": lsp.MessageType.WARNING, "message": str(warn)}
+            await self.send_notification("window/showMessage", params, writer)
+            return
+        except ce.DiagnosticError as err:
+            params = {"type": lsp.MessageType.ERROR, "message": str(err)}
+            await self.send_notification("window/showMessage", params, writer)
+            return
+        if version is not None and version != document.version:
+            self._logger.debug("Dropping diagnostics for outdated version %d of %s", version, file_uri)
+            return
+        params = {
+            "uri": file_uri,
+            "diagnostics": diagnostics or []
+        }
+        await self.send_notification("textDocument/publishDiagnostics", params, writer)
+
+    def schedule_file_diagnostics(self, files: list, dirty_files: dict, pending: dict, background: set, writer: asyncio.StreamWriter):
+        '''Compile several files in the background and publish their diagnostics
+
+        Open documents are compiled from their buffers. The others are
+        compiled from disk in parallel
+
+        :files: URIs of the files to compile
+        :dirty_files: Open documents, which take precedence over their on-disk contents
+        :pending: Dictionary of file_uri => scheduled tasks for the client
+        :background: Set of other running tasks for the client
+        :writer: asyncio.StreamWriter to publish diagnostics to
+        '''
+        on_disk = []
+        for file_uri in files:
+            if file_uri in dirty_files:
+                self.schedule_diagnostics(file_uri, dirty_files[file_uri], pending, writer, dirty_files=dirty_files)
+            else:
+                on_disk.append(file_uri)
+        if on_disk:
+            task = asyncio.ensure_future(self.publish_file_diagnostics(on_disk, writer, dirty_files))
+            background.add(task)
+            task.add_done_callback(background.discard)
+
+    async def publish_file_diagnostics(self, files: list, writer: asyncio.StreamWriter, dirty_files: dict=None):
+        '''Compile files on disk in parallel and publish the results of each as it finishes
+
+        Unlike CompileAllRules, files without errors are published too,
+        clearing any diagnostics shown for them before they changed
+
+        :files: URIs of the files to compile
+        :writer: asyncio.StreamWriter to publish diagnostics to
+        :dirty_files: (Optional) open documents, which included files are read from before the disk
+        '''
+        if not HAS_YARA:
+            return
+        overlay = self._snapshot(dirty_files or {})
+        async for file_uri, diagnostics in self.compiler.compile_all(dict.fromkeys(files), self._encoding, overlay=overlay):
+            params = {"uri": file_uri, "diagnostics": diagnostics}
+            await self.send_notification("textDocument/publishDiagnostics", params, writer)
+
+    async def register_file_watchers(self, state: WorkspaceState, writer: asyncio.StreamWriter, replace: bool=False):
+        '''Ask the client to notify the server about rule files changed outside of the editor
+
+        :state: Workspace the client opened
+        :writer: asyncio.StreamWriter of the client
+        :replace: (Optional) remove the watchers registered before
+        '''
+        if replace:
+            params = {"unregisterations": [{"id": WATCHER_REGISTRATION, "method": "workspace/didChangeWatchedFiles"}]}
+            await self.send_request("client/unregisterCapability", params, writer)
+        watchers = [{"globPattern": pattern} for pattern in state.scanner.watch_patterns()]
+        params = {
+            "registrations": [{
+                "id": WATCHER_REGISTRATION,
+                "method": "workspace/didChangeWatchedFiles",
+                "registerOptions": {"watchers": watchers}
+            }]
+        }
+        await self.send_request("client/registerCapability", params, writer)
+
+    def apply_file_changes(self, changes: list, state: WorkspaceState, dirty_files: dict) -> tuple:
+        '''Update the workspace state for files created, changed or deleted outside of the editor
+
+        Only the files in the changes are touched. The shared state is always
+        updated, but documents the client has open are not reported back,
+        since their buffers are newer than whatever is on disk
+
+        Returns the URIs of the files that were created or changed,
+        and the URIs of the files that were deleted
+
+        :changes: FileEvents from a workspace/didChangeWatchedFiles notification
+        :state: Workspace the client opened
+        :dirty_files: Open documents, which take precedence over their on-disk contents
+        '''
+        changed, deleted = [], []
+        if not state.root:
+            return changed, deleted
+        # file_uri => latest type of change, since a file can change several times in one batch
+        latest = {}
+        for change in changes:
+            if change.get("uri", None):
+                latest[change["uri"]] = change.get("type", lsp.FileChangeType.CHANGED)
+        for file_uri, change_type in latest.items():
+            file_path = helpers.parse_uri(file_uri, encoding=self._encoding)
+            if not state.includes(Path(file_path)):
+                continue
+            # whatever the change was, the next scan has to look at the file again
+            state.scanner.forget(file_path)
+            if change_type == lsp.FileChangeType.DELETED:
+                state.symbols.remove(file_uri)
+            else:
+                state.symbols.invalidate(file_uri, self._get_loader(file_uri, {}))
+            if file_uri in dirty_files:
+                continue
+            elif change_type == lsp.FileChangeType.DELETED:
+                deleted.append(file_uri)
+            else:
+                changed.append(file_uri)
+        return changed, deleted
+
+    def get_stats(self) -> dict:
+        ''' Collect the metrics and cache statistics answered by the yara/stats request '''
+        stats = self.metrics.to_dict()
+        stats["clients"] = self.num_clients
+        stats["compiles"] = self.compiler.compile_times.to_dict()
+        stats["scans"] = self.matcher.scan_times.to_dict()
+        caches = {
+            "diagnostics": hit_rate(self.compiler.cache.hits, self.compiler.cache.misses),
+            "files": hit_rate(self.files.hits, self.files.misses),
+            "rules": hit_rate(self.compiler.rules.hits, self.compiler.rules.misses),
+            "rule_chunks": hit_rate(CHUNK_CACHE.hits, CHUNK_CACHE.misses)
+        }
+        for name, cached in (("line_indexes", get_line_index), ("syntax_trees", get_syntax_tree)):
+            info = cached.cache_info()
+            caches[name] = hit_rate(info.hits, info.misses)
+        stats["caches"] = caches
+        stats["workspaces"] = {
+            str(state.root): {"clients": state.clients, "files": len(state.symbols)}
+            for state in self.workspaces
+        }
+        return stats
+
+    async def index_workspace(self, state: WorkspaceState):
+        '''Build the shared symbol index for a workspace in the background
+
+        Documents clients have open are indexed in their own overlays, so only files on disk are read
+
+        :state: Workspace to index
+        '''
+        self._logger.info("Indexing rules in %s", state.root)
+        loop = asyncio.get_event_loop()
+        symbols = await loop.run_in_executor(None, SymbolIndex.from_workspace, state.root, self._encoding, state.scanner)
+        # every client's overlay keeps pointing at the same index
+        state.symbols.replace(symbols)
+        self._logger.info("Indexed %d rule files in %s", len(symbols), state.root)
+
+    async def warm_up(self):
+        ''' Import yara-python and load the modules schema in the background '''
+        loop = asyncio.get_event_loop()
+        try:
+            if HAS_YARA:
+                await loop.run_in_executor(None, load_yara)
+            await loop.run_in_executor(None, lambda: self.completions)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            # anything that failed here will fail again (and be reported) when it is first used
+            self._logger.warning("Could not preload language data: %s", err)
+
+    async def log_stats(self):
+        ''' Log a summary of the metrics every stats_interval seconds, while anything is happening '''
+        last_seen = None
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if self.metrics.messages_in == last_seen:
+                continue
+            last_seen = self.metrics.messages_in
+            summary = self.metrics.summary()
+            compiles = self.compiler.compile_times
+            if compiles.count:
+                cache = hit_rate(self.compiler.cache.hits, self.compiler.cache.misses)
+                summary += "; compiles: {:d}, p50 {:g} ms, cache hit rate {:.0%}".format(
+                    compiles.count, compiles.percentile(0.5), cache["hit_rate"] or 0
+                )
+            self._logger.info("Stats: %s", summary)
+
+    def configure_cache(self, config: dict, state: WorkspaceState):
+        '''Persist compile results, compiled rules and the workspace manifest under the workspace if the user asked for it
+
+        The compile cache and the rules store are shared by every client,
+        so they are saved under whichever workspace enabled persistence last
+
+        :config: The client's "yara" settings
+        :state: Workspace the client opened
+        '''
+        cache = self.compiler.cache
+        rules = self.compiler.rules
+        cache.resize(int(config.get("compile_cache_size", 4096)))
+        max_bytes = int(config.get("compiled_rules_cache_size", 64) * 2**20)
+        if config.get("persist_compile_cache", False) and state.root:
+            path = state.root.joinpath(".yarals", "compile_cache.json")
+            if cache.path != path:
+                cache.path = path
+                cache.load()
+            rules.configure(path.with_name("rules"), max_bytes)
+            manifest_path = path.with_name("manifest.json")
+            if state.scanner.manifest_path != manifest_path:
+                state.scanner.manifest_path = manifest_path
+                state.scanner.load()
+        elif state.root:
+            if cache.path is not None and cache.path.parent == state.root.joinpath(".yarals"):
+                cache.path = None
+            if rules.path is not None and rules.path.parent == state.root.joinpath(".yarals"):
+                rules.configure(None)
+            state.scanner.manifest_path = None
+
+    def release_workspace(self, state: WorkspaceState):
+        '''Stop sharing a workspace with a client that is gone
+
+        Once its last client is gone, the compile results of its files are no longer kept on its behalf
+
+        :state: Workspace the client opened
+        '''
+        if self.workspaces.release(state) and state.root:
+            self.compiler.cache.pin(state.root, ())
+
+    def configure_workspace(self, config: dict, state: WorkspaceState) -> bool:
+        '''Apply the user's patterns of workspace files to include and exclude
+
+        The workspace is indexed again if the patterns changed. Returns whether they did.
+        The patterns are shared by every client of the workspace, so the last client to change them wins
+
+        :config: The client's "yara" settings
+        :state: Workspace the client opened
+        '''
+        if not state.root:
+            return False
+        include = config.get("workspace_include", DEFAULT_INCLUDE)
+        exclude = config.get("workspace_exclude", DEFAULT_EXCLUDE)
+        if state.scanner.configure(include, exclude):
+            self._logger.info("Including %s and excluding %s in %s", include, exclude, state.root)
+            if state.indexer is not None:
+                state.indexer.cancel()
+            state.indexer = asyncio.ensure_future(self.index_workspace(state))
+            return True
+        return False
+
+    async def execute_command(self, params: dict, dirty_files: dict, writer: asyncio.StreamWriter, state: WorkspaceState=None):
         cmd = params.get("command", "")
+        # clients without a workspace folder only have their open documents
+        state = WorkspaceState() if state is None else state
         args = params.get("arguments", [])
         if cmd == "yara.CompileRule":
             self._logger.info("Compiling rule per user's request")
         elif cmd == "yara.CompileAllRules":
             # temp copy of filenames => contents
-            # do a deep copy in order to not mess with dirty file contents
-            documents = deepcopy(dirty_files)
-            if self.workspace:
-                self._logger.info("Compiling all rules in %s per user's request", self.workspace)
-                for file in chain(self.workspace.glob("**/*.yara"), self.workspace.glob("**/*.yar")):
+            # snapshot the buffer text in order to not mess with dirty file contents
+            overlay = self._snapshot(dirty_files)
+            documents = dict(overlay)
+            # file_uri => content hash of files on disk. Filled in as files are read
+            keys = {}
+            # file_uri => Path of files on disk
+            paths = {}
+            loop = asyncio.get_event_loop()
+            if state.root:
+                self._logger.info("Compiling all rules in %s per user's request", state.root)
+                scan = await loop.run_in_executor(None, state.scanner.scan)
+                self._logger.info("Found %d rule files, %d changed since the last scan", len(scan), len(scan.changed))
+                for file in chain(scan.changed, scan.unchanged):
                     file_uri = file.as_uri()
-                    documents[file_uri] = self._get_document(file_uri, dirty_files)
+                    paths[file_uri] = file
+                    # files on disk are read by the compile workers themselves
+                    documents.setdefault(file_uri, None)
+                for file, key in scan.unchanged.items():
+                    if file.as_uri() not in dirty_files:
+                        # unchanged files are answered from the cache without reading them
+                        keys[file.as_uri()] = key
+                # so compiling the changed files can't evict the results of the unchanged ones
+                self.compiler.cache.pin(state.root, keys.values())
             else:
                 self._logger.warning("No workspace specified in initialization. CompileAllRules will only work on open docs")
                 self._logger.info("Compiling all unsaved files per user's request")
-                documents = dirty_files
-            # documents should be a list of file contents
-            for file_uri, document in documents.items():
-                diagnostics = await self.provide_diagnostic(document)
+            # results are published as soon as each file finishes compiling
+            async for file_uri, diagnostics in self.compiler.compile_all(documents, self._encoding, keys, overlay, state.root):
                 if diagnostics:
                     result = {
                         "uri": file_uri,
                         "diagnostics": diagnostics
                     }
                     await self.send_notification("textDocument/publishDiagnostics", result, writer)
+            if state.root:
+                # files deleted since the last scan would otherwise keep their diagnostics and symbols
+                for file in scan.removed:
+                    file_uri = file.as_uri()
+                    state.symbols.remove(file_uri)
+                    if file_uri not in dirty_files:
+                        result = {"uri": file_uri, "diagnostics": []}
+                        await self.send_notification("textDocument/publishDiagnostics", result, writer)
+                for file_uri, file in paths.items():
+                    if file_uri in keys and file_uri not in dirty_files:
+                        state.scanner.update(file, keys[file_uri])
+                # keep the results the manifest refers to, however many files the workspace has
+                self.compiler.cache.pin(state.root, keys.values())
+            # remember these results across restarts (if enabled)
+            await loop.run_in_executor(None, self.compiler.cache.save)
+            if state.root:
+                await loop.run_in_executor(None, state.scanner.save)
+        elif cmd in ("yara.ScanFile", "yara.ScanDirectory"):
+            return await self.scan_samples(params, dirty_files, writer, state)
         else:
             self._logger.warning("Unknown command: %s [%s]", cmd, ",".join(args))
 
-    async def provide_code_completion(self, params: dict, document: str) -> list:
+    async def scan_samples(self, params: dict, dirty_files: dict, writer: asyncio.StreamWriter, state: WorkspaceState) -> list:
+        '''Scan a file or every file in a folder with the rules in the workspace
+
+        The arguments are the path or URI of the file or folder to scan, and
+        optionally the URI of a single rule file to scan with instead of every
+        rule file in the workspace. Open documents are compiled as they appear
+        in the editor, and the rules are compiled once before anything is scanned.
+
+        If the client sent a partialResultToken, the result of each file is
+        reported with $/progress as soon as it is scanned. Otherwise every
+        result is sent in the response. If the client sent a workDoneToken,
+        each file is also reported as a progress message
+
+        :params: Parameters of the workspace/executeCommand request
+        :dirty_files: Open documents of the client
+        :writer: asyncio.StreamWriter of the client
+        :state: Workspace the client opened
+        '''
+        if not HAS_YARA:
+            raise ce.NoYaraPython("yara-python is not installed. Scanning is disabled")
+        cmd = params.get("command", "")
+        args = params.get("arguments", None) or []
+        if not args or not args[0]:
+            raise ce.ScanError("{} needs the path of a {} to scan".format(cmd, "file" if cmd == "yara.ScanFile" else "folder"))
+        target = Path(helpers.parse_uri(args[0], encoding=self._encoding) if args[0].startswith("file:") else args[0])
+        loop = asyncio.get_event_loop()
+        if cmd == "yara.ScanFile":
+            if not target.is_file():
+                raise ce.ScanError("Could not find file to scan: {}".format(target))
+            paths = [target]
+        else:
+            if not target.is_dir():
+                raise ce.ScanError("Could not find folder to scan: {}".format(target))
+            paths = await loop.run_in_executor(None, lambda: list(iter_samples(target)))
+        overlay = self._snapshot(dirty_files)
+        if len(args) > 1 and args[1]:
+            documents = {args[1]: overlay.get(args[1], None)}
+        else:
+            documents = dict(overlay)
+            if state.root:
+                rule_files = await loop.run_in_executor(None, lambda: list(state.scanner.iter_paths()))
+                for file in rule_files:
+                    documents.setdefault(file.as_uri(), None)
+        if not documents:
+            raise ce.ScanError("There are no rules to scan with. Open a rule file or a workspace folder first")
+        self._logger.info("Compiling %d rule files to scan %s", len(documents), target)
+        try:
+            rules = await self.matcher.compile(documents, self._encoding, overlay)
+        except (OSError, load_yara().Error) as err:
+            raise ce.ScanError("Could not compile rules to scan with: {}".format(err))
+        token = params.get("workDoneToken", None)
+        if token is not None:
+            progress = {"kind": "begin", "title": "Scanning {}".format(target.name), "percentage": 0}
+            await self.send_notification("$/progress", {"token": token, "value": progress}, writer)
+        started = time.perf_counter()
+        counts = {"scanned": 0, "matched": 0}
+
+        async def scan():
+            async for result in self.matcher.scan_all(rules, paths):
+                counts["scanned"] += 1
+                counts["matched"] += 1 if result["matches"] else 0
+                if token is not None:
+                    message = "{}: {:d} matches in {:.3f} ms".format(Path(result["uri"]).name, len(result["matches"]), result["time_ms"])
+                    progress = {"kind": "report", "message": message, "percentage": counts["scanned"] * 100 // len(paths)}
+                    await self.send_notification("$/progress", {"token": token, "value": progress}, writer)
+                yield result
+
+        try:
+            partial_token = params.get("partialResultToken", None)
+            if partial_token is not None:
+                results = await self.stream_results(partial_token, scan(), writer)
+            else:
+                results = [result async for result in scan()]
+        finally:
+            if token is not None:
+                message = "Scanned {:d} files in {:.0f} ms, {:d} matched".format(
+                    counts["scanned"], (time.perf_counter() - started) * 1000, counts["matched"]
+                )
+                await self.send_notification("$/progress", {"token": token, "value": {"kind": "end", "message": message}}, writer)
+        self._logger.info("Scanned %d files in %s, %d matched", counts["scanned"], target, counts["matched"])
+        return results
+
+    async def provide_code_completion(self, params: dict, document: str):
         '''Respond to the completionItem/resolve request
 
-        Returns a (possibly empty) list of completion items
+        Returns the already serialized list of completion items, or an empty list
         '''
         try:
-            results = []
-            trigger = params.get("context", {}).get("triggerCharacter", ".")
-            # typically the trigger is at the end of a line, so subtract one to avoid an IndexError
+            # typically the trigger is at the end of a line, so look at the character before it
             pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"]-1)
-            symbol = helpers.resolve_symbol(document, pos)
+            lines = get_line_index(document)
+            start, end = lines.line_span(pos.line)
+            if pos.char < 0 or start + pos.char > end:
+                return []
+            symbol = get_syntax_tree(document).dotted_name_at(start + pos.char)
             if not symbol:
                 return []
-            # split up the symbols into component parts, leaving off the last trigger character
-            symbols = symbol.split(trigger)
-            schema = self.modules
-            for depth, symbol in enumerate(symbols):
-                if symbol in schema:
-                    # if we're at the last symbol, return completion items
-                    if depth == len(symbols) - 1:
-                        completion_items = schema.get(symbol, {})
-                        if isinstance(completion_items, dict):
-                            for label, kind_str in completion_items.items():
-                                kind = lsp.CompletionItemKind.CLASS
-                                if str(kind_str).lower() == "enum":
-                                    kind = lsp.CompletionItemKind.ENUM
-                                elif str(kind_str).lower() == "property":
-                                    kind = lsp.CompletionItemKind.PROPERTY
-                                elif str(kind_str).lower() == "method":
-                                    kind = lsp.CompletionItemKind.METHOD
-                                results.append(lsp.CompletionItem(label, kind))
-                    else:
-                        schema = schema[symbol]
-            return results
+            results = self.completions.get(symbol)
+            return [] if results is None else results
+        except IndexError:
+            return []
         except Exception as err:
             self._logger.error(err)
             raise ce.CodeCompletionError("Could not offer completion items: {}".format(err))
 
-    async def provide_definition(self, params: dict, document: str) -> list:
+    async def provide_definition(self, params: dict, document: str, symbols: SymbolOverlay=None) -> list:
         '''Respond to the textDocument/definition request
 
         Returns a (possibly empty) list of symbol Locations
         '''
-        results = []
+        return [location async for location in self.iter_definitions(params, document, symbols)]
+
+    async def iter_definitions(self, params: dict, document: str, symbols: SymbolOverlay=None):
+        '''Find the definitions for a textDocument/definition request
+
+        Yields symbol Locations as they are found. Rules defined in other
+        files are only found if the client's view of the workspace symbols is given
+        '''
         try:
-            # the try/except statement after this uses the 'symbol' variable in the exception block
-            # so we need to separate the code before 'symbol' is instantiated from the code after
-            # there's probably a better way to do this
             file_uri = params.get("textDocument", {}).get("uri", None)
-            line = params.get("position", {}).get("line", None)
-            char = params.get("position", {}).get("character", None)
-            pos = lsp.Position(line=line, char=char)
-            symbol = helpers.resolve_symbol(document, pos)
-            if not symbol:
-                return []
+            tree, offset, symbol = self._resolve_symbol(params, document)
+            if symbol is None:
+                return
         except Exception as err:
             self._logger.error(err)
             raise ce.DefinitionError("Could not find symbol for definition request")
         try:
+            lines = get_line_index(document)
             # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
-            if symbol[0] in self._varchar:
-                pattern = "\\${} =\\s".format("".join(symbol[1:]))
-                rule_range = helpers.get_rule_range(document, pos)
-                match_lines = document.split("\n")[rule_range.start.line:rule_range.end.line+1]
-                rel_offset = rule_range.start.line
-                # ignore the "$" variable identifier at the beginning of the match
-                char_start_offset = 1
-            # else assume this is a rule symbol
+            if symbol.is_string:
+                for string in tree.string_definitions(offset, symbol.name):
+                    # keep the range from the start of the name through the "= "
+                    end = string.equals.end
+                    if document[end:end+1].isspace():
+                        end += 1
+                    locrange = lsp.Range(start=lines.position_at(string.start + 1), end=lines.position_at(end))
+                    yield lsp.Location(locrange, file_uri)
             else:
-                pattern = "\\brule {}\\b".format(symbol)
-                match_lines = document.split("\n")
-                rel_offset = 0
-                # ignore the "rule " string at the beginning of the match
-                char_start_offset = 5
-
-            for index, line in enumerate(match_lines):
-                for match in re.finditer(pattern, line):
-                    if match:
-                        offset = rel_offset + index
-                        locrange = lsp.Range(
-                            start=lsp.Position(line=offset, char=match.start() + char_start_offset),
-                            end=lsp.Position(line=offset, char=match.end())
-                        )
-                        results.append(lsp.Location(locrange, file_uri))
-            return results
-        except re.error:
-            self._logger.debug("Error building regex pattern: %s", pattern)
-            return []
+                found = False
+                for index, rule in enumerate(tree.find_rules(symbol.value)):
+                    if index % YIELD_INTERVAL == YIELD_INTERVAL - 1:
+                        # give other requests a chance to run (or cancel this one)
+                        await asyncio.sleep(0)
+                    found = True
+                    yield lsp.Location(self._token_range(rule.name_token, lines), file_uri)
+                # rules can also be defined in other files in the workspace
+                if not found and symbols is not None:
+                    for location in symbols.iter_definitions(symbol.value, exclude=file_uri):
+                        yield location
+        except asyncio.CancelledError:
+            raise
         except Exception as err:
             self._logger.error(err)
-            raise ce.DefinitionError("Could not offer definition for symbol '{}': {}".format(symbol, err))
+            raise ce.DefinitionError("Could not offer definition for symbol '{}': {}".format(symbol.value, err))
 
-    async def provide_diagnostic(self, document: str) -> list:
+    async def provide_diagnostic(self, document: str, file_uri: str=None, overlay: dict=None, store_rules: bool=False) -> list:
         ''' Respond to the textDocument/publishDiagnostics request
 
         :document: Contents of YARA rule file
+        :file_uri: (Optional) URI of the rule file, which relative include paths are resolved against
+        :overlay: (Optional) dictionary of file_uri => text of open documents, used instead of their on-disk contents
+        :store_rules: (Optional) save the compiled rules to the rules store
         '''
         try:
             if HAS_YARA:
-                diagnostics = []
-                try:
-                    yara.compile(source=document)
-                except yara.SyntaxError as error:
-                    line_no, msg = helpers.parse_result(str(error))
-                    # VSCode is zero-indexed
-                    line_no -= 1
-                    first_char = helpers.get_first_non_whitespace_index(document.split("\n")[line_no])
-                    symbol_range = lsp.Range(
-                        start=lsp.Position(line_no, first_char),
-                        end=lsp.Position(line_no, 10000)
-                    )
-                    diagnostics.append(
-                        lsp.Diagnostic(
-                            locrange=symbol_range,
-                            severity=lsp.DiagnosticSeverity.ERROR,
-                            message=msg
-                        )
-                    )
-                except yara.WarningError as warning:
-                    line_no, msg = helpers.parse_result(str(warning))
-                    # VSCode is zero-indexed
-                    line_no -= 1
-                    first_char = helpers.get_first_non_whitespace_index(document.split("\n")[line_no])
-                    symbol_range = lsp.Range(
-                        start=lsp.Position(line_no, first_char),
-                        end=lsp.Position(line_no, 10000)
-                    )
-                    diagnostics.append(
-                        lsp.Diagnostic(
-                            locrange=symbol_range,
-                            severity=lsp.DiagnosticSeverity.WARNING,
-                            message=msg
-                        )
-                    )
+                # compile in a worker thread so the event loop keeps serving other requests
+                diagnostics = await self.compiler.compile(document, file_uri, self._encoding, overlay, store_rules)
                 return diagnostics
             else:
                 if self.diagnostics_warned:
@@ -510,107 +1202,87 @@ class YaraLanguageServer(LanguageServer):
     async def provide_hover(self, params: dict, document: str) -> list:
         ''' Respond to the textDocument/hover request '''
         try:
-            definitions = await self.provide_definition(params, document)
-            if len(definitions) > 0:
+            tree, offset, symbol = self._resolve_symbol(params, document)
+            if symbol is None or not symbol.is_string:
+                return None
+            for string in tree.string_definitions(offset, symbol.name):
                 # only care about the first definition; although there shouldn't be more
-                definition = definitions[0]
-                line = document.split("\n")[definition.range.start.line]
-                try:
-                    words = line.split(" = ")
-                    if len(words) > 1:
-                        contents = lsp.MarkupContent(lsp.MarkupKind.Plaintext, content=words[1])
-                        return lsp.Hover(contents)
-                except IndexError as err:
-                    self._logger.warning(words)
-                    self._logger.warning("IndexError at line %d: '%s'", definition.range.start.line, line)
+                if string.value is None:
+                    return None
+                contents = lsp.MarkupContent(lsp.MarkupKind.Plaintext, content=document[string.value.start:string.end])
+                return lsp.Hover(contents)
             return None
         except Exception as err:
             self._logger.error(err)
             raise ce.HoverError("Could not offer definition hover: {}".format(err))
 
-    async def provide_reference(self, params: dict, document: str) -> list:
+    async def provide_reference(self, params: dict, document: str, symbols: SymbolOverlay=None) -> list:
         '''The references request is sent from the client to the server to resolve
         project-wide references for the symbol denoted by the given text document position
 
         Returns a (possibly empty) list of symbol Locations
         '''
-        results = []
+        return [location async for location in self.iter_references(params, document, symbols)]
+
+    async def iter_references(self, params: dict, document: str, symbols: SymbolOverlay=None):
+        '''Find the references for a textDocument/references request
+
+        Yields symbol Locations as they are found. References in other
+        files are only found if the client's view of the workspace symbols is given
+        '''
         file_uri = params.get("textDocument", {}).get("uri", None)
-        pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
-        symbol = helpers.resolve_symbol(document, pos)
-        if not symbol:
-            return []
+        tree, offset, symbol = self._resolve_symbol(params, document)
+        if symbol is None:
+            return
         try:
-            # gotta match the wildcard variables first to build the correct regex pattern
-            # I don't think wildcards are technially supposed to work for rules, but a diagnostic
-            # will appear to the user if YARA can't compile it, so I won't worry too much
-            WILDCARD = ("*" in symbol)
-            if WILDCARD:
-                # remove parentheses and replace the YARA wildcard with a Python re equivalent
-                symbol = symbol.replace("*", ".*?").strip("()")
+            lines = get_line_index(document)
             # check to see if the symbol is a variable or a rule name (currently the only valid symbols)
-            if symbol[0] in self._varchar:
-                # any possible first character matching self._varchar must be treated as a reference
-                pattern = "[{}]{}\\b".format("".join(self._varchar), "".join(symbol[1:]))
-                rule_range = helpers.get_rule_range(document, pos)
-                rule_lines = document.split("\n")[rule_range.start.line:rule_range.end.line+1]
-                rel_offset = rule_range.start.line
-                char_start_offset = 1
-                if WILDCARD:
-                    # only search strings section if this is a wildcard variable
-                    # figure out the bounds of the strings section
-                    strings_start = [idx for idx, line in enumerate(rule_lines) if "strings:" in line][0]
-                    strings_end = [idx for idx, line in enumerate(rule_lines) if "condition:" in line][0]
-                    rule_lines = rule_lines[strings_start:strings_end]
-                    rel_offset += strings_start
+            if symbol.is_string:
+                for index, token in enumerate(tree.string_references(offset, symbol.name)):
+                    if index % YIELD_INTERVAL == YIELD_INTERVAL - 1:
+                        await asyncio.sleep(0)
+                    # ignore the $, #, @ or ! in front of the name
+                    locrange = lsp.Range(start=lines.position_at(token.start + 1), end=lines.position_at(token.end))
+                    yield lsp.Location(locrange, file_uri)
             else:
-                rel_offset = 0
-                pattern = "{}\\b".format(symbol)
-                rule_lines = document.split("\n")
-                char_start_offset = 0
-
-            for index, line in enumerate(rule_lines):
-                for match in re.finditer(pattern, line):
-                    if match:
-                        # index corresponds to line no. within each rule, not within file
-                        offset = rel_offset + index
-                        locrange = lsp.Range(
-                            start=lsp.Position(line=offset, char=match.start() + char_start_offset),
-                            end=lsp.Position(line=offset, char=match.end())
-                        )
-                        results.append(lsp.Location(locrange, file_uri))
-            return results
-        except re.error:
-            self._logger.debug("Error building regex pattern: %s", pattern)
-            return []
+                for index, token in enumerate(tree.iter_rule_refs(symbol.value)):
+                    if index % YIELD_INTERVAL == YIELD_INTERVAL - 1:
+                        # give other requests a chance to run (or cancel this one)
+                        await asyncio.sleep(0)
+                    yield lsp.Location(self._token_range(token, lines), file_uri)
+                # ... and in every other file in the workspace
+                if symbols is not None:
+                    for location in symbols.iter_references(symbol.value, exclude=file_uri):
+                        yield location
+        except asyncio.CancelledError:
+            raise
         except Exception as err:
             self._logger.error(err)
-            raise ce.SymbolReferenceError("Could not find references for '{}': {}".format(symbol, err))
+            raise ce.SymbolReferenceError("Could not find references for '{}': {}".format(symbol.value, err))
 
     async def provide_rename(self, params: dict, document: str, file_uri: str) -> list:
         ''' Respond to the textDocument/rename request '''
         results = lsp.WorkspaceEdit(file_uri=file_uri, changes=[])
         try:
-            pos = lsp.Position(line=params["position"]["line"], char=params["position"]["character"])
-            old_text = helpers.resolve_symbol(document, pos)
+            _, _, symbol = self._resolve_symbol(params, document)
+            old_text = symbol.name if symbol is not None else None
             new_text = params.get("newName", None)
             if new_text is None:
                 self._logger.warning("No text to rename symbol to. Skipping")
+            elif old_text is None:
+                self._logger.warning("No symbol to rename. Skipping")
             elif new_text == old_text:
                 self._logger.warning("New rename symbol is the same as the old. Skipping")
             elif old_text.endswith("*"):
                 self._logger.warning("Cannot rename wildcard symbols. Skipping")
-            # let provide_reference() determine symbol or rule
-            # and therefore what scope to look into
-            refs = await self.provide_reference(params, document)
-            for ref in refs:
-                # need to add one character to the position so the variable
-                # type is not overwritten
-                new_range = lsp.Range(
-                    lsp.Position(ref.range.start.line, ref.range.start.char+1),
-                    lsp.Position(ref.range.end.line, ref.range.end.char)
-                )
-                results.append(lsp.TextEdit(new_range, new_text))
+            else:
+                # let provide_reference() determine symbol or rule
+                # and therefore what scope to look into
+                refs = await self.provide_reference(params, document)
+                for ref in refs:
+                    # a WorkspaceEdit only covers this document
+                    if ref.uri == file_uri:
+                        results.append(lsp.TextEdit(ref.range, new_text))
             if len(results.changes) <= 0:
                 self._logger.warning("No symbol references found to rename. Skipping")
         except Exception as err: